@@ -1,8 +1,6 @@
 import os
-import socket
 
-import requests
-from laim import Laim
+from laim import Laim, WebhookSink
 
 
 class SlackHandler(Laim):
@@ -12,20 +10,21 @@ class SlackHandler(Laim):
             config_file=os.path.join(os.path.dirname(__file__), 'slack.yml'),
             user=os.getlogin(),
         )
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Authorization': 'Bearer %s' % self.config['slack-token']
-        })
-        self.channel_id = self.config['slack-channel-id']
-        self.hostname = socket.gethostname()
+        self.slack = WebhookSink(
+            'https://slack.com/api/chat.postMessage',
+            headers={
+                'Authorization': 'Bearer %s' % self.config['slack-token'],
+            },
+            payload={
+                'channel': self.config['slack-channel-id'],
+                'text': '{hostname} received mail for {recipients}:\n{body}',
+            },
+            name='slack',
+        )
 
 
     def handle_message(self, sender, recipients, message):
-        self.session.post('https://slack.com/api/chat.postMessage', json={
-            'channel': self.channel_id,
-            'text': '%s received mail for %s:\n%s' % (
-                self.hostname, ', '.join(recipients), message.get_payload()),
-        })
+        return self.slack.send(sender, recipients, message)
 
 
 if __name__ == '__main__':
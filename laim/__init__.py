@@ -1,2 +1,47 @@
-from .laim import Laim, unfold
-from .log import before_log, log
+# The sendmail command imports from this package, so the handler API is only
+# imported once it's used to keep sendmail quick to start
+import sys
+import types
+
+
+_EXPORTS = {
+    'CircuitBreaker': 'laim.breaker',
+    'Laim': 'laim.laim',
+    'unfold': 'laim.laim',
+    'before_log': 'laim.log',
+    'log': 'laim.log',
+    'PriorityRule': 'laim.priority',
+    'RateLimit': 'laim.ratelimit',
+    'QueuedMessage': 'laim.util',
+    'WebhookSink': 'laim.sinks',
+}
+
+__all__ = list(_EXPORTS)
+
+
+class _Package(types.ModuleType):
+    # Module level __getattr__ is only supported from Python 3.7, on a module
+    # subclass it works on all versions
+    def __getattr__(self, name):
+        module_name = _EXPORTS.get(name)
+        if module_name is None:
+            raise AttributeError('module %r has no attribute %r' % (__name__, name))
+        import importlib # pylint: disable=import-outside-toplevel
+        value = getattr(importlib.import_module(module_name), name)
+        setattr(self, name, value)
+        return value
+
+
+    def __dir__(self):
+        return sorted(set(globals()) | set(__all__))
+
+
+    def __setattr__(self, name, value):
+        # Importing the laim.log module sets it as an attribute on the package,
+        # which would hide the log function
+        if name == 'log' and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
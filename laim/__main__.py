@@ -2,20 +2,43 @@
 laim to sendmail compatibility interface.
 '''
 
+# Imports are kept to a minimum, or done where they're needed, since sendmail
+# is started for every message sent, like every cron job that produces output
 import argparse
-import email.parser
+import itertools
 import logging
 import os
 import pwd
-import smtplib
+import re
+import socket
 import sys
-import traceback
-from email.headerregistry import AddressHeader
 
 from laim._version import __version__
 
 # Extracted as a constant to make it easy to override for tests
 SMTP_PORT = 25
+SMTP_SOCKET = '/run/laim/smtp.sock'
+SPOOL_DIR = '/var/spool/laim'
+MAILDROP_DIR = '/var/spool/laim/maildrop'
+
+HEADER_RE = re.compile(rb'^[\x21-\x39\x3b-\x7e]+[ \t]*:')
+
+# Matches 'foo@example.com', 'foo (Comment)' and 'Foo <foo@example.com>',
+# which saves importing the full address parser for the common cases
+SIMPLE_ADDRESS_RE = re.compile(
+    r'^\s*(?:[\w .-]*<([^<>\s"(),]+)>|([^<>\s"(),]+)(?:\s*\([\w .-]*\))?)\s*$')
+
+# Bytes of the message to buffer before writing to the socket
+SEND_BUFFER_SIZE = 64*1024
+
+# Seconds to wait for laim to reply to each command
+SMTP_TIMEOUT = 3
+
+# Seconds to wait for laim to accept the message once it has been sent, which
+# covers a brief wait for space in a full queue. Beyond that the message is
+# dropped in the maildrop instead of blocking the caller, and closing the
+# connection has laim stop waiting and not queue it.
+DATA_REPLY_TIMEOUT = 2
 
 
 _logger = logging.getLogger('laim')
@@ -26,13 +49,40 @@ def main(argv=None):
     try:
         sendmail(args)
     except Exception as ex: # pylint: disable=broad-except
+        import traceback # pylint: disable=import-outside-toplevel
         _logger.debug(traceback.format_exc())
         _logger.warning('Failed to send mail: %s', ex)
         sys.exit(1)
 
 
 def mailq(prog='mailq'):
-    _logger.warning('%s: Mail queue is empty (and not used by laim)', prog)
+    import time # pylint: disable=import-outside-toplevel
+    from laim.spool import list_spool # pylint: disable=import-outside-toplevel
+
+    try:
+        entries = list_spool(SPOOL_DIR)
+    except FileNotFoundError:
+        _logger.warning('%s: Mail queue is empty (and not used by laim)', prog)
+        return
+    except PermissionError:
+        _logger.warning('%s: Permission denied reading the mail queue in %s', prog, SPOOL_DIR)
+        sys.exit(1)
+
+    if not entries:
+        _logger.warning('%s: Mail queue is empty', prog)
+        return
+
+    print('-Queue ID-----------------------  --Size-- ----Arrival Time---- '
+        '-Sender/Recipient-------')
+    total_size = 0
+    for entry in entries:
+        arrival_time = time.strftime('%a %b %d %H:%M:%S', time.localtime(entry.arrival_time))
+        print('%-32s %9d %-20s %s' % (entry.spool_id, entry.size, arrival_time, entry.sender))
+        for recipient in entry.recipients:
+            print('%64s%s' % ('', recipient))
+        total_size += entry.size
+    print('-- %d Kbytes in %d Request%s.' % (
+        (total_size + 1023) // 1024, len(entries), '' if len(entries) == 1 else 's'))
 
 
 def newaliases(prog='newaliases'):
@@ -48,27 +98,31 @@ def sendmail(args):
         newaliases('sendmail')
         return
 
-    message = read_message(args.i)
+    lines = iter(sys.stdin.buffer)
+    headers, first_body_line = read_headers(lines, args.i)
     sender = None
     recipients = args.recipients
-    if 'From' not in message:
+    if not headers.has('From'):
         sender = args.r or pwd.getpwuid(os.getuid()).pw_name
         if args.F:
-            message['From'] = '"%s" <%s>' % (args.F, sender)
+            headers.add('From', '"%s" <%s>' % (args.F, sender))
         else:
-            message['From'] = sender
+            headers.add('From', sender)
 
-    if 'To' not in message and not recipients:
+    if not headers.has('To') and not recipients:
         raise ValueError("Message doesn't have a To header and no recipients "
             'given on the command line')
 
     if args.t:
-        recipients.extend(extract_recipients_from_to_header(message['To']))
+        recipients.extend(extract_recipients_from_to_header(headers.get('To')))
 
-    send_mail(sender, unique(recipients), message)
+    body = read_body(lines, first_body_line, args.i)
+    send_mail(sender, unique(recipients), headers, body)
 
 
 def extract_recipients_from_to_header(to_header):
+    from email.headerregistry import AddressHeader # pylint: disable=import-outside-toplevel
+
     recipients = []
     address_header = AddressHeader.value_parser(to_header)
     for address in address_header:
@@ -89,20 +143,295 @@ def unique(iterable):
     return ret
 
 
-def read_message(stop_on_dot):
-    binary_lines = []
-    for line in sys.stdin.buffer:
-        if stop_on_dot and line == b'.\n':
+def is_ascii(value):
+    '''Like str.isascii and bytes.isascii, which require Python 3.7.'''
+    try:
+        if isinstance(value, bytes):
+            value.decode('ascii')
+        else:
+            value.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+class Headers:
+    '''
+    The raw header lines of a message, which is all sendmail needs to look at.
+    The body is passed through untouched.
+    '''
+
+    def __init__(self):
+        # List of (lowercased name, raw lines)
+        self.fields = []
+
+
+    def append_line(self, line):
+        if line[:1] in (b' ', b'\t') and self.fields:
+            self.fields[-1][1].append(line)
+        else:
+            name = line.split(b':', 1)[0].strip().lower()
+            self.fields.append((name.decode('ascii', 'replace'), [line]))
+
+
+    def has(self, name):
+        return any(field_name == name.lower() for field_name, _ in self.fields)
+
+
+    def get(self, name):
+        for field_name, lines in self.fields:
+            if field_name == name.lower():
+                value = b''.join(lines).split(b':', 1)[1]
+                return value.decode('utf-8', 'surrogateescape').strip()
+        return None
+
+
+    def add(self, name, value):
+        line = ('%s: %s' % (name, value)).encode('utf-8')
+        if not is_ascii(line):
+            from email.header import Header # pylint: disable=import-outside-toplevel
+            line = ('%s: %s' % (name, Header(value, 'utf-8').encode())).encode('ascii')
+        self.fields.append((name.lower(), [line + b'\n']))
+
+
+    def remove(self, name):
+        self.fields = [field for field in self.fields if field[0] != name.lower()]
+
+
+    def lines(self):
+        for _, lines in self.fields:
+            yield from lines
+
+
+def read_headers(lines, stop_on_dot):
+    '''
+    Read the header lines from stdin. Returns the headers, and the first line
+    of the body if it was read while looking for the end of the headers.
+    '''
+    headers = Headers()
+    first_body_line = None
+    for line in lines:
+        if line in (b'\n', b'\r\n'):
+            break
+        if not headers.fields and line.startswith(b'From '):
+            # mbox style envelope line, not a header
+            continue
+        if (stop_on_dot and line == b'.\n') or not (HEADER_RE.match(line)
+                or (line[:1] in (b' ', b'\t') and headers.fields)):
+            # The end of the message, or missing the blank line between
+            # headers and body
+            first_body_line = line
             break
-        binary_lines.append(line)
-    parser = email.parser.BytesParser()
-    message = parser.parsebytes(b''.join(binary_lines))
-    return message
+        headers.append_line(line)
+    return headers, first_body_line
 
 
-def send_mail(sender, recipients, message):
-    with smtplib.SMTP('127.0.0.1', port=SMTP_PORT, timeout=3) as smtp:
-        smtp.send_message(message, from_addr=sender, to_addrs=recipients or None)
+def read_body(lines, first_line, stop_on_dot):
+    if first_line is not None:
+        lines = itertools.chain([first_line], lines)
+    for line in lines:
+        if stop_on_dot and line == b'.\n':
+            return
+        yield line
+
+
+def send_mail(sender, recipients, headers, body):
+    if sender is None:
+        sender = get_sender_from_headers(headers)
+    if not recipients:
+        recipients = get_recipients_from_headers(headers)
+    headers.remove('Bcc')
+    headers.remove('Resent-Bcc')
+
+    # Keep what has been sent to be able to drop it in the maildrop if laim
+    # fails to accept it
+    sent_lines = []
+    def record(lines):
+        for line in lines:
+            sent_lines.append(line)
+            yield line
+
+    try:
+        with SMTPClient.connect(timeout=SMTP_TIMEOUT) as smtp:
+            smtp.send(sender, recipients, headers.lines(), record(body))
+    except (OSError, SMTPError) as ex:
+        if not is_temporary_failure(ex) or not os.path.isdir(MAILDROP_DIR):
+            raise
+        _logger.debug('laim is unavailable (%s), dropping the message in %s', ex, MAILDROP_DIR)
+        drop_mail(sender, recipients, headers, itertools.chain(sent_lines, body))
+
+
+def is_temporary_failure(ex):
+    '''
+    Whether laim is down or too busy to accept the message. Messages rejected
+    by policy, like rate limits, are not retried through the maildrop.
+    '''
+    if isinstance(ex, OSError):
+        return True
+    if ex.code is None:
+        return True
+    return 400 <= ex.code < 500 and not ex.message.startswith('4.7.')
+
+
+def drop_mail(sender, recipients, headers, body):
+    '''
+    Write the message to the maildrop for laim to pick up later. The message is
+    written to a temporary file that's renamed once it's complete, to never
+    be picked up half-written.
+    '''
+    import json # pylint: disable=import-outside-toplevel
+    import time # pylint: disable=import-outside-toplevel
+
+    filename = '%017.6f-%d-%s' % (time.time(), os.getpid(), os.urandom(4).hex())
+    tmp_path = os.path.join(MAILDROP_DIR, '.tmp-' + filename)
+    drop_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        # Readable by laim regardless of umask, the directory isn't listable
+        # for anyone but laim
+        os.fchmod(drop_fd, 0o644)
+        with open(drop_fd, 'wb', closefd=False) as drop_fh:
+            drop_fh.write(json.dumps({
+                'sender': sender,
+                'recipients': recipients,
+                'enqueued_at': time.time(),
+            }).encode('utf-8') + b'\n')
+            for line in itertools.chain(headers.lines(), [b'\n'], body):
+                drop_fh.write(line.rstrip(b'\r\n') + b'\r\n')
+        os.fsync(drop_fd)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    finally:
+        os.close(drop_fd)
+    os.rename(tmp_path, os.path.join(MAILDROP_DIR, filename))
+
+
+def get_sender_from_headers(headers):
+    # Same as smtplib's send_message
+    sender_header = headers.get('Sender') or headers.get('From')
+    match = SIMPLE_ADDRESS_RE.match(sender_header)
+    if match:
+        return match.group(1) or match.group(2)
+
+    from email.utils import getaddresses # pylint: disable=import-outside-toplevel
+    return getaddresses([sender_header])[0][1]
+
+
+def get_recipients_from_headers(headers):
+    from email.utils import getaddresses # pylint: disable=import-outside-toplevel
+
+    values = [headers.get(name) for name in ('To', 'Bcc', 'Cc')]
+    return [address for _, address in getaddresses([value for value in values if value])]
+
+
+class SMTPError(Exception):
+    def __init__(self, code, message):
+        super().__init__('%s %s' % (code, message) if code else message)
+        self.code = code
+        self.message = message
+
+
+class SMTPClient:
+    '''
+    Just enough of an SMTP client to submit a message to laim, writing the
+    body as it's read from stdin. smtplib needs the whole message in memory,
+    and is slow to import.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+
+
+    @classmethod
+    def connect(cls, timeout):
+        if os.path.exists(SMTP_SOCKET):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = SMTP_SOCKET
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ('127.0.0.1', SMTP_PORT)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        client = cls(sock)
+        client.expect(220)
+        return client
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        try:
+            self.command('QUIT')
+        except (OSError, SMTPError):
+            pass
+        self.close()
+
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+    def command(self, command, expected=(250,)):
+        _logger.debug('send: %s', command)
+        self.sock.sendall(command.encode('utf-8') + b'\r\n')
+        return self.expect(*expected)
+
+
+    def expect(self, *expected):
+        code, lines = self.read_reply()
+        if code not in expected:
+            raise SMTPError(code, ' '.join(lines))
+        return code, lines
+
+
+    def read_reply(self):
+        lines = []
+        while True:
+            line = self.reader.readline()
+            if not line:
+                raise SMTPError(None, 'Connection closed by server')
+            _logger.debug('reply: %s', line.rstrip())
+            lines.append(line[4:].strip().decode('utf-8', 'replace'))
+            if line[3:4] != b'-':
+                return int(line[:3]), lines
+
+
+    def send(self, sender, recipients, header_lines, body_lines):
+        self.command('EHLO %s' % socket.gethostname())
+        options = ''
+        if not all(is_ascii(address) for address in [sender] + recipients):
+            options = ' SMTPUTF8'
+        self.command('MAIL FROM:<%s>%s' % (sender, options))
+        for recipient in recipients:
+            self.command('RCPT TO:<%s>' % recipient, expected=(250, 251))
+        self.command('DATA', expected=(354,))
+
+        buffered = []
+        buffered_size = 0
+        lines = itertools.chain(header_lines, [b'\n'], body_lines)
+        for line in lines:
+            # Transparency, see RFC 5321 section 4.5.2
+            if line.startswith(b'.'):
+                line = b'.' + line
+            line = line.rstrip(b'\r\n') + b'\r\n'
+            buffered.append(line)
+            buffered_size += len(line)
+            if buffered_size >= SEND_BUFFER_SIZE:
+                self.sock.sendall(b''.join(buffered))
+                buffered = []
+                buffered_size = 0
+        buffered.append(b'.\r\n')
+        self.sock.sendall(b''.join(buffered))
+        self.sock.settimeout(DATA_REPLY_TIMEOUT)
+        self.expect(250)
 
 
 def parse_args(argv=None):
@@ -0,0 +1,169 @@
+'''
+Circuit breaker around the handler, to stop calling a downstream that is
+failing or slow, and let the queue drain instead of filling up behind it.
+'''
+
+import threading
+import time
+from collections import deque, namedtuple
+
+from .log import log
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+# Handed out by allow() for each call that's let through, to tell the calls
+# that probe whether the handler recovered from calls that were already
+# running, and calls from before the last change of state
+Permit = namedtuple('Permit', 'generation probe')
+
+
+class CircuitBreaker: # pylint: disable=too-many-instance-attributes
+    '''
+    Tracks the outcome of the handler calls in the last window seconds. Once
+    at least min_calls calls have been made in the window, the breaker opens
+    if the share of calls that failed reaches error_rate, or the share of calls
+    that took slow_call_ms or longer reaches slow_call_rate. Messages are not
+    handled while the breaker is open.
+
+    After open_seconds the breaker half-opens, and lets half_open_calls calls
+    through to probe whether the handler has recovered. It closes if they all
+    succeed in time, and opens again otherwise. Calls that started before the
+    breaker half-opened don't count as probes.
+    '''
+
+    def __init__(
+            self,
+            window=60,
+            min_calls=10,
+            error_rate=0.5,
+            slow_call_ms=None,
+            slow_call_rate=0.5,
+            open_seconds=30,
+            half_open_calls=1,
+            clock=time.monotonic,
+    ):
+        if min_calls < 1 or half_open_calls < 1:
+            raise ValueError('min_calls and half_open_calls must be at least 1')
+        if not 0 < error_rate <= 1 or not 0 < slow_call_rate <= 1:
+            raise ValueError('error_rate and slow_call_rate must be between 0 and 1')
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_ms = slow_call_ms
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        # (time, failed, slow) of the calls in the window
+        self._calls = deque()
+        self._failed = 0
+        self._slow = 0
+        self._opened_at = None
+        self._generation = 0
+        self._probes = 0
+        self._probe_successes = 0
+
+
+    def allow(self):
+        '''
+        Returns a Permit to pass to record() if the handler should be called,
+        None otherwise.
+        '''
+        transition = None
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.open_seconds:
+                    return None
+                transition = self._transition(HALF_OPEN)
+            permit = Permit(self._generation, probe=False)
+            if self.state == HALF_OPEN:
+                permit = None
+                if self._probes + self._probe_successes < self.half_open_calls:
+                    self._probes += 1
+                    permit = Permit(self._generation, probe=True)
+
+        if transition is not None:
+            log(transition, sender=self)
+        return permit
+
+
+    def record(self, permit, failed, duration_ms):
+        '''
+        Record the outcome of a call that was allowed. Calls that were
+        allowed before the breaker last changed state are ignored.
+        '''
+        slow = (self.slow_call_ms is not None and duration_ms is not None
+            and duration_ms >= self.slow_call_ms)
+        transition = None
+        with self._lock:
+            if permit.generation != self._generation:
+                return
+            if permit.probe:
+                self._probes -= 1
+                if failed or slow:
+                    transition = self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        transition = self._transition(CLOSED)
+            else:
+                now = self.clock()
+                self._calls.append((now, failed, slow))
+                self._failed += failed
+                self._slow += slow
+                self._prune(now)
+                calls = len(self._calls)
+                if calls >= self.min_calls and (self._failed >= calls*self.error_rate
+                        or self._slow >= calls*self.slow_call_rate):
+                    transition = self._transition(OPEN)
+
+        if transition is not None:
+            log(transition, sender=self)
+
+
+    def retry_after(self):
+        '''Seconds until messages that were not let through should be tried again.'''
+        with self._lock:
+            if self.state == OPEN:
+                return max(0, self._opened_at + self.open_seconds - self.clock())
+            # Give the probes a chance to finish
+            return self.open_seconds
+
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] <= now - self.window:
+            _, failed, slow = self._calls.popleft()
+            self._failed -= failed
+            self._slow -= slow
+
+
+    def _transition(self, state):
+        '''Change the state, returning the details to log once the lock is released.'''
+        calls = len(self._calls)
+        log_data = {
+            'action': 'circuit-breaker',
+            'state': state,
+            'previous_state': self.state,
+            'calls': calls,
+            'error_rate': self._failed/calls if calls else None,
+            'slow_rate': self._slow/calls if calls else None,
+        }
+        self.state = state
+        self._generation += 1
+        self._probes = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._opened_at = self.clock()
+        if state == CLOSED:
+            self._calls.clear()
+            self._failed = 0
+            self._slow = 0
+        return log_data
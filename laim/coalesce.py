@@ -0,0 +1,155 @@
+'''
+Suppression of duplicate messages, like the same failure mail from a cron job
+that runs every minute.
+'''
+
+import hashlib
+import heapq
+import re
+import threading
+import time
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+
+from .log import log
+from .message import READ_CHUNK_SIZE, FilePayload, read_header_bytes, split_headers
+
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+class Coalescer: # pylint: disable=too-many-instance-attributes
+    '''
+    Tracks messages by fingerprint. The first message with a given fingerprint
+    is handled right away, and opens a window where later messages with the
+    same fingerprint are suppressed. When the window closes the last of the
+    suppressed messages is requeued, with the number of messages it represents
+    set as repeats on the task.
+
+    requeue must not block, as it's called with the lock held to never
+    requeue a message after flush() returns.
+    '''
+
+    def __init__(self, window, requeue, discard):
+        self.window = window
+        self.requeue = requeue
+        self.discard = discard
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # fingerprint -> [suppressed count, last suppressed task]
+        self._windows = {}
+        self._expiry_heap = []
+        self._flushed = False
+        self._thread = threading.Thread(
+            target=self._run,
+            name='Laim coalescer',
+            daemon=True,
+        )
+        self._thread.start()
+
+
+    def accept(self, task_args):
+        '''
+        Returns whether the task should be handled now. Requeued tasks with
+        repeats are always accepted.
+        '''
+        if task_args.repeats:
+            return True
+
+        fingerprint = get_fingerprint(task_args)
+        with self._lock:
+            open_window = self._windows.get(fingerprint)
+            if open_window is None:
+                # No more windows are opened once flushed
+                if not self._flushed:
+                    self._windows[fingerprint] = [0, None]
+                    heapq.heappush(self._expiry_heap,
+                        (time.monotonic() + self.window, fingerprint))
+                    self._wakeup.notify()
+                return True
+
+            replaced_task = open_window[1]
+            open_window[0] += 1
+            open_window[1] = task_args
+            suppressed = open_window[0]
+
+        log({
+            'action': 'suppressed-duplicate',
+            'sender': task_args.sender,
+            'recipients': ','.join(task_args.recipients),
+            'fingerprint': fingerprint,
+            'suppressed': suppressed,
+        }, sender=self)
+
+        if replaced_task is not None:
+            self.discard(replaced_task)
+        return False
+
+
+    def flush(self):
+        '''
+        Requeue all suppressed messages without waiting for their windows to
+        close, and stop suppressing duplicates. Called when stopping, before
+        the workers are told to stop.
+        '''
+        with self._lock:
+            self._flushed = True
+            for suppressed, task_args in self._windows.values():
+                if task_args is not None:
+                    self.requeue(task_args._replace(repeats=suppressed))
+            self._windows = {}
+            self._expiry_heap = []
+            self._wakeup.notify()
+
+
+    def _run(self):
+        with self._lock:
+            while not self._flushed:
+                if not self._expiry_heap:
+                    self._wakeup.wait()
+                    continue
+                expires, fingerprint = self._expiry_heap[0]
+                remaining = expires - time.monotonic()
+                if remaining > 0:
+                    self._wakeup.wait(remaining)
+                    continue
+                heapq.heappop(self._expiry_heap)
+                suppressed, task_args = self._windows.pop(fingerprint, (0, None))
+                if task_args is not None:
+                    self.requeue(task_args._replace(repeats=suppressed))
+
+
+def get_fingerprint(task_args):
+    '''
+    Fingerprint a message by its sender, normalized subject and the hash of
+    its body.
+    '''
+    data = task_args.data
+    body_hash = hashlib.sha256()
+    if isinstance(data, FilePayload):
+        with data.open() as payload_fh:
+            header_bytes, body_start = split_headers(read_header_bytes(payload_fh))
+            body_hash.update(body_start)
+            for chunk in iter(lambda: payload_fh.read(READ_CHUNK_SIZE), b''):
+                body_hash.update(chunk)
+    else:
+        header_bytes, body = split_headers(data)
+        body_hash.update(body)
+
+    headers = BytesHeaderParser().parsebytes(bytes(header_bytes))
+    subject = headers.get('subject')
+    if subject is not None:
+        try:
+            subject = str(make_header(decode_header(subject)))
+        except (LookupError, UnicodeError):
+            # Unknown charset, fingerprint the raw subject
+            subject = str(subject)
+        subject = WHITESPACE_RE.sub(' ', subject).strip().lower()
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(str(task_args.sender).encode('utf-8', 'surrogateescape'))
+    fingerprint.update(b'\0')
+    fingerprint.update((subject or '').encode('utf-8', 'surrogateescape'))
+    fingerprint.update(b'\0')
+    fingerprint.update(body_hash.digest())
+    return fingerprint.hexdigest()[:16]
@@ -0,0 +1,58 @@
+'''
+Reading the config file, also after privileges have been dropped.
+
+The config file is only readable by root, so to be able to read it again on
+reload a small helper process is started before dropping privileges. The
+helper keeps running as root, and does nothing but read the config file when
+asked to. It exits when laim closes its end of the pipe.
+'''
+
+import json
+import os
+import subprocess
+import sys
+
+
+HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_helper.py')
+
+
+class ConfigReader:
+    '''
+    Reads the config file, through the privileged helper if there is one.
+    '''
+
+    def __init__(self, path, privileged_helper=False):
+        self.path = path
+        self.helper = None
+        if privileged_helper:
+            self.helper = subprocess.Popen(
+                [sys.executable, '-I', HELPER_PATH, path],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+            )
+
+
+    def read(self):
+        '''Returns the contents of the config file, raises OSError if it can't be read.'''
+        if self.helper is None:
+            with open(self.path, 'r') as config_fh:
+                return config_fh.read()
+
+        self.helper.stdin.write(b'read\n')
+        self.helper.stdin.flush()
+        response_line = self.helper.stdout.readline()
+        if not response_line:
+            raise OSError('The config helper exited with code %s' % self.helper.poll())
+        response = json.loads(response_line)
+        if 'error' in response:
+            raise OSError(response['error'])
+        return response['contents']
+
+
+    def close(self):
+        if self.helper is not None:
+            self.helper.stdin.close()
+            self.helper.stdout.close()
+            self.helper.wait()
+            self.helper = None
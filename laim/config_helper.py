@@ -0,0 +1,26 @@
+'''
+The privileged helper that reads the config file for laim.config.ConfigReader,
+and writes its contents back as JSON.
+
+The helper keeps running as root, so it's a standalone script that only uses
+the standard library. It's run by path in isolated mode rather than as part of
+the laim package, to not import anything from the package or PYTHONPATH.
+'''
+
+import json
+import sys
+
+
+def run_helper(path):
+    for _ in sys.stdin.buffer:
+        try:
+            with open(path, 'r') as config_fh:
+                response = {'contents': config_fh.read()}
+        except OSError as ex:
+            response = {'error': str(ex)}
+        sys.stdout.buffer.write(json.dumps(response).encode('utf-8') + b'\n')
+        sys.stdout.buffer.flush()
+
+
+if __name__ == '__main__':
+    run_helper(sys.argv[1])
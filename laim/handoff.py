@@ -0,0 +1,159 @@
+'''
+Handing over from a running laim to a newly started one, to upgrade without
+rejecting or losing mail.
+
+The new process connects to the handoff socket of the running process, which
+passes over its listening sockets and stops accepting connections. Once the
+SMTP sessions it had already accepted are done, it sends over the messages
+that are still queued and closes its end of the connection. The new process
+acknowledges once it has queued all of them, and the running process exits
+once the messages it was already handling are done. Without the
+acknowledgement the running process can't tell which messages the new one
+got, so it handles all of them itself.
+
+Messages are sent as a JSON header line, followed by the raw message unless
+it's stored in a file, in which case the new process reads it from the same
+file.
+'''
+
+import array
+import json
+import socket
+
+from .message import FilePayload
+from .sockets import bind_unix_socket, socket_from_fd
+from .util import TaskArguments
+
+
+# Max number of sockets that can be handed over
+MAX_SOCKETS = 64
+
+
+def connect_to_predecessor(path):
+    '''
+    Connect to the handoff socket of a running laim. Returns None if no laim
+    is listening on the socket.
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    return conn
+
+
+def take_over(path):
+    '''
+    Connect to a running laim and receive its listening sockets. Returns the
+    connection the queued messages are sent on and the sockets, or None and
+    no sockets if no laim is running.
+    '''
+    conn = connect_to_predecessor(path)
+    if conn is None:
+        return None, []
+    return conn, receive_sockets(conn)
+
+
+def listen_for_successor(path):
+    '''Bind the handoff socket, which only the laim user can connect to.'''
+    sock = bind_unix_socket(path, mode=0o600)
+    sock.setblocking(True)
+    return sock
+
+
+def send_sockets(conn, sockets):
+    '''Pass the listening sockets, and wait for the receiver to have them.'''
+    send_fds(conn, [b'%d\n' % len(sockets)], [sock.fileno() for sock in sockets])
+    wait_for_ack(conn)
+
+
+def send_tasks(conn, tasks):
+    '''
+    Send the tasks and wait for the receiver to have queued all of them.
+    Raises OSError if the receiver went away before that.
+    '''
+    with conn.makefile('wb') as handoff_fh:
+        for task_args in tasks:
+            send_task(handoff_fh, task_args)
+    conn.shutdown(socket.SHUT_WR)
+    wait_for_ack(conn)
+
+
+def send_ack(conn):
+    conn.sendall(b'ok\n')
+
+
+def wait_for_ack(conn):
+    ack = conn.recv(3)
+    if ack != b'ok\n':
+        raise ConnectionError('Unexpected handoff acknowledgement: %r' % ack)
+
+
+def receive_sockets(conn):
+    _, fds = recv_fds(conn, 1024, MAX_SOCKETS)
+    sockets = []
+    for sock_fd in fds:
+        sock = socket_from_fd(sock_fd)
+        sock.setblocking(False)
+        sockets.append(sock)
+    send_ack(conn)
+    return sockets
+
+
+def send_fds(conn, buffers, fds):
+    '''Like socket.send_fds, which is only available from Python 3.9.'''
+    return conn.sendmsg(buffers, [
+        (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)),
+    ])
+
+
+def recv_fds(conn, bufsize, maxfds):
+    '''Like socket.recv_fds, returning the data and the received fds.'''
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(bufsize, socket.CMSG_LEN(maxfds*fds.itemsize))
+    for level, cmsg_type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    return data, list(fds)
+
+
+def send_task(handoff_fh, task_args):
+    header = {
+        'sender': task_args.sender,
+        'recipients': task_args.recipients,
+        'spool_id': task_args.spool_id,
+        'repeats': task_args.repeats,
+        'enqueued_at': task_args.enqueued_at,
+        'attempts': task_args.attempts,
+        'priority': task_args.priority,
+    }
+    if isinstance(task_args.data, FilePayload):
+        header['file'] = list(task_args.data)
+        handoff_fh.write(json.dumps(header).encode('utf-8') + b'\n')
+    else:
+        header['size'] = len(task_args.data)
+        handoff_fh.write(json.dumps(header).encode('utf-8') + b'\n')
+        handoff_fh.write(task_args.data)
+
+
+def read_tasks(handoff_fh):
+    '''Yields the tasks sent by send_task until the sender closes the connection.'''
+    for header_line in handoff_fh:
+        header = json.loads(header_line.decode('utf-8'))
+        if 'file' in header:
+            data = FilePayload(*header['file'])
+        else:
+            data = handoff_fh.read(header['size'])
+            if len(data) != header['size']:
+                raise ConnectionError('Handoff connection closed in the middle of a message')
+        yield TaskArguments(
+            header['sender'],
+            header['recipients'],
+            data,
+            header['spool_id'],
+            header['repeats'],
+            header['enqueued_at'],
+            header.get('attempts', 0),
+            header.get('priority'),
+        )
@@ -1,194 +1,998 @@
+import asyncio
+import inspect
+import multiprocessing
+import os
 import platform
 import queue
 import signal
+import sys
 import threading
 import time
-from collections import namedtuple
-from email import message_from_string
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from email.header import decode_header, make_header
+from email.policy import compat32
 
 import sdnotify
 import setproctitle
 import yaml
-from aiosmtpd.controller import Controller
-from aiosmtpd.smtp import SMTP
 
-from .util import drop_privileges, unfold
-from .log import log, format_message_structure
-from ._version import __version__
-
-
-TaskArguments = namedtuple('TaskArguments', 'sender recipients data')
-
-
-class Laim:
+from .coalesce import Coalescer
+from .config import ConfigReader
+from .handoff import (listen_for_successor, read_tasks, send_ack, send_sockets, send_tasks,
+    take_over)
+from .util import QueuedMessage, drop_privileges, get_owner, unfold
+from .log import configure_log_writer, flush_logs, format_message_structure, log
+from .maildrop import MaildropWatcher, create_maildrop
+from .message import LazyMessage, get_payload_size, remove_file_payload
+from .metrics import Metrics, start_metrics_server
+from .ordering import KeyOrdering
+from .priority import NORMAL_PRIORITY, PrioritySpoolQueue, PriorityTaskQueue, Prioritizer
+from .profiler import SamplingProfiler
+from .ratelimit import RateLimiter
+from .retry import create_dead_letter_dir, create_retry_scheduler, write_dead_letter
+from .routing import Router
+from .server import ADMISSION_POLL_INTERVAL, LaimController, LaimHandler
+from .sockets import bind_unix_socket, describe_socket, get_systemd_sockets
+from .spool import SpoolQueue
+from .taskqueue import TaskQueue
+
+
+# Max seconds a worker waits on the queue before checking for messages to
+# retry, which might have been scheduled by another worker in the meantime
+RETRY_POLL_INTERVAL = 1
+
+
+class Laim: # pylint: disable=too-many-instance-attributes
 
     def __init__(
             self,
             port=25,
             user='laim',
             max_queue_size=50,
+            max_queue_bytes=256*1024*1024,
             config_file='/etc/laim/config.yml',
             smtp_kwargs=None,
+            num_workers=1,
+            ordering_key=None,
+            max_concurrency=10,
+            use_processes=False,
+            spool_dir=None,
+            max_batch_size=100,
+            batch_linger_ms=500,
+            email_policy=compat32,
+            spill_threshold=1024*1024,
+            spill_dir=None,
+            coalesce_window=None,
+            rate_limits=None,
+            admission_timeout=10,
+            metrics_address=None,
+            log_target='stdout',
+            log_buffer_size=10000,
+            profile_seconds=10,
+            unix_socket=None,
+            handoff_socket=None,
+            handoff_timeout=30,
+            maildrop_dir=None,
+            max_attempts=1,
+            retry_delay=1,
+            max_retry_delay=300,
+            max_retrying=1000,
+            dead_letter_dir=None,
+            priority_rules=None,
+            priority_aging=60,
+            routes=None,
+            circuit_breaker=None,
+            shed_priority=None,
     ):
         setproctitle.setproctitle('laim')
-        self.queue = queue.Queue(max_queue_size)
-        self.notifier = sdnotify.SystemdNotifier()
-        handler = LaimHandler(self.queue)
-        privilege_event = threading.Event()
-        self.controller = LaimController(
-            privilege_event,
-            handler,
-            port=port,
-            smtp_kwargs=smtp_kwargs,
+        configure_log_writer(log_target, max_buffer_size=log_buffer_size)
+        self.is_async = inspect.iscoroutinefunction(self.handle_message)
+        # Handlers opt in to batching by implementing handle_messages
+        self.is_batched = hasattr(self, 'handle_messages')
+        self._check_options(num_workers, max_concurrency, ordering_key, use_processes,
+            max_batch_size, max_attempts, routes)
+        # Routes are dispatched from the default handle_message
+        self.router = None if routes is None else Router(routes, self)
+        # A laim that is already running hands over its sockets and the
+        # messages it hasn't handled yet
+        predecessor, inherited_sockets = None, []
+        self.handoff_listener = None
+        if handoff_socket is not None:
+            predecessor, inherited_sockets = take_over(handoff_socket)
+            self.handoff_listener = listen_for_successor(handoff_socket)
+        prioritizer = None if priority_rules is None else Prioritizer(priority_rules)
+        # The spool is still in use by the predecessor, it sends over what it
+        # hasn't handled instead
+        self.queue = create_queue(max_queue_size, spool_dir, prioritizer, priority_aging,
+            replay=predecessor is None, user=user)
+        self.num_workers = num_workers
+        self.handoff_timeout = handoff_timeout
+        self.ordering = None if ordering_key is None else KeyOrdering(ordering_key, num_workers)
+        self.max_concurrency = max_concurrency
+        self.use_processes = use_processes
+        self.process_pool = None
+        self.max_batch_size = max_batch_size
+        self.batch_linger = batch_linger_ms/1000
+        self.email_policy = email_policy
+        self.coalescer = None if coalesce_window is None else Coalescer(
+            coalesce_window, self._requeue, self._task_done)
+        self.breaker = circuit_breaker
+        self.shed_priority = shed_priority
+        self.retries = create_retry_scheduler(max_attempts, retry_delay, max_retry_delay,
+            max_retrying, circuit_breaker)
+        self.dead_letter_dir = dead_letter_dir
+        if dead_letter_dir is not None:
+            create_dead_letter_dir(dead_letter_dir, *get_owner(user))
+        self.workers = []
+        self.maildrop = None
+        if maildrop_dir is not None:
+            # Created before dropping privileges since anyone can write to it
+            create_maildrop(maildrop_dir, *get_owner(user))
+            # The predecessor hands over what it took from the maildrop
+            self.maildrop = MaildropWatcher(maildrop_dir, self.queue,
+                spooled=spool_dir is not None, requeue_queued=predecessor is None,
+                prioritizer=prioritizer)
+        handler = LaimHandler(
+            self.queue,
+            spill_threshold,
+            spill_dir,
+            RateLimiter(rate_limits) if rate_limits else None,
+            admission_timeout,
+            prioritizer,
+            max_queue_bytes,
+            self.retries,
         )
-
         # Start the controller while we have the privileges to bind the port
-        self.controller.start()
+        self.controller = start_controller(handler, port, smtp_kwargs, inherited_sockets,
+            unix_socket)
+
+        self.metrics_server = None if metrics_address is None else start_metrics_server(
+            Metrics(self.queue, self.breaker), metrics_address)
 
         # Let systemd we're done binding to the network socket
-        self.notifier.notify('READY=1')
+        sdnotify.SystemdNotifier().notify('READY=1')
         log({
             'action': 'started',
-            'port': port,
-            'max_queue_size': max_queue_size,
+            'listen': ','.join(describe_socket(sock) for sock in self.controller.server.sockets),
+            'socket_activated': not self.controller.bind_port,
+            'handed_over': predecessor is not None,
+            'max_queue_size': self.queue.maxsize,
+            'max_queue_bytes': max_queue_bytes,
+            'num_workers': num_workers,
+            'async_handler': self.is_async,
+            'use_processes': use_processes,
+            'batched_handler': self.is_batched,
+            'prioritized': prioritizer is not None,
+            'routed': routes is not None,
+            'circuit_breaker': circuit_breaker is not None,
+            'spool_dir': spool_dir,
+            'maildrop_dir': maildrop_dir,
+            'max_attempts': max_attempts,
+            'dead_letter_dir': dead_letter_dir,
+            'metrics_address': metrics_address,
+            'log_target': log_target,
+            'replayed': getattr(self.queue, 'replayed', 0),
             'config_file': config_file,
             'py': platform.python_version(),
         }, sender=self)
 
-        with open(config_file, 'r') as config_fh:
-            drop_privileges(user)
-            self.config = yaml.safe_load(config_fh)
+        self.config_reader, self.config = load_config(config_file, user)
+        self._reload_lock = threading.Lock()
+        self._process_pool_lock = threading.Lock()
 
         self.stop_event = threading.Event()
-        signal.signal(signal.SIGTERM, self._signalhandler)
-        signal.signal(signal.SIGINT, self._signalhandler)
+        self.profiler = SamplingProfiler(duration=profile_seconds)
+        self._install_signal_handlers()
 
         # Allow client sessions to be created
-        privilege_event.set()
+        self.controller.privilege_event.set()
+
+        if predecessor is not None:
+            self._start_receiving_handoff(predecessor)
+
+
+    def _check_options(self, num_workers, max_concurrency, ordering_key, use_processes,
+            max_batch_size, max_attempts, routes):
+        '''Raise ValueError for options that are invalid or can't be combined.'''
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1')
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        if self.is_async and ordering_key is not None:
+            raise ValueError('ordering_key is not supported for async handlers')
+        if self.is_async and use_processes:
+            raise ValueError('use_processes is not supported for async handlers')
+        if use_processes and sys.version_info < (3, 7):
+            raise ValueError('use_processes requires Python 3.7 or newer')
+        if self.is_batched and (self.is_async or ordering_key is not None or use_processes):
+            raise ValueError('handle_messages can not be combined with async handlers, '
+                'ordering_key or use_processes')
+        if routes is not None and (self.is_async or self.is_batched):
+            raise ValueError('routes can not be combined with async handlers or '
+                'handle_messages')
 
 
     def handle_message(self, sender, recipients, message):
-        raise NotImplementedError('The handler must implement handle_message')
+        if self.router is not None:
+            return self.router.dispatch(sender, recipients, message)
+        raise NotImplementedError('The handler must implement handle_message or set routes')
+
+
+    def reload_config(self, config):
+        '''
+        Called with the new config when the config file is reloaded, before
+        it's made available as self.config. Raise an exception to reject the
+        new config and keep the current one. Messages are handled as usual
+        while this runs.
+        '''
 
 
     def run(self):
-        worker_thread = threading.Thread(
-            target=self._start_worker,
-            name='Laim worker',
-            daemon=False,
-        )
-        worker_thread.start()
+        if self.router is not None:
+            # Targets can be sinks created after the constructor has run
+            self.router.resolve()
+
+        if self.use_processes:
+            self._start_process_pool()
+
+        if self.maildrop is not None:
+            self.maildrop.start()
+
+        if self.handoff_listener is not None:
+            handoff_thread = threading.Thread(
+                target=self._accept_handoff,
+                name='Laim handoff',
+                daemon=True,
+            )
+            handoff_thread.start()
+
+        self._start_workers()
 
         self.stop_event.wait()
         self.controller.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+
+        for worker_thread in self.workers:
+            worker_thread.join()
+
+        if self.retries is not None:
+            self._drop_retries()
+
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+        self.config_reader.close()
+        flush_logs()
+
+
+    def _start_workers(self):
+        if self.is_async:
+            target = self._start_async_worker
+        elif self.is_batched:
+            target = self._start_batch_worker
+        else:
+            target = self._start_worker
+        for worker_num in range(self.num_workers):
+            name = 'Laim worker'
+            if self.num_workers > 1:
+                name = 'Laim worker %d' % worker_num
+            worker_thread = threading.Thread(
+                target=target,
+                name=name,
+                daemon=False,
+            )
+            worker_thread.start()
+            self.workers.append(worker_thread)
 
 
     def stop(self):
-        self.queue.put(None)
+        if self.maildrop is not None:
+            self.maildrop.stop()
+
+        if self.coalescer is not None:
+            self.coalescer.flush()
+
+        # One sentinel per worker, each worker exits after consuming one
+        for _ in range(self.num_workers):
+            self.queue.put(None)
         self.stop_event.set()
 
 
+    def _install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._signalhandler)
+        signal.signal(signal.SIGINT, self._signalhandler)
+        signal.signal(signal.SIGHUP, self._reload_signalhandler)
+        signal.signal(signal.SIGUSR1, self._profile_signalhandler)
+
+
     def _signalhandler(self, signum, frame): # pylint: disable=unused-argument
         self.stop()
 
 
+    def _profile_signalhandler(self, signum, frame): # pylint: disable=unused-argument
+        self.profiler.start()
+
+
+    def _reload_signalhandler(self, signum, frame): # pylint: disable=unused-argument
+        # Reloading might block on reading the file, keep that out of the
+        # signal handler
+        reload_thread = threading.Thread(
+            target=self.reload,
+            name='Laim config reload',
+            daemon=True,
+        )
+        reload_thread.start()
+
+
+    def reload(self):
+        '''
+        Read the config file again, and replace self.config if it's valid and
+        accepted by reload_config. Returns whether the config was replaced.
+        '''
+        with self._reload_lock:
+            start_time = time.time()
+            try:
+                config = yaml.safe_load(self.config_reader.read())
+                self.reload_config(config)
+            except Exception as ex: # pylint: disable=broad-except
+                log({
+                    'action': 'reload-config-error',
+                    'error': ex.__class__.__name__,
+                    'error_msg': str(ex),
+                }, start_time, sender=self)
+                return False
+
+            # A single assignment, so a handler sees either the old or the new
+            # config in full
+            self.config = config
+            if self.process_pool is not None:
+                # The worker processes have a copy of the old config
+                self._restart_process_pool()
+            log({'action': 'reload-config'}, start_time, sender=self)
+            return True
+
+
+    def _accept_handoff(self):
+        conn, _ = self.handoff_listener.accept()
+        with conn:
+            self._hand_off(conn)
+
+
+    def _hand_off(self, conn):
+        '''
+        Give the listening sockets and queued messages to a successor, and
+        stop once the messages being handled are done. If the successor goes
+        away before it has all of the messages, they're handled here instead.
+        '''
+        start_time = time.time()
+        log_data = {'action': 'handoff'}
+        try:
+            send_sockets(conn, self.controller.server.sockets)
+        except OSError as ex:
+            # Nothing has been handed over yet, keep serving
+            add_handoff_error_to_log_data(log_data, ex)
+            log(log_data, start_time, sender=self)
+            return
+        self.controller.stop_accepting()
+
+        # Sessions that were already accepted might still queue messages,
+        # the ones that don't finish in time are closed to not queue messages
+        # after they've been handed over
+        deadline = time.monotonic() + self.handoff_timeout
+        while self.controller.active_sessions and time.monotonic() < deadline:
+            time.sleep(ADMISSION_POLL_INTERVAL)
+        log_data['active_sessions'] = self.controller.active_sessions
+        self.controller.close_sessions()
+
+        if self.coalescer is not None:
+            self.coalescer.flush()
+
+        tasks = self._take_queued_tasks()
+        try:
+            conn.settimeout(self.handoff_timeout)
+            send_tasks(conn, tasks)
+            log_data['handed_over'] = len(tasks)
+        except OSError as ex:
+            # The successor has the listening sockets, so handle the messages
+            # here and stop like after a successful handoff
+            add_handoff_error_to_log_data(log_data, ex)
+            log_data['requeued'] = len(tasks)
+            for task_args in tasks:
+                self.queue.put(task_args)
+        log(log_data, start_time, sender=self)
+        self.stop()
+
+
+    def _take_queued_tasks(self):
+        tasks = []
+        while True:
+            try:
+                task_args = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if task_args is None:
+                # Already stopping, leave the sentinel for the workers
+                self.queue.put(None)
+                break
+            tasks.append(task_args)
+        if self.retries is not None:
+            # The successor retries these right away
+            tasks.extend(self.retries.drain())
+        return tasks
+
+
+    def _start_receiving_handoff(self, predecessor):
+        handoff_thread = threading.Thread(
+            target=self._receive_handoff,
+            args=(predecessor,),
+            name='Laim handoff',
+            daemon=True,
+        )
+        handoff_thread.start()
+
+
+    def _receive_handoff(self, predecessor):
+        start_time = time.time()
+        received = 0
+        with predecessor, predecessor.makefile('rb') as handoff_fh:
+            try:
+                for task_args in read_tasks(handoff_fh):
+                    self.queue.put(task_args)
+                    received += 1
+                send_ack(predecessor)
+            except (OSError, ValueError) as ex:
+                log({
+                    'action': 'handoff-received-error',
+                    'received': received,
+                    'error': ex.__class__.__name__,
+                    'error_msg': str(ex),
+                }, start_time, sender=self)
+                return
+
+        log({
+            'action': 'handoff-received',
+            'received': received,
+        }, start_time, sender=self)
+
+
+    def _start_process_pool(self):
+        '''
+        Fork one process per worker thread. This happens after privileges have
+        been dropped and the config has been read, so the worker processes
+        inherit the fully initialized handler.
+        '''
+        self.process_pool = self._create_process_pool()
+
+
+    def _create_process_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker_process,
+            initargs=(self,),
+        )
+
+
+    def _restart_process_pool(self):
+        '''
+        Replace the worker processes with ones forked from the current state,
+        letting the old processes finish what they've been given first.
+        '''
+        new_pool = self._create_process_pool()
+        with self._process_pool_lock:
+            old_pool = self.process_pool
+            self.process_pool = new_pool
+        old_pool.shutdown(wait=False)
+
+
     def _start_worker(self):
         while True:
-            task_args = self.queue.get()
+            if self.ordering is not None:
+                self.ordering.wait_for_room()
+            task_args = self._get_task()
             if task_args is None:
                 break
 
-            start_time = time.time()
-            message_string = task_args.data.decode('utf-8')
-            message = message_from_string(message_string)
-            raw_subject = message.get('subject')
+            if self.ordering is None:
+                self._handle_task(task_args)
+            else:
+                self.ordering.handle(task_args, self._handle_task)
+
+
+    def _get_task(self, block=True, timeout=None):
+        '''
+        Get the next task to handle, either a message that's due to be retried
+        or the next message from the queue, skipping duplicates.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            polling = False
+            if self.retries is not None:
+                task_args, retry_wait = self.retries.pop_due()
+                if task_args is not None:
+                    return task_args
+                retry_wait = RETRY_POLL_INTERVAL if retry_wait is None else min(
+                    retry_wait, RETRY_POLL_INTERVAL)
+                if block and (wait is None or retry_wait < wait):
+                    wait = retry_wait
+                    polling = True
+
+            try:
+                task_args = self.queue.get(block, wait)
+            except queue.Empty:
+                if polling:
+                    continue
+                raise
+            if task_args is None or self.coalescer is None or self.coalescer.accept(task_args):
+                return task_args
 
-            # Decode the subject to make it easier to consume for handlers
-            decoded_subject = None
-            if raw_subject:
-                decoded_subject = str(make_header(decode_header(raw_subject)))
-                message.replace_header('subject', decoded_subject)
 
+    def _start_batch_worker(self):
+        while True:
+            batch, stopped = self._get_batch()
+            if batch:
+                self._handle_batch(batch)
+            if stopped:
+                break
+
+
+    def _get_batch(self):
+        '''
+        Wait for a message, and then collect more messages until either the
+        batch is full or the linger time has passed. Returns the batch and
+        whether the stop sentinel was received.
+        '''
+        task_args = self._get_task()
+        if task_args is None:
+            return [], True
+
+        batch = [task_args]
+        deadline = time.monotonic() + self.batch_linger
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    task_args = self._get_task(timeout=remaining)
+                else:
+                    task_args = self._get_task(block=False)
+            except queue.Empty:
+                break
+            if task_args is None:
+                return batch, True
+            batch.append(task_args)
+
+        return batch, False
+
+
+    def _handle_batch(self, batch):
+        start_time = time.time()
+        permit = self._allow(batch, start_time)
+        if permit is None:
+            return
+
+        parsed = [self._parse_task(task_args) for task_args in batch]
+        messages = [QueuedMessage(task_args.sender, task_args.recipients, message)
+            for task_args, (message, _) in zip(batch, parsed)]
+
+        batch_log_data = {'batch_size': len(batch)}
+        handler_start = time.time()
+        try:
+            handler_data = self.handle_messages(messages) # pylint: disable=no-member
+            if handler_data:
+                batch_log_data.update(handler_data)
+        except Exception as ex: # pylint: disable=broad-except
+            add_error_to_log_data(batch_log_data, ex)
+        batch_log_data['handler_ms'] = (time.time() - handler_start)*1000
+        if self.breaker is not None:
+            self.breaker.record(permit, 'error' in batch_log_data, batch_log_data['handler_ms'])
+
+        for task_args, (message, log_data) in zip(batch, parsed):
+            add_message_details(log_data, message)
+            log_data.update(batch_log_data)
+            retrying = self._retry_or_dead_letter(task_args, log_data)
+            log(log_data, start_time, sender=self)
+            if not retrying:
+                self._task_done(task_args)
+
+
+    def _start_async_worker(self):
+        '''
+        Run an event loop handling up to max_concurrency messages concurrently
+        with the async handle_message.
+        '''
+        loop = asyncio.new_event_loop()
+        # The queue is read on a dedicated thread to not block the loop
+        queue_reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            loop.run_until_complete(self._run_async_worker(loop, queue_reader))
+        finally:
+            queue_reader.shutdown()
+            loop.close()
+
+
+    async def _run_async_worker(self, loop, queue_reader):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        in_flight = set()
+
+        def on_task_done(task):
+            in_flight.discard(task)
+            semaphore.release()
+
+        while True:
+            # Don't take messages off the queue before they can be handled, to
+            # let the queue apply backpressure if the handler is slow
+            await semaphore.acquire()
+            task_args = await loop.run_in_executor(queue_reader, self._get_task)
+            if task_args is None:
+                break
+
+            task = loop.create_task(self._handle_task_async(task_args))
+            in_flight.add(task)
+            task.add_done_callback(on_task_done)
+
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+
+    async def _handle_task_async(self, task_args):
+        start_time = time.time()
+        permit = self._allow([task_args], start_time)
+        if permit is None:
+            return
+
+        message, log_data = self._parse_task(task_args)
+        handler_start = time.time()
+        try:
+            handler_data = await self.handle_message(task_args.sender, task_args.recipients,
+                message)
+            if handler_data:
+                log_data.update(handler_data)
+        except Exception as ex: # pylint: disable=broad-except
+            add_error_to_log_data(log_data, ex)
+        finally:
+            log_data['handler_ms'] = (time.time() - handler_start)*1000
+            if self.breaker is not None:
+                self.breaker.record(permit, log_data['action'] == 'handle-message-error',
+                    log_data['handler_ms'])
+            add_message_details(log_data, message)
+            retrying = self._retry_or_dead_letter(task_args, log_data)
+            log(log_data, start_time, sender=self)
+            if not retrying:
+                self._task_done(task_args)
+
+
+    def _handle_task(self, task_args):
+        start_time = time.time()
+        permit = self._allow([task_args], start_time)
+        if permit is None:
+            return
+
+        if self.process_pool is None:
+            log_data = self._call_handler(task_args)
+        else:
+            log_data = self._call_handler_in_process(task_args)
+        if self.breaker is not None:
+            # The handler time is missing if the worker process died
+            self.breaker.record(permit, log_data['action'] == 'handle-message-error',
+                log_data.get('handler_ms'))
+        retrying = self._retry_or_dead_letter(task_args, log_data)
+        log(log_data, start_time, sender=self)
+        if not retrying:
+            self._task_done(task_args)
+
+
+    def _task_done(self, task_args):
+        if task_args.spool_id is not None:
+            self.queue.ack(task_args)
+        else:
+            remove_file_payload(task_args.data)
+
+
+    def _requeue(self, task_args):
+        '''
+        Put a message the coalescer held back on the queue. This mustn't block
+        as it's also done from stop() in the signal handler, so if the queue
+        is full spooled messages are left in the spool to be handled on the
+        next start, and others are written to the dead-letter directory.
+        '''
+        try:
+            self.queue.put_nowait(task_args)
+        except queue.Full:
             log_data = {
-                'action': 'handle-message',
-                'parse_time': '%.3fs' % (time.time() - start_time),
+                'action': 'requeue-queue-full',
                 'sender': task_args.sender,
                 'recipients': ','.join(task_args.recipients),
-                'msg_structure': format_message_structure(message),
-                'raw_subject': unfold(raw_subject),
-                'decoded_subject': decoded_subject,
-                'msg_defects': ','.join(e.__class__.__name__ for e in message.defects),
+                'repeats': task_args.repeats,
             }
-
-            try:
-                handler_data = self.handle_message(task_args.sender, task_args.recipients, message)
-                if handler_data:
-                    log_data.update(handler_data)
-            except Exception as ex: # pylint: disable=broad-except
-                log_data['action'] = 'handle-message-error'
-                log_data['error'] = ex.__class__.__name__
-                log_data['error_msg'] = str(ex)
-            finally:
+            if task_args.spool_id is None:
+                if self.dead_letter_dir is not None:
+                    self._dead_letter(task_args, log_data, 'QueueFull', 'The queue was full')
+                self._task_done(task_args)
+            log(log_data, sender=self)
+
+
+    def _retry_or_dead_letter(self, task_args, log_data):
+        '''
+        Schedule a retry of a message the handler failed to handle, or write
+        it to the dead-letter directory if it has no attempts left. Returns
+        whether the message is kept to be retried.
+        '''
+        if log_data['action'] != 'handle-message-error':
+            return False
+
+        failed_recipients = log_data.get('failed_recipients')
+        if failed_recipients is not None:
+            # The routes of the other recipients already handled the message
+            task_args = task_args._replace(recipients=failed_recipients)
+            log_data['failed_recipients'] = ','.join(failed_recipients)
+
+        if self.retries is not None and self.retries.max_attempts > 1:
+            log_data['attempt'] = task_args.attempts + 1
+            delay = self.retries.schedule(task_args)
+            if delay is not None:
+                log_data['retry_in_ms'] = delay*1000
+                return True
+
+        if self.dead_letter_dir is not None:
+            failed_task = task_args._replace(attempts=task_args.attempts + 1)
+            self._dead_letter(failed_task, log_data, log_data['error'], log_data['error_msg'])
+        return False
+
+
+    def _allow(self, tasks, start_time):
+        '''
+        Returns the circuit breaker's permit to handle the tasks, or True
+        without a breaker. Returns None if the breaker didn't let them
+        through, after parking or shedding them.
+        '''
+        if self.breaker is None:
+            return True
+        permit = self.breaker.allow()
+        if permit is None:
+            for task_args in tasks:
+                self._park_or_shed(task_args, start_time)
+        return permit
+
+
+    def _park_or_shed(self, task_args, start_time):
+        '''
+        Hold on to a message while the circuit breaker is open, to try it
+        again once the breaker lets calls through. Messages with a priority of
+        shed_priority or lower are shed instead, like messages that don't fit
+        with the other waiting messages.
+        '''
+        log_data = {
+            'action': 'park-message',
+            'sender': task_args.sender,
+            'recipients': ','.join(task_args.recipients),
+            'circuit': self.breaker.state,
+        }
+        priority = task_args.priority or NORMAL_PRIORITY
+        if self.shed_priority is None or priority < self.shed_priority:
+            delay = self.retries.park(task_args, self.breaker.retry_after())
+            if delay is not None:
+                log_data['retry_in_ms'] = delay*1000
                 log(log_data, start_time, sender=self)
+                return
 
+        log_data['action'] = 'shed-message'
+        if self.dead_letter_dir is not None:
+            self._dead_letter(task_args, log_data, 'CircuitOpen',
+                'The circuit breaker was %s' % self.breaker.state)
+        log(log_data, start_time, sender=self)
+        self._task_done(task_args)
 
-class LaimHandler:
-    def __init__(self, task_queue):
-        self.task_queue = task_queue
+
+    def _dead_letter(self, task_args, log_data, error=None, error_msg=None):
+        try:
+            log_data['dead_letter'] = write_dead_letter(
+                self.dead_letter_dir, task_args, error, error_msg)
+        except OSError as ex:
+            log_data['dead_letter_error'] = str(ex)
+
+
+    def _drop_retries(self):
+        '''
+        Give up on the messages still waiting to be retried when stopping.
+        Spooled messages are kept in the spool and retried on the next start,
+        others are written to the dead-letter directory if there is one, and
+        are lost otherwise.
+        '''
+        for task_args in self.retries.drain():
+            if task_args.spool_id is not None:
+                continue
+            log_data = {
+                'action': 'retry-dropped',
+                'sender': task_args.sender,
+                'recipients': ','.join(task_args.recipients),
+                'attempts': task_args.attempts,
+            }
+            if self.dead_letter_dir is not None:
+                self._dead_letter(task_args, log_data)
+            else:
+                log_data['action'] = 'retry-lost'
+                log_data['enqueued_at'] = task_args.enqueued_at
+                log_data['msg_size'] = get_payload_size(task_args.data)
+            log(log_data, sender=self)
+            self._task_done(task_args)
 
 
-    async def handle_DATA(self, server, session, envelope): # pylint: disable=invalid-name,unused-argument
+    def _call_handler_in_process(self, task_args):
+        try:
+            with self._process_pool_lock:
+                future = self.process_pool.submit(_handle_task_in_process, task_args)
+            return future.result()
+        except Exception as ex: # pylint: disable=broad-except
+            # The worker process died or the task couldn't be sent to it
+            log_data = {
+                'action': 'handle-message',
+                'sender': task_args.sender,
+                'recipients': ','.join(task_args.recipients),
+            }
+            add_error_to_log_data(log_data, ex)
+            return log_data
+
+
+    def _call_handler(self, task_args):
+        message, log_data = self._parse_task(task_args)
+        handler_start = time.time()
+        try:
+            handler_data = self.handle_message(task_args.sender, task_args.recipients, message)
+            if handler_data:
+                log_data.update(handler_data)
+        except Exception as ex: # pylint: disable=broad-except
+            add_error_to_log_data(log_data, ex)
+            failed_recipients = getattr(ex, 'failed_recipients', None)
+            if failed_recipients is not None:
+                # Set by the router when only some of the routes failed
+                log_data['failed_recipients'] = failed_recipients
+        log_data['handler_ms'] = (time.time() - handler_start)*1000
+        add_message_details(log_data, message)
+        return log_data
+
+
+    def _parse_task(self, task_args):
         start_time = time.time()
-        mail_from = envelope.mail_from
-        data = envelope.content
-        recipients = envelope.rcpt_tos
+        message = LazyMessage(task_args.data, self.email_policy)
+        raw_subject = message.get('subject')
+        if raw_subject is not None:
+            # Headers with undecodable bytes are returned as Header objects
+            raw_subject = str(raw_subject)
+
+        # Decode the subject to make it easier to consume for handlers
+        decoded_subject = None
+        if raw_subject:
+            decoded_subject = str(make_header(decode_header(raw_subject)))
+            message.replace_header('subject', decoded_subject)
+
+        parse_duration = time.time() - start_time
         log_data = {
-            'action': 'queued-message',
-            'mail_from': mail_from,
-            'recipients': ','.join(recipients),
-            'msg_size': len(data),
-            'client': session.host_name,
+            'action': 'handle-message',
+            'parse_time': '%.3fs' % parse_duration,
+            'parse_ms': parse_duration*1000,
+            'queue_wait_ms': None,
+            'sender': task_args.sender,
+            'recipients': ','.join(task_args.recipients),
+            # Filled in by add_message_details once the handler is done
+            'msg_structure': None,
+            'raw_subject': unfold(raw_subject),
+            'decoded_subject': decoded_subject,
+            'msg_defects': None,
         }
-        try:
-            self.task_queue.put_nowait(TaskArguments(mail_from, recipients, data))
-            log(log_data, start_time, sender=self)
-        except queue.Full:
-            log_data['action'] = 'queue-full'
-            log(log_data, start_time, sender=self)
-            return '552 Exceeded storage allocation'
 
-        return '250 OK'
+        if task_args.enqueued_at is not None:
+            log_data['queue_wait_ms'] = (start_time - task_args.enqueued_at)*1000
 
+        if task_args.attempts:
+            log_data['attempt'] = task_args.attempts + 1
 
-class LaimController(Controller):
-    def __init__(self, privilege_event, handler, port, smtp_kwargs=None):
-        super().__init__(handler, hostname='localhost', port=port)
-        self.smtp_kwargs = smtp_kwargs
-        self.privilege_event = privilege_event
+        if task_args.repeats:
+            # Let the handler know how many duplicates this message represents
+            message['X-Laim-Repeats'] = str(task_args.repeats)
+            log_data['repeats'] = task_args.repeats
 
+        return message, log_data
 
-    def factory(self):
-        kwargs = {
-            'enable_SMTPUTF8': True,
-            'ident': 'laim %s' % __version__,
-        }
-        if self.smtp_kwargs:
-            kwargs.update(self.smtp_kwargs)
 
-        return LaimSMTP(self.privilege_event, self.handler, **kwargs)
+def create_queue(max_queue_size, spool_dir, prioritizer, priority_aging, replay, user):
+    # The count limit is optional, the byte budget bounds the queue either way
+    max_queue_size = max_queue_size or 0
+    if spool_dir is None:
+        if prioritizer is None:
+            return TaskQueue(max_queue_size)
+        return PriorityTaskQueue(max_queue_size, aging=priority_aging)
 
+    if prioritizer is None:
+        task_queue = SpoolQueue(spool_dir, max_queue_size, replay=replay)
+    else:
+        task_queue = PrioritySpoolQueue(spool_dir, max_queue_size, replay=replay,
+            aging=priority_aging)
+    uid, gid = get_owner(user)
+    if uid is not None:
+        # Keep the spool writable after dropping privileges
+        task_queue.chown(uid, gid)
+    return task_queue
 
-class LaimSMTP(SMTP):
+
+def load_config(config_file, user):
+    '''
+    Read the config file and drop privileges, returning the config along with
+    a reader that can still read the file after dropping privileges, to be
+    able to reload it.
     '''
-    Subclass to make sure no sessions are created before we've dropped
-    privileges.
+    with open(config_file, 'r') as config_fh:
+        config_reader = ConfigReader(config_file, privileged_helper=os.geteuid() == 0)
+        drop_privileges(user)
+        return config_reader, yaml.safe_load(config_fh)
+
+
+def start_controller(handler, port, smtp_kwargs, inherited_sockets, unix_socket):
+    # Sockets passed by systemd or the predecessor replace binding the port
+    # ourselves, which lets the kernel queue connections while laim is
+    # restarting
+    listen_sockets = inherited_sockets or get_systemd_sockets()
+    socket_activated = bool(listen_sockets)
+    if unix_socket is not None and not inherited_sockets:
+        listen_sockets.append(bind_unix_socket(unix_socket))
+    controller = LaimController(
+        threading.Event(),
+        handler,
+        port=port,
+        smtp_kwargs=smtp_kwargs,
+        sockets=listen_sockets,
+        bind_port=not socket_activated,
+    )
+    controller.start()
+    return controller
+
+
+def add_message_details(log_data, message):
     '''
-    def __init__(self, privilege_event, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.privilege_event = privilege_event
+    Describe the structure of the message, without parsing the body if the
+    handler didn't need it. The time spent on this is logged as details_ms.
+    '''
+    start_time = time.time()
+    if message.is_parsed:
+        log_data['msg_structure'] = format_message_structure(message)
+        defects = message.defects
+    else:
+        log_data['msg_structure'] = message.get_content_type()
+        defects = message.header_defects
+    log_data['msg_defects'] = ','.join(e.__class__.__name__ for e in defects)
+    log_data['details_ms'] = (time.time() - start_time)*1000
+
+
+# The handler inherited by a forked worker process
+_process_handler = None
+
+
+def _init_worker_process(handler):
+    global _process_handler # pylint: disable=global-statement
+    _process_handler = handler
+
+    # Let the parent decide when to stop, it'll shut down the pool once the
+    # queue has been drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _handle_task_in_process(task_args):
+    return _process_handler._call_handler(task_args) # pylint: disable=protected-access
+
+
+def add_handoff_error_to_log_data(log_data, ex):
+    log_data['action'] = 'handoff-error'
+    log_data['error'] = ex.__class__.__name__
+    log_data['error_msg'] = str(ex)
 
 
-    def _create_session(self):
-        self.privilege_event.wait()
-        return super()._create_session()
+def add_error_to_log_data(log_data, ex):
+    log_data['action'] = 'handle-message-error'
+    log_data['error'] = ex.__class__.__name__
+    log_data['error_msg'] = str(ex)
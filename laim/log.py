@@ -1,7 +1,12 @@
+import atexit
 import numbers
+import os
 import re
+import socket
+import struct
 import threading
 import time
+from collections import deque
 
 from blinker import signal
 
@@ -9,6 +14,8 @@ from ._version import __version__
 
 STDOUT_LOCK = threading.Lock()
 NEEDS_QUOTES_RE = re.compile(r'[\s=]')
+JOURNALD_SOCKET = '/run/systemd/journal/socket'
+JOURNALD_FIELD_RE = re.compile(r'[^A-Z0-9_]')
 
 before_log = signal('before-log')
 
@@ -20,10 +27,198 @@ def log(context, start_time=None, sender=None):
         context['duration_ms'] = (time.time() - start_time)*1000
 
     before_log.send(sender, log_data=context)
-    message = format_context(context)
+    _log_writer.write(context)
 
-    with STDOUT_LOCK:
-        print(message)
+
+class SyncLogWriter:
+    '''Writes log lines from the calling thread.'''
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.dropped = 0
+
+
+    def write(self, context):
+        self.sink.write_batch([context])
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class BufferedLogWriter: # pylint: disable=too-many-instance-attributes
+    '''
+    Writes log lines in batches from a background thread, so that callers
+    never wait for the sink. If the sink can't keep up and the buffer is full
+    new lines are dropped, and the number of dropped lines is logged once the
+    sink catches up.
+    '''
+
+    def __init__(self, sink, max_buffer_size=10000):
+        self.sink = sink
+        self.max_buffer_size = max_buffer_size
+        self.dropped = 0
+        self._unreported_drops = 0
+        self._buffer = deque()
+        self._writing = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='Laim log writer',
+            daemon=True,
+        )
+        self._thread.start()
+
+
+    def write(self, context):
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer_size:
+                self.dropped += 1
+                self._unreported_drops += 1
+                return
+            self._buffer.append(context)
+            self._cond.notify_all()
+
+
+    def flush(self):
+        '''Wait for everything written so far to reach the sink.'''
+        with self._cond:
+            while self._buffer or self._writing:
+                self._cond.wait()
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if not self._buffer and self._closed:
+                    return
+                batch = list(self._buffer)
+                self._buffer.clear()
+                if self._unreported_drops:
+                    batch.append({
+                        'action': 'log-dropped',
+                        'dropped': self._unreported_drops,
+                        'version': __version__,
+                    })
+                    self._unreported_drops = 0
+                self._writing = True
+
+            try:
+                self.sink.write_batch(batch)
+            except Exception: # pylint: disable=broad-except
+                # Nowhere to report this, but the writer must keep running
+                with self._cond:
+                    self.dropped += len(batch)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+
+class StdoutSink:
+    def write_batch(self, batch): # pylint: disable=no-self-use
+        message = '\n'.join(format_context(context) for context in batch)
+        with STDOUT_LOCK:
+            print(message, flush=True)
+
+
+class JournaldSink:
+    '''
+    Sends log lines to journald with the native protocol, with every key in
+    the context as a separate field in addition to the logfmt message.
+    '''
+
+    def __init__(self, socket_path=JOURNALD_SOCKET, identifier='laim'):
+        self.socket_path = socket_path
+        self.identifier = identifier
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+
+    def write_batch(self, batch):
+        for context in batch:
+            self.socket.sendto(self.format_entry(context), self.socket_path)
+
+
+    def format_entry(self, context):
+        fields = [
+            ('MESSAGE', format_context(context)),
+            ('PRIORITY', '3' if 'error' in context else '6'),
+            ('SYSLOG_IDENTIFIER', self.identifier),
+        ]
+        for key, value in context.items():
+            fields.append(('LAIM_' + JOURNALD_FIELD_RE.sub('_', key.upper()),
+                format_value(value)))
+        return b''.join(format_journald_field(key, value) for key, value in fields)
+
+
+def format_journald_field(key, value):
+    key = key.encode('utf-8')
+    value = value.encode('utf-8', 'surrogateescape')
+    if b'\n' in value:
+        # Values with newlines must be sent with an explicit length
+        return key + b'\n' + struct.pack('<Q', len(value)) + value + b'\n'
+    return key + b'=' + value + b'\n'
+
+
+_log_writer = SyncLogWriter(StdoutSink())
+
+
+def configure_log_writer(target='stdout', buffered=True, max_buffer_size=10000):
+    '''
+    Replace the current log writer. target is either 'stdout' or 'journald'.
+    '''
+    global _log_writer # pylint: disable=global-statement
+    if target == 'stdout':
+        sink = StdoutSink()
+    elif target == 'journald':
+        sink = JournaldSink()
+    else:
+        raise ValueError('Unknown log target %r' % target)
+
+    if buffered:
+        writer = BufferedLogWriter(sink, max_buffer_size)
+    else:
+        writer = SyncLogWriter(sink)
+
+    old_writer = _log_writer
+    _log_writer = writer
+    old_writer.flush()
+    old_writer.close()
+    return writer
+
+
+def get_log_writer():
+    return _log_writer
+
+
+def flush_logs():
+    _log_writer.flush()
+
+
+def _reset_log_writer_after_fork():
+    # The writer thread doesn't survive the fork, write synchronously instead
+    global _log_writer # pylint: disable=global-statement
+    _log_writer = SyncLogWriter(_log_writer.sink)
+
+
+atexit.register(flush_logs)
+# Only Python 3.7 and newer, where laim forks worker processes with use_processes
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_log_writer_after_fork)
 
 
 def format_context(context):
@@ -33,6 +228,17 @@ def format_context(context):
 
 
 def format_key_value_pair(key, value):
+    value = format_value(value)
+
+    should_quote = NEEDS_QUOTES_RE.search(value)
+
+    if should_quote:
+        value = '"%s"' % value
+
+    return '%s=%s' % (key, value)
+
+
+def format_value(value):
     if value is None:
         value = ''
     elif value is True:
@@ -45,13 +251,7 @@ def format_key_value_pair(key, value):
         value = '%.4f' % value
     else:
         value = str(value)
-
-    should_quote = NEEDS_QUOTES_RE.search(value)
-
-    if should_quote:
-        value = '"%s"' % value
-
-    return '%s=%s' % (key, value)
+    return value
 
 
 def format_message_structure(message):
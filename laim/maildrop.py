@@ -0,0 +1,215 @@
+'''
+Messages dropped in the maildrop directory by sendmail while laim was down or
+too busy to accept them.
+
+Each message is a file with a JSON header line with the envelope, followed by
+the raw message, like in the spool. sendmail writes the file to a dotfile and
+renames it once it's complete. The directory is watched with inotify where
+available, and polled otherwise.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import stat
+import threading
+import time
+
+from .log import log
+from .message import FilePayload, get_payload_size
+from .util import TaskArguments
+
+
+# Max seconds between checking the maildrop for new files, also with inotify
+POLL_INTERVAL = 5
+
+# Messages being handled are renamed with this prefix, to not be picked up
+# again while they're queued
+QUEUED_PREFIX = '.queued-'
+
+# Files that could not be read as a message are renamed with this prefix
+INVALID_PREFIX = '.invalid-'
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+
+
+class MaildropWatcher: # pylint: disable=too-many-instance-attributes
+    '''
+    Puts messages from the maildrop on the queue. With a spool the message is
+    spooled and removed from the maildrop, otherwise the maildrop file is
+    removed once the message has been handled, like spilled messages.
+    '''
+
+    def __init__(self, directory, task_queue, spooled, requeue_queued=True, prioritizer=None):
+        self.directory = directory
+        self.task_queue = task_queue
+        self.spooled = spooled
+        self.requeue_queued = requeue_queued
+        self.prioritizer = prioritizer
+        self.stop_event = threading.Event()
+        self._inotify_fd = None
+        self._thread = None
+
+
+    def start(self):
+        self._inotify_fd = create_inotify_watch(self.directory)
+        self._thread = threading.Thread(
+            target=self._run,
+            name='Laim maildrop',
+            daemon=True,
+        )
+        self._thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+    def _run(self):
+        if self.requeue_queued:
+            # Left over from a previous run that didn't get to handle them
+            for filename in self._list(QUEUED_PREFIX):
+                self._ingest(filename)
+
+        while not self.stop_event.is_set():
+            for filename in self._list():
+                if self.stop_event.is_set():
+                    break
+                self._ingest(filename)
+            self._wait()
+
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+
+
+    def _list(self, prefix=''):
+        filenames = []
+        for filename in os.listdir(self.directory):
+            if prefix:
+                if filename.startswith(prefix):
+                    filenames.append(filename)
+            elif not filename.startswith('.'):
+                filenames.append(filename)
+        return sorted(filenames)
+
+
+    def _wait(self):
+        if self._inotify_fd is None:
+            self.stop_event.wait(POLL_INTERVAL)
+            return
+
+        readable, _, _ = select.select([self._inotify_fd], [], [], POLL_INTERVAL)
+        if readable:
+            # Only used as a wakeup, the directory is listed either way
+            try:
+                while os.read(self._inotify_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+    def _ingest(self, filename):
+        start_time = time.time()
+        path = os.path.join(self.directory, filename)
+        try:
+            if not self.spooled and not filename.startswith(QUEUED_PREFIX):
+                queued_path = os.path.join(self.directory, QUEUED_PREFIX + filename)
+                os.rename(path, queued_path)
+                path = queued_path
+            task_args = read_maildrop_file(path, in_memory=self.spooled)
+            if self.prioritizer is not None:
+                task_args = task_args._replace(priority=self.prioritizer.classify(
+                    task_args.sender, task_args.recipients, task_args.data))
+
+            # Blocks while the queue is full, the message is safe in the
+            # maildrop in the meantime
+            self.task_queue.put(task_args)
+            if self.spooled:
+                os.unlink(path)
+        except (OSError, ValueError, KeyError) as ex:
+            if not isinstance(ex, OSError):
+                # Not something sendmail wrote, keep it out of the way
+                os.rename(path, os.path.join(self.directory, INVALID_PREFIX + filename))
+            log({
+                'action': 'maildrop-error',
+                'file': filename,
+                'error': ex.__class__.__name__,
+                'error_msg': str(ex),
+            }, start_time, sender=self)
+            return
+
+        log_data = {
+            'action': 'queued-message',
+            'mail_from': task_args.sender,
+            'recipients': ','.join(task_args.recipients),
+            'msg_size': get_payload_size(task_args.data),
+            'client': 'maildrop',
+        }
+        if task_args.priority is not None:
+            log_data['priority'] = task_args.priority
+        log(log_data, start_time, sender=self)
+
+
+def read_maildrop_file(path, in_memory):
+    '''
+    Anyone can write to the maildrop, so only regular files are read: a
+    symlink could point to a file only laim can read, and a FIFO would block.
+    '''
+    try:
+        drop_fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError as ex:
+        if ex.errno == errno.ELOOP:
+            raise ValueError('Not a regular file: %s' % path) from ex
+        raise
+    with open(drop_fd, 'rb') as drop_fh:
+        drop_stat = os.fstat(drop_fd)
+        if not stat.S_ISREG(drop_stat.st_mode):
+            raise ValueError('Not a regular file: %s' % path)
+        header_line = drop_fh.readline()
+        envelope = json.loads(header_line.decode('utf-8'))
+        if in_memory:
+            data = drop_fh.read()
+        else:
+            data = FilePayload(path, len(header_line), drop_stat.st_size - len(header_line))
+    return TaskArguments(envelope['sender'], envelope['recipients'], data,
+        enqueued_at=envelope.get('enqueued_at'))
+
+
+def create_maildrop(directory, uid=None, gid=None):
+    '''
+    Create the maildrop so that anyone can drop messages in it, but only laim
+    can list and read them. Like /tmp, files can only be removed by the owner
+    of the file or of the directory.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    os.chmod(directory, 0o1733)
+    if uid is not None:
+        os.chown(directory, uid, gid)
+
+
+def create_inotify_watch(directory): # pylint: disable=too-many-return-statements
+    '''
+    Returns an inotify file descriptor watching for files appearing in the
+    directory, or None if inotify is not available.
+    '''
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    watch_fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if watch_fd < 0:
+        return None
+    if inotify_add_watch(watch_fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(watch_fd)
+        return None
+    return watch_fd
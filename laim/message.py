@@ -0,0 +1,186 @@
+import io
+import os
+import re
+import tempfile
+from collections import namedtuple
+from email.message import EmailMessage, Message
+from email.parser import BytesHeaderParser, BytesParser, HeaderParser, Parser
+from email.policy import compat32
+
+
+HEADER_END_RE = re.compile(br'\r?\n\r?\n')
+READ_CHUNK_SIZE = 64*1024
+
+
+class FilePayload(namedtuple('FilePayload', 'path offset size')):
+    '''
+    A raw message stored in a file instead of in memory, starting at offset.
+    The file isn't opened through symlinks, as maildrop files can be replaced
+    by whoever dropped them.
+    '''
+
+    def open(self):
+        payload_fh = open(os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW), 'rb')
+        payload_fh.seek(self.offset)
+        return payload_fh
+
+
+def spill_to_file(data, directory=None):
+    '''Write the raw message to a temporary file, returning a FilePayload.'''
+    spill_fd, path = tempfile.mkstemp(prefix='laim-', dir=directory)
+    with open(spill_fd, 'wb') as spill_fh:
+        spill_fh.write(data)
+    return FilePayload(path, 0, len(data))
+
+
+def get_payload_size(data):
+    if isinstance(data, FilePayload):
+        return data.size
+    return len(data)
+
+
+class LazyMessage(Message):
+    '''
+    Message that parses only the headers up front, while the body and the MIME
+    structure is parsed from the raw bytes the first time it's accessed. Until
+    then header lookups are served from the headers alone, which saves parsing
+    large attachments for handlers that only look at the headers.
+
+    The raw message can be either bytes or a FilePayload, which is read from
+    disk as it's parsed. Messages are parsed like parse_message does.
+
+    With a policy that creates EmailMessage objects, like email.policy.default,
+    the message is a LazyEmailMessage instead.
+    '''
+
+    def __new__(cls, data=None, policy=compat32): # pylint: disable=unused-argument
+        # Copying and unpickling create the object without arguments
+        if cls is LazyMessage and issubclass(policy.message_factory or Message, EmailMessage):
+            return super().__new__(LazyEmailMessage)
+        return super().__new__(cls)
+
+
+    def __init__(self, data, policy=compat32):
+        super().__init__(policy=policy)
+        if isinstance(data, FilePayload):
+            with data.open() as payload_fh:
+                headers = parse_headers(read_header_bytes(payload_fh), policy)
+        else:
+            headers = parse_headers(data, policy)
+        self._headers = headers._headers # pylint: disable=protected-access
+        self.set_unixfrom(headers.get_unixfrom())
+        # Defects found in the headers, all defects are in defects once the
+        # body has been parsed
+        self.header_defects = headers.defects
+        self._data = data
+        # Read from the parsed message when first accessed
+        for name in LAZY_ATTRIBUTES:
+            delattr(self, name)
+
+
+    @property
+    def is_parsed(self):
+        return '_data' not in self.__dict__
+
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, thus for the lazy
+        # attributes until the body has been parsed
+        if name not in LAZY_ATTRIBUTES or self.is_parsed:
+            raise AttributeError(name)
+        self._parse_body()
+        return getattr(self, name)
+
+
+    def _parse_body(self):
+        message = parse_message(self.__dict__.pop('_data'), self.policy)
+        for name in LAZY_ATTRIBUTES:
+            # Unless the handler already replaced it
+            if name not in self.__dict__:
+                setattr(self, name, getattr(message, name))
+
+
+class LazyEmailMessage(LazyMessage, EmailMessage):
+    '''A LazyMessage with the EmailMessage API.'''
+
+
+# The parts of a Message that come from the body
+LAZY_ATTRIBUTES = ('_payload', '_charset', 'preamble', 'epilogue', 'defects')
+
+
+def parse_message(data, policy=compat32):
+    '''
+    Parse a raw message, either bytes or a FilePayload. Messages that are valid
+    UTF-8 are parsed as text, so 8-bit text without a declared charset is
+    decoded as UTF-8, while other messages are parsed as bytes.
+    '''
+    if isinstance(data, FilePayload):
+        return parse_message_file(data, policy)
+
+    try:
+        text = bytes(data).decode('utf-8')
+    except UnicodeDecodeError:
+        return BytesParser(policy=policy).parsebytes(data)
+    return Parser(policy=policy).parsestr(text)
+
+
+def parse_message_file(payload, policy=compat32):
+    '''Like parse_message, reading the message from the FilePayload as it's parsed.'''
+    with payload.open() as payload_fh:
+        try:
+            text_fh = io.TextIOWrapper(payload_fh, encoding='utf-8', newline='')
+            return Parser(policy=policy).parse(text_fh)
+        except UnicodeDecodeError:
+            pass
+    with payload.open() as payload_fh:
+        return BytesParser(policy=policy).parse(payload_fh)
+
+
+def parse_headers(data, policy=compat32):
+    '''Parse only the header section of a raw message, like parse_message.'''
+    header_bytes = bytes(split_headers(data)[0])
+    try:
+        header_text = header_bytes.decode('utf-8')
+    except UnicodeDecodeError:
+        return BytesHeaderParser(policy=policy).parsebytes(header_bytes)
+    return HeaderParser(policy=policy).parsestr(header_text)
+
+
+def split_headers(data):
+    '''
+    Split a raw message in the header section and the body, without copying
+    the body.
+    '''
+    data = memoryview(data)
+    if data[:1] in (b'\n', b'\r'):
+        # No headers
+        return data[:0], data[2:] if data[:2] == b'\r\n' else data[1:]
+    header_end = HEADER_END_RE.search(data)
+    if header_end is None:
+        return data, data[len(data):]
+    return data[:header_end.start()], data[header_end.end():]
+
+
+def read_header_bytes(payload_fh):
+    '''
+    Read from the file until the end of the headers. Might return some of the
+    body too, which parse_headers ignores.
+    '''
+    data = b''
+    while True:
+        chunk = payload_fh.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return data
+        # Include the tail of the previous chunk in case the separator is split
+        search_start = max(0, len(data) - 3)
+        data += chunk
+        if data[:1] in (b'\n', b'\r') or HEADER_END_RE.search(data, search_start):
+            return data
+
+
+def remove_file_payload(data):
+    if isinstance(data, FilePayload):
+        try:
+            os.unlink(data.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,167 @@
+'''
+In-process metrics, exposed in the Prometheus text format.
+
+Metrics are collected from the log events, so everything that is logged is
+also counted.
+'''
+
+import http.server
+import os
+import socketserver
+import threading
+
+from .breaker import STATES
+from .log import before_log, get_log_writer
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s histogram' % self.name,
+        ]
+        for upper_bound, count in zip(self.buckets, self.counts):
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, upper_bound, count))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append('%s_sum %f' % (self.name, self.sum))
+        lines.append('%s_count %d' % (self.name, self.count))
+        return lines
+
+
+class Metrics:
+    '''
+    Counts log events by action, and keeps histograms of the timings logged
+    for handled messages.
+    '''
+
+    def __init__(self, task_queue, breaker=None):
+        self.task_queue = task_queue
+        self.breaker = breaker
+        self.lock = threading.Lock()
+        self.actions = {}
+        self.histograms = {
+            'queue_wait_ms': Histogram('laim_queue_wait_seconds',
+                'Time messages spent waiting in the queue.'),
+            'parse_ms': Histogram('laim_parse_duration_seconds',
+                'Time spent parsing messages before they are handled.'),
+            'handler_ms': Histogram('laim_handler_duration_seconds',
+                'Time spent in the handler.'),
+            'duration_ms': Histogram('laim_handle_duration_seconds',
+                'Total time spent parsing, handling and logging messages.'),
+            'sink_ms': Histogram('laim_sink_duration_seconds',
+                'Time spent delivering messages to sinks.'),
+        }
+        before_log.connect(self.on_log)
+
+
+    def on_log(self, sender, log_data): # pylint: disable=unused-argument
+        action = log_data.get('action')
+        with self.lock:
+            self.actions[action] = self.actions.get(action, 0) + 1
+            if action not in ('handle-message', 'handle-message-error'):
+                return
+
+            for key, histogram in self.histograms.items():
+                value = log_data.get(key)
+                if value is not None:
+                    histogram.observe(value/1000)
+
+
+    def render(self):
+        lines = [
+            '# HELP laim_events_total Number of logged events, by action.',
+            '# TYPE laim_events_total counter',
+        ]
+        with self.lock:
+            for action, count in sorted(self.actions.items()):
+                lines.append('laim_events_total{action="%s"} %d' % (action, count))
+            for histogram in self.histograms.values():
+                lines.extend(histogram.render())
+
+        lines.extend([
+            '# HELP laim_queue_size Number of messages waiting to be handled.',
+            '# TYPE laim_queue_size gauge',
+            'laim_queue_size %d' % self.task_queue.qsize(),
+            '# HELP laim_queue_bytes Total size of the messages waiting to be handled.',
+            '# TYPE laim_queue_bytes gauge',
+            'laim_queue_bytes %d' % getattr(self.task_queue, 'queued_bytes', 0),
+            '# HELP laim_log_dropped_total Number of log lines dropped since the log sink '
+                'could not keep up.',
+            '# TYPE laim_log_dropped_total counter',
+            'laim_log_dropped_total %d' % get_log_writer().dropped,
+        ])
+        if self.breaker is not None:
+            lines.extend([
+                '# HELP laim_circuit_breaker_state Whether the circuit breaker is in the '
+                    'given state.',
+                '# TYPE laim_circuit_breaker_state gauge',
+            ])
+            for state in STATES:
+                lines.append('laim_circuit_breaker_state{state="%s"} %d' % (
+                    state, self.breaker.state == state))
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(metrics, address):
+    '''
+    Serve the metrics over HTTP on a background thread. address is either a
+    (host, port) tuple or the path to a Unix socket.
+    '''
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self): # pylint: disable=invalid-name
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            # Scrapes are not worth logging
+            pass
+
+
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = ThreadingUnixHTTPServer(address, MetricsRequestHandler)
+    else:
+        server = ThreadingHTTPServer(address, MetricsRequestHandler)
+
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name='Laim metrics',
+        daemon=True,
+    )
+    thread.start()
+    return server
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''Like http.server.ThreadingHTTPServer, which requires Python 3.7.'''
+    daemon_threads = True
@@ -0,0 +1,62 @@
+'''
+Keeping messages with the same ordering key in order while several workers
+handle messages concurrently.
+'''
+
+import threading
+from collections import deque
+
+
+class KeyOrdering:
+    '''
+    Only one worker at a time handles messages with a given ordering key. A
+    worker that gets a message whose key is already being handled leaves it
+    for the worker handling that key, which handles it once it's done with
+    the messages before it.
+
+    At most max_pending messages are left for other workers at a time, to
+    not take messages off the queue faster than they're handled, which would
+    get around the limits of the queue.
+    '''
+
+    def __init__(self, ordering_key, max_pending):
+        self.ordering_key = ordering_key
+        self.max_pending = max_pending
+        self.pending_by_key = {}
+        self.pending_count = 0
+        self._cond = threading.Condition()
+
+
+    def wait_for_room(self):
+        '''Wait until there's room for another message to be left pending.'''
+        with self._cond:
+            while self.pending_count >= self.max_pending:
+                self._cond.wait()
+
+
+    def handle(self, task_args, handle_task):
+        '''
+        Call handle_task with the task, and then with the tasks with the same
+        key that were left for this worker in the meantime, unless another
+        worker is already handling tasks with the key.
+        '''
+        key = self.ordering_key(task_args)
+        with self._cond:
+            pending = self.pending_by_key.get(key)
+            if pending is not None:
+                pending.append(task_args)
+                self.pending_count += 1
+                return
+            self.pending_by_key[key] = deque()
+
+        while task_args is not None:
+            handle_task(task_args)
+            with self._cond:
+                pending = self.pending_by_key[key]
+                if pending:
+                    task_args = pending.popleft()
+                    self.pending_count -= 1
+                    self._cond.notify_all()
+                else:
+                    del self.pending_by_key[key]
+                    task_args = None
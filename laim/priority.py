@@ -0,0 +1,189 @@
+'''
+Priorities of queued messages, to handle urgent mail like security alerts
+before a backlog of routine reports.
+
+Priorities go from 1 (highest) to 5 (lowest) like the X-Priority header.
+Messages get the priority of the first matching rule, or the priority
+requested by the X-Priority, Importance or Priority header if no rule matched,
+and are otherwise of normal priority.
+'''
+
+import heapq
+import itertools
+import math
+import re
+import time
+from collections import namedtuple
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+
+from .message import FilePayload, read_header_bytes, split_headers
+from .spool import SpoolQueue
+from .taskqueue import TaskQueue
+
+
+# A rule matches if all of its given patterns match. sender and subject are
+# regexes searched for in the sender and decoded subject, recipient matches if
+# it's found in any of the recipients, and headers is a dict of header names to
+# regexes searched for in the header.
+PriorityRule = namedtuple('PriorityRule', 'priority sender recipient subject headers')
+PriorityRule.__new__.__defaults__ = (None, None, None, None)
+
+HIGHEST_PRIORITY = 1
+NORMAL_PRIORITY = 3
+LOWEST_PRIORITY = 5
+
+X_PRIORITY_RE = re.compile(r'\s*([1-5])')
+
+# Values of the Importance and Priority headers
+HEADER_PRIORITIES = {
+    'high': 1,
+    'urgent': 1,
+    'normal': 3,
+    'low': 5,
+    'non-urgent': 5,
+}
+
+
+class Prioritizer:
+    '''
+    Classifies messages as they're accepted. Only the envelope is looked at if
+    that's enough to find a matching rule, otherwise only the headers of the
+    message are parsed.
+    '''
+
+    def __init__(self, rules=()):
+        self.rules = [compile_rule(rule) for rule in rules]
+
+
+    def classify(self, sender, recipients, data):
+        headers = None
+        for rule in self.rules:
+            if rule.sender is not None and not rule.sender.search(sender or ''):
+                continue
+            if rule.recipient is not None and not any(
+                    rule.recipient.search(recipient) for recipient in recipients):
+                continue
+            if rule.subject is not None or rule.headers:
+                if headers is None:
+                    headers = get_headers(data)
+                if not rule_matches_headers(rule, headers):
+                    continue
+            return rule.priority
+
+        if headers is None:
+            headers = get_headers(data)
+        return get_requested_priority(headers)
+
+
+def compile_rule(rule):
+    if not HIGHEST_PRIORITY <= rule.priority <= LOWEST_PRIORITY:
+        raise ValueError('Priority must be between %d and %d: %r' % (
+            HIGHEST_PRIORITY, LOWEST_PRIORITY, rule))
+    return rule._replace(
+        sender=compile_pattern(rule.sender),
+        recipient=compile_pattern(rule.recipient),
+        subject=compile_pattern(rule.subject),
+        headers={name: compile_pattern(pattern)
+            for name, pattern in (rule.headers or {}).items()},
+    )
+
+
+def compile_pattern(pattern):
+    if pattern is None:
+        return None
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def rule_matches_headers(rule, headers):
+    if rule.subject is not None:
+        subject = get_decoded_subject(headers)
+        if subject is None or not rule.subject.search(subject):
+            return False
+    for name, pattern in rule.headers.items():
+        value = headers.get(name)
+        if value is None or not pattern.search(str(value)):
+            return False
+    return True
+
+
+def get_decoded_subject(headers):
+    subject = headers.get('subject')
+    if subject is None:
+        return None
+    try:
+        return str(make_header(decode_header(str(subject))))
+    except (LookupError, UnicodeError):
+        # Unknown charset, match against the raw subject
+        return str(subject)
+
+
+def get_requested_priority(headers):
+    x_priority = headers.get('x-priority')
+    if x_priority is not None:
+        match = X_PRIORITY_RE.match(str(x_priority))
+        if match:
+            return int(match.group(1))
+    for name in ('importance', 'priority'):
+        value = headers.get(name)
+        if value is not None:
+            priority = HEADER_PRIORITIES.get(str(value).strip().lower())
+            if priority is not None:
+                return priority
+    return NORMAL_PRIORITY
+
+
+def get_headers(data):
+    if isinstance(data, FilePayload):
+        with data.open() as payload_fh:
+            header_bytes, _ = split_headers(read_header_bytes(payload_fh))
+    else:
+        header_bytes, _ = split_headers(data)
+    return BytesHeaderParser().parsebytes(bytes(header_bytes))
+
+
+class PriorityQueueMixin:
+    '''
+    Orders a TaskQueue by priority, with aging so that low priority messages
+    are not starved: each priority level below the highest counts as having
+    been queued aging seconds later. A low priority message is thus handled
+    after higher priority messages that arrive up to a few times aging seconds
+    after it, but before anything that arrives later than that. Messages of the
+    same priority are handled in the order they arrived.
+    '''
+
+    def __init__(self, *args, aging=60, **kwargs):
+        self.aging = aging
+        super().__init__(*args, **kwargs)
+
+
+    def _init(self, maxsize): # pylint: disable=unused-argument
+        self.queue = []
+        self._sequence = itertools.count()
+
+
+    def _push(self, item):
+        heapq.heappush(self.queue, (self._get_rank(item), next(self._sequence), item))
+
+
+    def _pop(self):
+        return heapq.heappop(self.queue)[2]
+
+
+    def _get_rank(self, task_args):
+        if task_args is None:
+            # The stop sentinel goes last, workers stop once the queue is drained
+            return math.inf
+        enqueued_at = task_args.enqueued_at
+        if enqueued_at is None:
+            enqueued_at = time.time()
+        priority = task_args.priority or NORMAL_PRIORITY
+        return enqueued_at + (priority - HIGHEST_PRIORITY)*self.aging
+
+
+class PriorityTaskQueue(PriorityQueueMixin, TaskQueue):
+    pass
+
+
+class PrioritySpoolQueue(PriorityQueueMixin, SpoolQueue):
+    pass
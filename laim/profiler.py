@@ -0,0 +1,95 @@
+'''
+Sampling profiler that can be triggered in a running daemon.
+'''
+
+import collections
+import sys
+import threading
+import time
+
+from .log import log
+
+
+class SamplingProfiler:
+    '''
+    Samples the stacks of all other threads at a fixed interval for a while,
+    and logs the most common stacks of each thread when done. Only one
+    profiling run is active at a time.
+    '''
+
+    def __init__(self, duration=10, interval=0.005, top=10):
+        self.duration = duration
+        self.interval = interval
+        self.top = top
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    def start(self):
+        '''Start profiling in the background. Returns False if already running.'''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(
+                target=self._run,
+                name='Laim profiler',
+                daemon=True,
+            )
+            self._thread.start()
+            return True
+
+
+    def join(self):
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+    def _run(self):
+        log({
+            'action': 'profile-started',
+            'duration': self.duration,
+            'interval': self.interval,
+        }, sender=self)
+        start_time = time.time()
+        samples = self.sample()
+        for thread_name, stacks in sorted(samples.items()):
+            total = sum(stacks.values())
+            for stack, count in stacks.most_common(self.top):
+                log({
+                    'action': 'profile-stack',
+                    'thread': thread_name,
+                    'samples': count,
+                    'share': count/total,
+                    'stack': stack,
+                }, sender=self)
+        log({'action': 'profile-done'}, start_time, sender=self)
+
+
+    def sample(self):
+        '''
+        Returns a Counter of stacks per thread name, where each stack is in the
+        folded format used by flame graph tools, outermost frame first.
+        '''
+        own_id = threading.get_ident()
+        samples = collections.defaultdict(collections.Counter)
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items(): # pylint: disable=protected-access
+                if thread_id == own_id:
+                    continue
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                samples[thread_name][fold_stack(frame)] += 1
+            time.sleep(self.interval)
+        return samples
+
+
+def fold_stack(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append('%s:%s:%d' % (code.co_filename, code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
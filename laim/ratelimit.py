@@ -0,0 +1,77 @@
+'''
+Token bucket rate limiting of incoming messages, to keep a single noisy sender
+from filling up the queue for everyone else.
+'''
+
+import time
+from collections import namedtuple
+
+
+RateLimit = namedtuple('RateLimit', 'per_minute burst')
+
+# Buckets are pruned once there's more than this many of them
+MAX_BUCKETS = 10000
+
+
+class RateLimiter:
+    '''
+    Keeps a token bucket per key, where a key is a kind of limit ('sender',
+    'recipient' or 'client') and a value. Each bucket holds up to burst
+    tokens, and is refilled at per_minute tokens per minute.
+
+    Not thread safe, it's intended to be used from the SMTP event loop.
+    '''
+
+    def __init__(self, limits, clock=time.monotonic):
+        for kind, limit in limits.items():
+            if limit.per_minute <= 0 or limit.burst < 1:
+                raise ValueError('Invalid rate limit for %s: %r' % (kind, limit))
+        self.limits = limits
+        self.clock = clock
+        # (kind, value) -> [tokens, last updated]
+        self._buckets = {}
+
+
+    def acquire(self, keys):
+        '''
+        Take a token from the bucket of each of the given (kind, value) keys.
+        Tokens are only taken if all buckets have one to spare, otherwise the
+        first key that is over its limit is returned.
+        '''
+        now = self.clock()
+        buckets = []
+        for key in keys:
+            limit = self.limits.get(key[0])
+            if limit is None:
+                continue
+            bucket = self._get_bucket(key, limit, now)
+            if bucket[0] < 1:
+                return key
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket[0] -= 1
+
+        if len(self._buckets) > MAX_BUCKETS:
+            self._prune(now)
+
+        return None
+
+
+    def _get_bucket(self, key, limit, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [limit.burst, now]
+        else:
+            refill = (now - bucket[1]) * limit.per_minute / 60
+            bucket[0] = min(limit.burst, bucket[0] + refill)
+            bucket[1] = now
+        return bucket
+
+
+    def _prune(self, now):
+        '''Remove buckets that have been refilled, they're the same as new buckets.'''
+        for key, (tokens, updated) in list(self._buckets.items()):
+            limit = self.limits[key[0]]
+            if tokens + (now - updated) * limit.per_minute / 60 >= limit.burst:
+                del self._buckets[key]
@@ -0,0 +1,178 @@
+'''
+Retrying messages the handler failed to handle, and setting aside messages
+that kept failing.
+
+Failed messages wait in a heap ordered by when they're due, which the workers
+check before taking a message from the queue. Messages waiting to be retried
+thus don't hold up the messages queued behind them.
+
+Messages that failed on every attempt are written to the dead-letter
+directory in the same format as the maildrop: a JSON header line with the
+envelope, followed by the raw message. Moving the files to the maildrop
+directory makes laim pick them up again.
+'''
+
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+from .message import READ_CHUNK_SIZE, FilePayload, get_payload_size
+
+
+class RetryScheduler: # pylint: disable=too-many-instance-attributes
+    '''
+    Holds failed messages until they're due to be retried, with exponential
+    backoff between attempts. At most max_retrying messages are held at once,
+    and their total size is kept in retrying_bytes to count them toward the
+    byte budget of the queue.
+    '''
+
+    def __init__(self, max_attempts, base_delay=1, max_delay=300, max_retrying=1000):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retrying = max_retrying
+        self.retrying_bytes = 0
+        self._lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count()
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+
+    def schedule(self, task_args):
+        '''
+        Schedule a retry of a message that just failed. Returns the delay in
+        seconds until it's retried, or None if it has no attempts left or too
+        many messages are already waiting to be retried.
+        '''
+        attempts = task_args.attempts + 1
+        if attempts >= self.max_attempts:
+            return None
+        delay = get_backoff(attempts, self.base_delay, self.max_delay)
+        return self._push(task_args._replace(attempts=attempts), delay)
+
+
+    def park(self, task_args, delay):
+        '''
+        Hold on to a message that couldn't be handled right now, without
+        counting it as an attempt. Returns the delay, or None if too many
+        messages are already waiting.
+        '''
+        return self._push(task_args, delay)
+
+
+    def _push(self, task_args, delay):
+        with self._lock:
+            if len(self._heap) >= self.max_retrying:
+                return None
+            heapq.heappush(self._heap, (
+                time.monotonic() + delay,
+                next(self._counter),
+                task_args,
+            ))
+            self.retrying_bytes += get_payload_size(task_args.data)
+        return delay
+
+
+    def pop_due(self):
+        '''
+        Returns a message that's due to be retried and None, or None and the
+        seconds until the next message is due. The seconds are None if no
+        messages are waiting.
+        '''
+        with self._lock:
+            if not self._heap:
+                return None, None
+            due_at = self._heap[0][0]
+            now = time.monotonic()
+            if due_at > now:
+                return None, due_at - now
+            task_args = heapq.heappop(self._heap)[2]
+            self.retrying_bytes -= get_payload_size(task_args.data)
+            return task_args, None
+
+
+    def drain(self):
+        '''Remove and return all waiting messages, regardless of when they're due.'''
+        with self._lock:
+            pending = [task_args for _, _, task_args in sorted(self._heap)]
+            self._heap = []
+            self.retrying_bytes = 0
+        return pending
+
+
+def get_backoff(attempts, base_delay, max_delay):
+    '''
+    The delay before the next attempt after the given number of failed
+    attempts, doubling for each attempt up to max_delay. The delay is randomized
+    between half and the full delay, so that messages that failed together
+    don't all retry at the same time.
+    '''
+    delay = min(max_delay, base_delay * 2**(attempts - 1))
+    return random.uniform(delay/2, delay)
+
+
+def create_retry_scheduler(max_attempts, retry_delay, max_retry_delay, max_retrying,
+        circuit_breaker):
+    # Messages are parked with the retries while the circuit breaker is open
+    if max_attempts > 1 or circuit_breaker is not None:
+        return RetryScheduler(max_attempts, retry_delay, max_retry_delay, max_retrying)
+    return None
+
+
+def create_dead_letter_dir(directory, uid=None, gid=None):
+    os.makedirs(directory, mode=0o750, exist_ok=True)
+    if uid is not None:
+        os.chown(directory, uid, gid)
+
+
+def write_dead_letter(directory, task_args, error, error_msg):
+    '''
+    Write the message to the dead-letter directory, returning the filename.
+    Like in the maildrop, the file is written under a temporary name and
+    renamed once it's complete.
+    '''
+    filename = '%017.6f-%d-%s' % (time.time(), os.getpid(), os.urandom(4).hex())
+    tmp_path = os.path.join(directory, '.tmp-' + filename)
+    dead_letter_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+    try:
+        with open(dead_letter_fd, 'wb', closefd=False) as dead_letter_fh:
+            dead_letter_fh.write(json.dumps({
+                'sender': task_args.sender,
+                'recipients': task_args.recipients,
+                'enqueued_at': task_args.enqueued_at,
+                'attempts': task_args.attempts,
+                'error': error,
+                'error_msg': error_msg,
+            }).encode('utf-8') + b'\n')
+            if isinstance(task_args.data, FilePayload):
+                with task_args.data.open() as payload_fh:
+                    copy_bytes(payload_fh, dead_letter_fh, task_args.data.size)
+            else:
+                dead_letter_fh.write(task_args.data)
+        os.fsync(dead_letter_fd)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    finally:
+        os.close(dead_letter_fd)
+    os.rename(tmp_path, os.path.join(directory, filename))
+    return filename
+
+
+def copy_bytes(source_fh, target_fh, size):
+    remaining = size
+    while remaining > 0:
+        chunk = source_fh.read(min(remaining, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        target_fh.write(chunk)
+        remaining -= len(chunk)
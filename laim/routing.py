@@ -0,0 +1,193 @@
+'''
+Routing messages to handler methods or sinks by recipient.
+
+Routes map recipient patterns to targets, and are compiled into dicts on
+startup so that finding the route of a recipient takes a few dict lookups
+regardless of the number of routes. Patterns are, from most to least specific:
+
+- 'root@example.com': The exact address.
+- 'root': The local part at any domain, or without a domain.
+- 'alerts-*@example.com' and 'alerts-*': Local parts starting with the prefix,
+  at the domain or at any domain. The longest matching prefix wins.
+- '@example.com': Any address at the domain.
+- '*': Any recipient not matched by another route.
+
+Addresses are matched case-insensitively.
+'''
+
+
+class RouteError(Exception):
+    def __init__(self, message, failed_recipients=None):
+        super().__init__(message)
+        self.failed_recipients = failed_recipients
+
+
+class Router: # pylint: disable=too-many-instance-attributes
+    '''
+    Splits the recipients of a message by route, and calls the target of each
+    route with only the recipients routed to it.
+
+    A target is either the name of an attribute on the handler, or an object.
+    Targets with a send method, like WebhookSink, are sent the message, other
+    targets are called with the sender, recipients and message like
+    handle_message. Names are resolved when the handler starts, so that they
+    can refer to sinks created after the Laim constructor has run.
+    '''
+
+    def __init__(self, routes, handler):
+        self.handler = handler
+        self.targets = None
+        self._exact = {}
+        self._local_parts = {}
+        # domain, or None for any domain -> {prefix: target}
+        self._prefixes = {}
+        self._max_prefix_length = 0
+        self._domains = {}
+        self._default = None
+        for pattern, target in routes.items():
+            self._add(pattern.lower(), target)
+
+
+    def _add(self, pattern, target):
+        if pattern == '*':
+            self._default = target
+            return
+
+        local_part, at_sign, domain = pattern.rpartition('@')
+        if not at_sign:
+            local_part, domain = pattern, None
+        elif not local_part:
+            self._domains[domain] = target
+            return
+
+        if local_part.endswith('*'):
+            local_part = local_part[:-1]
+            if '*' in local_part:
+                raise ValueError('Only a single trailing wildcard is supported: %s' % pattern)
+            self._prefixes.setdefault(domain, {})[local_part] = target
+            self._max_prefix_length = max(self._max_prefix_length, len(local_part))
+        elif '*' in local_part or (domain is not None and '*' in domain):
+            raise ValueError('Only a single trailing wildcard is supported: %s' % pattern)
+        elif domain is None:
+            self._local_parts[local_part] = target
+        else:
+            self._exact[(local_part, domain)] = target
+
+
+    def lookup(self, recipient):
+        '''Returns the target the recipient is routed to, or None.'''
+        local_part, at_sign, domain = recipient.lower().rpartition('@')
+        if not at_sign:
+            local_part, domain = domain, None
+
+        target = None
+        if domain is not None:
+            target = self._exact.get((local_part, domain))
+        if target is None:
+            target = self._local_parts.get(local_part)
+        if target is None:
+            target = self._lookup_prefix(local_part, domain)
+        if target is None and domain is not None:
+            target = self._domains.get(domain)
+        if target is None:
+            target = self._default
+        return target
+
+
+    def _lookup_prefix(self, local_part, domain):
+        prefix_domains = (None,) if domain is None else (domain, None)
+        for prefix_domain in prefix_domains:
+            prefixes = self._prefixes.get(prefix_domain)
+            if prefixes is None:
+                continue
+            for length in range(min(len(local_part), self._max_prefix_length), -1, -1):
+                target = prefixes.get(local_part[:length])
+                if target is not None:
+                    return target
+        return None
+
+
+    def resolve(self):
+        '''Look up the targets on the handler, raises ValueError for unknown targets.'''
+        targets = {}
+        all_targets = [self._default] if self._default is not None else []
+        all_targets.extend(self._exact.values())
+        all_targets.extend(self._local_parts.values())
+        all_targets.extend(self._domains.values())
+        for prefixes in self._prefixes.values():
+            all_targets.extend(prefixes.values())
+
+        for target in all_targets:
+            if target not in targets:
+                targets[target] = resolve_target(self.handler, target)
+        self.targets = targets
+
+
+    def dispatch(self, sender, recipients, message):
+        '''
+        Call each route with its recipients, returning the details to log. If
+        a single route failed its exception is raised as is, if several failed
+        a RouteError is raised once all routes have been tried. Either way the
+        exception has the recipients of the failed routes as
+        failed_recipients, so that only they are retried.
+        '''
+        if self.targets is None:
+            self.resolve()
+
+        routed = {}
+        unrouted = []
+        for recipient in recipients:
+            target = self.lookup(recipient)
+            if target is None:
+                unrouted.append(recipient)
+            else:
+                routed.setdefault(target, []).append(recipient)
+
+        log_data = {
+            'routes': ','.join(self.targets[target][0] for target in routed),
+        }
+        if unrouted:
+            log_data['unrouted'] = ','.join(unrouted)
+
+        errors = []
+        failed_recipients = []
+        for target, route_recipients in routed.items():
+            name, function = self.targets[target]
+            try:
+                route_data = function(sender, route_recipients, message)
+                if route_data:
+                    log_data.update(route_data)
+            except Exception as ex: # pylint: disable=broad-except
+                errors.append((name, ex))
+                failed_recipients.extend(route_recipients)
+
+        if len(errors) == 1:
+            error = errors[0][1]
+            error.failed_recipients = failed_recipients
+            raise error
+        if errors:
+            raise RouteError('%d of %d routes failed: %s' % (
+                len(errors),
+                len(routed),
+                ', '.join('%s: %s' % (name, ex) for name, ex in errors),
+            ), failed_recipients)
+        return log_data
+
+
+def resolve_target(handler, target):
+    '''Returns the name of the target for logging, and the function to call.'''
+    if isinstance(target, str):
+        name = target
+        target = getattr(handler, target, None)
+        if target is None:
+            raise ValueError('The handler has no route target %r' % name)
+    else:
+        name = getattr(target, 'name', None) or getattr(target, '__name__', None) or \
+            target.__class__.__name__
+
+    send = getattr(target, 'send', None)
+    if send is not None:
+        return name, send
+    if callable(target):
+        return name, target
+    raise ValueError('Route target %r is neither callable nor has a send method' % name)
@@ -0,0 +1,340 @@
+'''
+The SMTP side of laim, admitting messages to the queue the workers read from.
+'''
+
+import asyncio
+import queue
+import socket
+import threading
+import time
+
+from aiosmtpd.smtp import SMTP
+
+from .log import log
+from .message import get_payload_size, remove_file_payload, spill_to_file
+from .spool import SpoolQueue
+from .util import TaskArguments
+from ._version import __version__
+
+
+# Max seconds between checking whether a full queue has space
+ADMISSION_POLL_INTERVAL = 0.05
+
+
+class LaimHandler: # pylint: disable=too-many-instance-attributes
+    def __init__(
+            self,
+            task_queue,
+            spill_threshold=None,
+            spill_dir=None,
+            rate_limiter=None,
+            admission_timeout=0,
+            prioritizer=None,
+            max_queue_bytes=None,
+            retries=None,
+    ):
+        self.task_queue = task_queue
+        self.prioritizer = prioritizer
+        self.max_queue_bytes = max_queue_bytes
+        # Messages waiting to be retried count toward max_queue_bytes too
+        self.retries = retries
+        # Bytes of the messages that are being admitted, but aren't on the
+        # queue yet since they're being persisted. Only changed from the event
+        # loop.
+        self.admitting_bytes = 0
+        self.admission_timeout = admission_timeout
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.rate_limiter = rate_limiter
+
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options): # pylint: disable=invalid-name,unused-argument,too-many-arguments
+        if self.rate_limiter is not None:
+            keys = [('recipient', address)]
+            if not envelope.rcpt_tos:
+                # Only count the sender and client once per message
+                keys.append(('sender', envelope.mail_from))
+                keys.append(('client', session.host_name))
+            limited_key = self.rate_limiter.acquire(keys)
+            if limited_key is not None:
+                log({
+                    'action': 'rate-limited',
+                    'limit': limited_key[0],
+                    'mail_from': envelope.mail_from,
+                    'recipient': address,
+                    'client': session.host_name,
+                }, sender=self)
+                return '451 4.7.1 Rate limit exceeded for %s, try again later' % limited_key[0]
+
+        # Implementing handle_RCPT replaces what aiosmtpd does by default
+        envelope.rcpt_tos.append(address)
+        envelope.rcpt_options.extend(rcpt_options)
+        return '250 OK'
+
+
+    async def handle_DATA(self, server, session, envelope): # pylint: disable=invalid-name,unused-argument,too-many-return-statements
+        start_time = time.time()
+        mail_from = envelope.mail_from
+        data = envelope.content
+        recipients = envelope.rcpt_tos
+        log_data = {
+            'action': 'queued-message',
+            'mail_from': mail_from,
+            'recipients': ','.join(recipients),
+            'msg_size': len(data),
+            'client': session.host_name,
+        }
+        priority = None
+        if self.max_queue_bytes is not None and len(data) > self.max_queue_bytes:
+            # Would never fit, don't have the client try again
+            log_data['action'] = 'message-too-large'
+            log(log_data, start_time, sender=self)
+            return '552 5.3.4 Message too large for the queue'
+        if self.prioritizer is not None:
+            # Classified before the message is spilled, while it's in memory
+            priority = self.prioritizer.classify(mail_from, recipients, data)
+            log_data['priority'] = priority
+        try:
+            # Keep large messages on disk while they're queued. Spooled
+            # messages are read from the spool when handled, thus don't need
+            # to be spilled.
+            if (not isinstance(self.task_queue, SpoolQueue)
+                    and self.spill_threshold is not None
+                    and len(data) > self.spill_threshold):
+                data = await asyncio.get_event_loop().run_in_executor(
+                    None, spill_to_file, data, self.spill_dir)
+                log_data['spilled'] = True
+            task_args = TaskArguments(mail_from, recipients, data, enqueued_at=time.time(),
+                priority=priority)
+            try:
+                await self._admit(task_args, log_data)
+            except (queue.Full, asyncio.CancelledError):
+                # Also when the client gave up waiting and disconnected
+                remove_file_payload(data)
+                raise
+            log(log_data, start_time, sender=self)
+        except queue.Full:
+            log_data['action'] = 'queue-full'
+            log_data['queued_bytes'] = getattr(self.task_queue, 'queued_bytes', None)
+            log(log_data, start_time, sender=self)
+            return '451 4.3.1 Queue full, try again later'
+        except OSError as ex:
+            log_data['action'] = 'spool-error'
+            log_data['error'] = ex.__class__.__name__
+            log_data['error_msg'] = str(ex)
+            log(log_data, start_time, sender=self)
+            return '451 Requested action aborted: local error in processing'
+
+        return '250 OK'
+
+
+    async def _admit(self, task_args, log_data):
+        '''
+        Put the task on the queue, waiting up to admission_timeout for the
+        queue to have space for it without blocking the event loop. Raises
+        queue.Full if the queue is still full by then.
+        '''
+        loop = asyncio.get_event_loop()
+        admission_start = loop.time()
+        deadline = admission_start + self.admission_timeout
+        delay = 0.001
+        size = get_payload_size(task_args.data)
+        while True:
+            try:
+                self._reserve_bytes(size)
+                try:
+                    if isinstance(self.task_queue, SpoolQueue):
+                        # Don't acknowledge the message before it has been persisted
+                        await self.task_queue.put_async(task_args, loop)
+                    else:
+                        self.task_queue.put_nowait(task_args)
+                finally:
+                    self.admitting_bytes -= size
+                log_data['queued_bytes'] = getattr(self.task_queue, 'queued_bytes', None)
+                return
+            except queue.Full:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay*2, ADMISSION_POLL_INTERVAL)
+            finally:
+                log_data['admission_ms'] = (loop.time() - admission_start)*1000
+
+
+    def _reserve_bytes(self, size):
+        '''
+        Count the message as being admitted, raises queue.Full if it doesn't
+        fit in the byte budget. Messages that are put on the queue by other
+        means, like the maildrop or the spool on startup, count toward the
+        budget but aren't held back by it, as do messages waiting to be
+        retried.
+        '''
+        if self.max_queue_bytes is not None:
+            queued_bytes = self.task_queue.queued_bytes + self.admitting_bytes
+            if self.retries is not None:
+                queued_bytes += self.retries.retrying_bytes
+            if queued_bytes + size > self.max_queue_bytes:
+                raise queue.Full
+        self.admitting_bytes += size
+
+
+class LaimController: # pylint: disable=too-many-instance-attributes
+    '''
+    Serves SMTP on the given listening sockets, in addition to binding the
+    port on localhost if bind_port is set, with an event loop on a background
+    thread.
+    '''
+    def __init__(self, privilege_event, handler, port, smtp_kwargs=None, sockets=(),
+            bind_port=True):
+        self.handler = handler
+        self.hostname = 'localhost'
+        self.port = port
+        self.smtp_kwargs = smtp_kwargs
+        self.privilege_event = privilege_event
+        self.sockets = list(sockets)
+        self.bind_port = bind_port
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self._thread = None
+        # The LaimSMTP instances of the open connections, only changed from
+        # the event loop
+        self.sessions = set()
+
+
+    def start(self):
+        '''Start serving, raises if the servers couldn't be created.'''
+        self.server = self.loop.run_until_complete(self._create_servers())
+        self._thread = threading.Thread(target=self._run, name='Laim SMTP', daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        '''Stop serving, cancelling the sessions that are still active.'''
+        self.loop.call_soon_threadsafe(self._cancel_tasks)
+        self._thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+
+    def _cancel_tasks(self):
+        self.loop.stop()
+        # asyncio.all_tasks requires Python 3.7
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        for task in all_tasks(self.loop):
+            task.cancel()
+
+
+    async def _create_servers(self):
+        # The servers only call the factory once a client connects, so create
+        # a session up front to not find out about invalid smtp_kwargs then
+        self.factory()
+        servers = []
+        try:
+            if self.bind_port:
+                servers.append(await self.loop.create_server(self.factory,
+                    host=self.hostname, port=self.port))
+            for sock in self.sockets:
+                if sock.family == socket.AF_UNIX:
+                    server = await self.loop.create_unix_server(self.factory, sock=sock)
+                else:
+                    server = await self.loop.create_server(self.factory, sock=sock)
+                servers.append(server)
+        except Exception:
+            for server in servers:
+                server.close()
+            raise
+        return ServerGroup(servers)
+
+
+    def factory(self):
+        kwargs = {
+            'enable_SMTPUTF8': True,
+            'ident': 'laim %s' % __version__,
+        }
+        if self.smtp_kwargs:
+            kwargs.update(self.smtp_kwargs)
+
+        return LaimSMTP(self, self.handler, **kwargs)
+
+
+    @property
+    def active_sessions(self):
+        return len(self.sessions)
+
+
+    def stop_accepting(self):
+        '''Stop accepting new connections, letting current sessions finish.'''
+        self.loop.call_soon_threadsafe(self.server.close)
+
+
+    def close_sessions(self):
+        '''
+        Close the connections of the sessions that are still active, waiting
+        until they're closed. Messages that weren't admitted yet are rejected
+        by the connection closing, which makes the client try again later.
+        '''
+        asyncio.run_coroutine_threadsafe(self._close_sessions(), self.loop).result()
+
+
+    async def _close_sessions(self):
+        for session in list(self.sessions):
+            session.transport.close()
+        while self.sessions:
+            await asyncio.sleep(0.01)
+
+
+class ServerGroup:
+    '''
+    Several asyncio servers that are closed together, to look like a single
+    server.
+    '''
+    def __init__(self, servers):
+        self.servers = servers
+
+
+    @property
+    def sockets(self):
+        return [sock for server in self.servers for sock in server.sockets]
+
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+
+    async def wait_closed(self):
+        for server in self.servers:
+            await server.wait_closed()
+
+
+class LaimSMTP(SMTP):
+    '''
+    Subclass to make sure no sessions are created before we've dropped
+    privileges, and to count the active sessions.
+    '''
+    def __init__(self, controller, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.controller = controller
+
+
+    def _create_session(self):
+        self.controller.privilege_event.wait()
+        return super()._create_session()
+
+
+    def connection_made(self, transport):
+        self.controller.sessions.add(self)
+        super().connection_made(transport)
+
+
+    def connection_lost(self, error):
+        self.controller.sessions.discard(self)
+        super().connection_lost(error)
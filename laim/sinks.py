@@ -0,0 +1,257 @@
+'''
+Sinks that deliver messages to common destinations, for handlers that don't
+need more than forwarding the message.
+'''
+
+import http.client
+import json
+import queue
+import select
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import unfold
+
+
+# Errors sending a request on a connection the server has closed. The request
+# wasn't received, so it's safe to send again on a new connection. Errors
+# while waiting for the response are not retried, since the server might have
+# acted on the request.
+SEND_ERRORS = (
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+
+class WebhookError(Exception):
+    pass
+
+
+class WebhookSink: # pylint: disable=too-many-instance-attributes
+    '''
+    Posts messages as JSON to a webhook, reusing connections between messages.
+
+    payload is either a function returning the JSON payload for a message, or
+    a template for it where strings are formatted with the fields sender,
+    recipients, subject, body and hostname, like
+    {'text': 'Mail for {recipients}: {subject}'}.
+
+    Up to concurrency requests are made at the same time, both from workers
+    calling send and from send_batch, each on its own pooled connection.
+    Requests are not pipelined on a connection, a connection is only reused
+    once its previous response has been read.
+    '''
+
+    def __init__(
+            self,
+            url,
+            payload,
+            headers=None,
+            name='webhook',
+            concurrency=4,
+            timeout=10,
+    ):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        elif parsed_url.scheme == 'http':
+            self.connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError('Unsupported webhook URL: %s' % url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port
+        self.path = parsed_url.path or '/'
+        if parsed_url.query:
+            self.path += '?' + parsed_url.query
+        self.payload = payload
+        self.headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'laim',
+        }
+        if headers:
+            self.headers.update(headers)
+        self.name = name
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.hostname = socket.gethostname()
+        # Idle connections, most recently used first since they're the least
+        # likely to have been closed by the server
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+
+    def send(self, sender, recipients, message):
+        '''
+        Post the message, returning details to log. Raises WebhookError if the
+        webhook doesn't respond with a 2xx status.
+        '''
+        start_time = time.time()
+        body = json.dumps(self.render(sender, recipients, message)).encode('utf-8')
+        with self._slots:
+            status = self._post(body)
+        return {
+            'sink': self.name,
+            'sink_status': status,
+            'sink_ms': (time.time() - start_time)*1000,
+        }
+
+
+    def send_batch(self, batch):
+        '''
+        Post each QueuedMessage in the batch, with up to concurrency requests in
+        flight at the same time. Raises WebhookError if any of them failed,
+        after all have been tried.
+        '''
+        start_time = time.time()
+        futures = [
+            self._get_executor().submit(self.send, queued.sender, queued.recipients, queued.message)
+            for queued in batch
+        ]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise WebhookError('%d of %d requests to %s failed, first error: %s' % (
+                len(errors), len(batch), self.name, errors[0]))
+        return {
+            'sink': self.name,
+            'sink_requests': len(batch),
+            'sink_ms': (time.time() - start_time)*1000,
+        }
+
+
+    def render(self, sender, recipients, message):
+        if callable(self.payload):
+            return self.payload(sender, recipients, message)
+
+        fields = {
+            'sender': sender,
+            'recipients': ', '.join(recipients),
+            'subject': get_subject(message),
+            'body': get_text_body(message),
+            'hostname': self.hostname,
+        }
+        return render_template(self.payload, fields)
+
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency,
+                    thread_name_prefix='Laim %s' % self.name,
+                )
+            return self._executor
+
+
+    def _post(self, body):
+        connection, reused = self._checkout()
+        try:
+            try:
+                self._send_request(connection, body)
+            except SEND_ERRORS:
+                if not reused:
+                    raise
+                connection.close()
+                connection = self._connect()
+                self._send_request(connection, body)
+            response = connection.getresponse()
+            response_body = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+        if not 200 <= response.status < 300:
+            raise WebhookError('%s responded with %d: %s' % (
+                self.name, response.status, response_body[:200].decode('utf-8', 'replace')))
+        return response.status
+
+
+    def _checkout(self):
+        '''Returns an idle connection that's still open, or a new one, and whether it was reused.'''
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(), False
+            if is_connection_dropped(connection):
+                connection.close()
+                continue
+            return connection, True
+
+
+    def _connect(self):
+        return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+
+    def _send_request(self, connection, body):
+        connection.request('POST', self.path, body=body, headers=self.headers)
+
+
+def render_template(template, fields): # pylint: disable=too-many-return-statements
+    if isinstance(template, str):
+        return template.format_map(fields)
+    if isinstance(template, dict):
+        return {key: render_template(value, fields) for key, value in template.items()}
+    if isinstance(template, list):
+        return [render_template(value, fields) for value in template]
+    return template
+
+
+def get_subject(message):
+    # Laim has already decoded the subject
+    subject = message['Subject']
+    if subject is None:
+        return ''
+    return unfold(str(subject))
+
+
+def get_text_body(message):
+    '''The first text/plain part of the message that's not an attachment.'''
+    for part in message.walk():
+        if part.get_content_type() != 'text/plain':
+            continue
+        if part.get_content_disposition() == 'attachment':
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        charset = part.get_content_charset() or 'utf-8'
+        try:
+            return payload.decode(charset, 'replace')
+        except LookupError:
+            return payload.decode('utf-8', 'replace')
+    return ''
+
+
+def is_connection_dropped(connection):
+    '''
+    Whether the server closed an idle connection. Idle connections have
+    nothing to read unless they've been closed.
+    '''
+    if connection.sock is None:
+        return True
+    poller = select.poll()
+    poller.register(connection.sock, select.POLLIN)
+    return bool(poller.poll(0))
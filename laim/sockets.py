@@ -0,0 +1,82 @@
+'''
+Listening sockets, either passed from systemd or bound by laim itself.
+'''
+
+import os
+import socket
+import stat
+
+
+# The first file descriptor passed by systemd, see sd_listen_fds(3)
+SD_LISTEN_FDS_START = 3
+
+
+def get_systemd_sockets(environ=None):
+    '''
+    Returns the sockets passed by systemd through socket activation, or an
+    empty list if the process was not socket activated. The environment
+    variables are unset so that they're not inherited by child processes.
+    '''
+    if environ is None:
+        environ = os.environ
+    listen_pid = environ.pop('LISTEN_PID', None)
+    listen_fds = environ.pop('LISTEN_FDS', None)
+    environ.pop('LISTEN_FDNAMES', None)
+    if listen_pid is None or listen_fds is None:
+        return []
+
+    if int(listen_pid) != os.getpid():
+        return []
+
+    sockets = []
+    for sock_fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + int(listen_fds)):
+        os.set_inheritable(sock_fd, False)
+        sock = socket_from_fd(sock_fd)
+        sock.setblocking(False)
+        sockets.append(sock)
+    return sockets
+
+
+def socket_from_fd(sock_fd):
+    '''
+    Wrap an inherited socket file descriptor. Python only detects the family
+    and type of the socket itself from 3.7, so look them up explicitly.
+    '''
+    probe = socket.socket(fileno=sock_fd)
+    try:
+        family = probe.getsockopt(socket.SOL_SOCKET, socket.SO_DOMAIN)
+        sock_type = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    finally:
+        probe.detach()
+    return socket.socket(family, sock_type, fileno=sock_fd)
+
+
+def bind_unix_socket(path, mode=0o666):
+    '''
+    Bind a listening Unix socket at path, replacing any stale socket left from
+    a previous run. Anyone can connect by default, like they can to the TCP
+    port on localhost.
+    '''
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen(100)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def describe_socket(sock):
+    address = sock.getsockname()
+    if sock.family == socket.AF_UNIX:
+        return address
+    return '%s:%d' % address[:2]
@@ -0,0 +1,313 @@
+'''
+Durable spool for messages that have been accepted but not yet handled.
+
+Each message is stored as a file in a maildir-like directory. Files are written
+to tmp/, and moved to new/ once they have been fsynced, and deleted from new/
+when the handler is done with them. Anything left in new/ on startup was
+accepted but never handled, and is queued again.
+
+Queued messages are read from the spool file when handled, so the size of the
+messages in the queue doesn't affect memory usage.
+'''
+
+import asyncio
+import functools
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from .message import FilePayload
+from .taskqueue import TaskQueue
+from .util import TaskArguments
+
+
+SpoolEntry = namedtuple('SpoolEntry', 'spool_id size arrival_time sender recipients')
+
+
+class SpoolQueue(TaskQueue): # pylint: disable=too-many-instance-attributes
+    '''
+    A TaskQueue that persists items to a spool directory before they're made
+    available to consumers.
+
+    Writers that arrive while an fsync is in progress are committed together
+    in the next batch, which keeps the latency of accepting a message low
+    when lots of messages arrive at once.
+    '''
+
+    def __init__(self, directory, maxsize=0, replay=True):
+        super().__init__(maxsize)
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, 'tmp')
+        self.new_dir = os.path.join(directory, 'new')
+        for path in (self.directory, self.tmp_dir, self.new_dir):
+            os.makedirs(path, mode=0o750, exist_ok=True)
+
+        self._counter = itertools.count()
+        self._reserved = 0
+        self._commit_lock = threading.Lock()
+        self._commit_cond = threading.Condition(self._commit_lock)
+        self._uncommitted = []
+        self._committer = threading.Thread(
+            target=self._run_committer,
+            name='Laim spool committer',
+            daemon=True,
+        )
+        self._committer.start()
+
+        self.replayed = self._replay() if replay else 0
+
+
+    def chown(self, uid, gid):
+        for path in (self.directory, self.tmp_dir, self.new_dir):
+            os.chown(path, uid, gid)
+        for filename in os.listdir(self.new_dir):
+            os.chown(os.path.join(self.new_dir, filename), uid, gid)
+
+
+    def put(self, item, block=True, timeout=None):
+        # The stop sentinel shouldn't survive restarts, and spooled items that
+        # are put back on the queue are already persisted
+        if item is None or item.spool_id is not None:
+            super().put(item, block, timeout)
+            return
+
+        self._reserve(block, timeout)
+        done = threading.Event()
+        errors = []
+        def on_commit(error):
+            if error is not None:
+                errors.append(error)
+            done.set()
+        try:
+            spool_id = self._write(item, on_commit)
+        except Exception:
+            self._release()
+            raise
+        done.wait()
+        if errors:
+            self._release()
+            raise errors[0]
+        self._publish(self._spooled_task(item, spool_id))
+
+
+    async def put_async(self, item, loop):
+        '''
+        Like put_nowait(), but waits for the item to be persisted without
+        blocking the event loop.
+        '''
+        self._reserve(block=False)
+        future = loop.create_future()
+        def on_commit(error):
+            try:
+                loop.call_soon_threadsafe(set_future_result, future, error)
+            except RuntimeError:
+                # The loop was closed while committing, keep the committer
+                # running for other writers
+                pass
+        try:
+            spool_id = self._write(item, on_commit)
+        except Exception:
+            self._release()
+            raise
+        # Once written the item is committed whether or not the caller is
+        # cancelled while waiting, so it's published or its slot released
+        # regardless
+        future.add_done_callback(functools.partial(self._on_commit_done, item, spool_id))
+        await asyncio.shield(future)
+
+
+    def _on_commit_done(self, item, spool_id, future):
+        if future.exception() is None:
+            self._publish(self._spooled_task(item, spool_id))
+        else:
+            self._release()
+
+
+    def ack(self, task_args):
+        '''Remove a handled item from the spool.'''
+        try:
+            os.unlink(os.path.join(self.new_dir, task_args.spool_id))
+        except FileNotFoundError:
+            pass
+
+
+    def _spooled_task(self, item, spool_id):
+        path = os.path.join(self.new_dir, spool_id)
+        data_size = len(item.data)
+        payload = FilePayload(path, os.path.getsize(path) - data_size, data_size)
+        return item._replace(data=payload, spool_id=spool_id)
+
+
+    def _slots_used(self):
+        # Count items being persisted to not accept more than maxsize, but not
+        # in qsize() since consumers can't get them yet
+        return len(self.queue) + self._reserved
+
+
+    def _reserve(self, block=True, timeout=None):
+        '''Claim a slot in the queue for an item that is being persisted.'''
+        with self.not_full:
+            if self.maxsize > 0:
+                if not block:
+                    if self._slots_used() >= self.maxsize:
+                        raise queue.Full
+                elif timeout is None:
+                    while self._slots_used() >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    deadline = time.monotonic() + timeout
+                    while self._slots_used() >= self.maxsize:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise queue.Full
+                        self.not_full.wait(remaining)
+            self._reserved += 1
+
+
+    def _release(self):
+        with self.not_full:
+            self._reserved -= 1
+            self.not_full.notify()
+
+
+    def _publish(self, item):
+        with self.mutex:
+            self._reserved -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+    def _write(self, item, on_commit):
+        spool_id = '%017.6f-%d-%d' % (time.time(), os.getpid(), next(self._counter))
+        tmp_path = os.path.join(self.tmp_dir, spool_id)
+        spool_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+        try:
+            with open(spool_fd, 'wb', closefd=False) as spool_fh:
+                spool_fh.write(serialize_task(item))
+        except Exception:
+            os.close(spool_fd)
+            os.unlink(tmp_path)
+            raise
+
+        with self._commit_cond:
+            self._uncommitted.append((spool_fd, spool_id, on_commit))
+            self._commit_cond.notify()
+
+        return spool_id
+
+
+    def _run_committer(self):
+        while True:
+            with self._commit_cond:
+                while not self._uncommitted:
+                    self._commit_cond.wait()
+                batch = self._uncommitted
+                self._uncommitted = []
+
+            error = None
+            try:
+                self._commit(batch)
+            except OSError as ex:
+                error = ex
+
+            for _, _, on_commit in batch:
+                on_commit(error)
+
+
+    def _commit(self, batch):
+        try:
+            for spool_fd, _, _ in batch:
+                os.fsync(spool_fd)
+        finally:
+            for spool_fd, _, _ in batch:
+                os.close(spool_fd)
+
+        for _, spool_id, _ in batch:
+            os.rename(
+                os.path.join(self.tmp_dir, spool_id),
+                os.path.join(self.new_dir, spool_id),
+            )
+        fsync_directory(self.new_dir)
+
+
+    def _replay(self):
+        # Files in tmp/ were never acknowledged to the client
+        for filename in os.listdir(self.tmp_dir):
+            os.unlink(os.path.join(self.tmp_dir, filename))
+
+        count = 0
+        with self.mutex:
+            for spool_id in sorted(os.listdir(self.new_dir)):
+                task_args = read_spooled_task(os.path.join(self.new_dir, spool_id))
+                # Bypasses maxsize, everything here has already been accepted
+                self._put(task_args)
+                self.unfinished_tasks += 1
+                count += 1
+            self.not_empty.notify(count)
+        return count
+
+
+def serialize_task(task_args):
+    header = json.dumps({
+        'sender': task_args.sender,
+        'recipients': task_args.recipients,
+        'enqueued_at': task_args.enqueued_at,
+        'priority': task_args.priority,
+    })
+    return header.encode('utf-8') + b'\n' + task_args.data
+
+
+def read_spooled_task(path):
+    with open(path, 'rb') as spool_fh:
+        header_line = spool_fh.readline()
+        size = os.fstat(spool_fh.fileno()).st_size
+    envelope = json.loads(header_line.decode('utf-8'))
+    payload = FilePayload(path, len(header_line), size - len(header_line))
+    return TaskArguments(envelope['sender'], envelope['recipients'], payload,
+        os.path.basename(path), enqueued_at=envelope.get('enqueued_at'),
+        priority=envelope.get('priority'))
+
+
+def set_future_result(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+def fsync_directory(path):
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def list_spool(directory):
+    new_dir = os.path.join(directory, 'new')
+    entries = []
+    for spool_id in sorted(os.listdir(new_dir)):
+        path = os.path.join(new_dir, spool_id)
+        try:
+            with open(path, 'rb') as spool_fh:
+                header_line = spool_fh.readline()
+                stat = os.fstat(spool_fh.fileno())
+        except FileNotFoundError:
+            # Handled since we listed the directory
+            continue
+        header = json.loads(header_line.decode('utf-8'))
+        entries.append(SpoolEntry(
+            spool_id,
+            stat.st_size - len(header_line),
+            stat.st_mtime,
+            header['sender'],
+            header['recipients'],
+        ))
+    return entries
@@ -0,0 +1,42 @@
+'''
+The queue between the SMTP listener and the workers.
+'''
+
+import queue
+
+from .message import get_payload_size
+
+
+class TaskQueue(queue.Queue):
+    '''
+    A queue.Queue of TaskArguments that keeps track of the total size of the
+    queued messages in queued_bytes, whichever way they got on the queue.
+
+    Subclasses that store the items differently override _push and _pop
+    instead of _put and _get.
+    '''
+
+    def __init__(self, maxsize=0):
+        self.queued_bytes = 0
+        super().__init__(maxsize)
+
+
+    def _put(self, item):
+        if item is not None:
+            self.queued_bytes += get_payload_size(item.data)
+        self._push(item)
+
+
+    def _get(self):
+        item = self._pop()
+        if item is not None:
+            self.queued_bytes -= get_payload_size(item.data)
+        return item
+
+
+    def _push(self, item):
+        self.queue.append(item)
+
+
+    def _pop(self):
+        return self.queue.popleft()
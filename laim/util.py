@@ -1,6 +1,21 @@
 import os
 import pwd
 import re
+from collections import namedtuple
+
+
+# spool_id is only set when the queue is backed by a spool, repeats is the
+# number of suppressed duplicates the message represents, enqueued_at is the
+# time the message was put on the queue, attempts is the number of times the
+# handler has failed to handle it, and priority is only set when messages are
+# prioritized
+TaskArguments = namedtuple('TaskArguments',
+    'sender recipients data spool_id repeats enqueued_at attempts priority')
+# Like the defaults argument to namedtuple, which requires Python 3.7
+TaskArguments.__new__.__defaults__ = (None, 0, None, 0, None)
+
+# A parsed message as given to handle_messages
+QueuedMessage = namedtuple('QueuedMessage', 'sender recipients message')
 
 
 def drop_privileges(user):
@@ -13,6 +28,18 @@ def drop_privileges(user):
     os.setuid(pwd_details.pw_uid)
 
 
+def get_owner(user):
+    '''
+    The uid and gid to give files created before dropping privileges to. Both
+    are None when not running as root, since the files are then already owned
+    by the user laim runs as.
+    '''
+    if os.geteuid() != 0:
+        return None, None
+    pwd_details = pwd.getpwnam(user)
+    return (pwd_details.pw_uid, pwd_details.pw_gid)
+
+
 def unfold(folded):
     '''Helper to unfold headers'''
     if folded is None:
@@ -1,9 +1,19 @@
+import asyncio
+import os
+import smtplib
+import socket
+import sys
+import threading
+import time
+from email.message import Message
 from unittest import mock
 
 import pytest
 
-from laim import Laim
-from laim.laim import TaskArguments
+from laim import CircuitBreaker, Laim, before_log
+from laim.handoff import receive_sockets
+from laim.util import TaskArguments
+from laim.message import spill_to_file
 
 pytestmark = pytest.mark.integration
 
@@ -38,3 +48,555 @@ def test_crashing_handler(temp_config):
 
     # the worker thread shouldn't crash
     assert handler.stop_event.is_set()
+
+
+def test_multiple_workers_preserve_order_per_key(temp_config):
+    handled = []
+    lock = threading.Lock()
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            # Make the first message for each sender slow to give the other
+            # workers a chance to pick up later messages from the same sender
+            if message.get_payload() == '0':
+                time.sleep(0.1)
+            with lock:
+                handled.append((sender, message.get_payload()))
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(
+                config_file=temp_config,
+                num_workers=3,
+                ordering_key=lambda task: task.sender,
+            )
+
+    for i in range(4):
+        for sender in ('foo', 'bar'):
+            handler.queue.put(TaskArguments(sender, [], str(i).encode('utf-8')))
+
+    workers = [threading.Thread(target=handler._start_worker) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    handler.stop()
+    for worker in workers:
+        worker.join()
+
+    assert len(handled) == 8
+    for sender in ('foo', 'bar'):
+        payloads = [payload for (s, payload) in handled if s == sender]
+        assert payloads == ['0', '1', '2', '3']
+    assert handler.ordering.pending_by_key == {}
+
+
+def test_tasks_waiting_for_their_key_are_bounded(temp_config):
+    handled = []
+    max_pending = 0
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            nonlocal max_pending
+            time.sleep(0.02)
+            max_pending = max(max_pending, self.ordering.pending_count)
+            handled.append(message.get_payload())
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(
+                config_file=temp_config,
+                num_workers=2,
+                ordering_key=lambda task: task.sender,
+            )
+
+    for i in range(8):
+        handler.queue.put(TaskArguments('foo', [], str(i).encode('utf-8')))
+
+    workers = [threading.Thread(target=handler._start_worker) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    handler.stop()
+    for worker in workers:
+        worker.join()
+
+    assert handled == [str(i) for i in range(8)]
+    assert max_pending == 2
+    assert handler.ordering.pending_count == 0
+
+
+def test_async_handler_runs_concurrently(temp_config):
+    in_flight = 0
+    max_in_flight = 0
+    handled = []
+
+    class Handler(Laim):
+        async def handle_message(self, sender, recipients, message):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+            handled.append(message.get_payload())
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config, max_concurrency=3)
+
+    assert handler.is_async
+
+    for i in range(7):
+        handler.queue.put(TaskArguments('foo', [], str(i).encode('utf-8')))
+    handler.stop()
+    handler._start_async_worker()
+
+    assert sorted(handled) == [str(i) for i in range(7)]
+    assert max_in_flight == 3
+
+
+def test_async_handler_rejects_ordering_key(temp_config):
+    class Handler(Laim):
+        async def handle_message(self, sender, recipients, message):
+            pass
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            with pytest.raises(ValueError):
+                Handler(config_file=temp_config, ordering_key=lambda task: task.sender)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='use_processes requires Python 3.7')
+def test_process_pool(temp_config):
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            return {
+                'pid': os.getpid(),
+                'secret': self.config['some-secret'],
+            }
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config, use_processes=True)
+
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    handler._start_process_pool()
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: hello\n\nbody'))
+    handler.stop()
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+    handler.process_pool.shutdown()
+
+    assert len(logged) == 1
+    assert logged[0]['action'] == 'handle-message'
+    assert logged[0]['decoded_subject'] == 'hello'
+    assert logged[0]['secret'] == 'foo secret'
+    assert logged[0]['pid'] != os.getpid()
+
+
+def test_batch_handler(temp_config):
+    batches = []
+    logged = []
+
+    class Handler(Laim):
+        def handle_messages(self, batch):
+            batches.append([queued.message.get_payload() for queued in batch])
+            return {'coalesced': True}
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config, max_batch_size=3, batch_linger_ms=10)
+
+    for i in range(5):
+        handler.queue.put(TaskArguments('foo', ['bar'], str(i).encode('utf-8')))
+    handler.stop()
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_batch_worker()
+
+    assert batches == [['0', '1', '2'], ['3', '4']]
+    assert len(logged) == 5
+    assert [log_data['batch_size'] for log_data in logged] == [3, 3, 3, 2, 2]
+    assert all(log_data['coalesced'] for log_data in logged)
+
+
+def test_header_only_handler_skips_body_parsing(temp_config):
+    logged = []
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            return {'handler_subject': message['subject']}
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config)
+
+    # Not valid UTF-8 in either the header or the body
+    handler.queue.put(TaskArguments('foo', ['bar'],
+        b'Subject: caf\xe9\nContent-Type: multipart/mixed; boundary=X\n\n--X\n\n\xff\n--X--\n'))
+    handler.stop()
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    assert logged[0]['action'] == 'handle-message'
+    assert logged[0]['msg_structure'] == 'multipart/mixed'
+
+
+def test_spilled_message_is_removed_after_handling(temp_config):
+    received_payload = None
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            nonlocal received_payload
+            received_payload = message.get_payload()
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config)
+
+    payload = spill_to_file(b'Subject: spilled\n\nLarge message\n')
+    handler.queue.put(TaskArguments('foo', ['bar'], payload))
+    handler.stop()
+    handler._start_worker()
+
+    assert received_payload == 'Large message\n'
+    assert not os.path.exists(payload.path)
+
+
+def test_logs_time_spent_in_each_stage(temp_config):
+    logged = []
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            time.sleep(0.01)
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config)
+
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: Hi\n\nHello',
+        enqueued_at=time.time() - 1))
+    handler.stop()
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    assert logged[0]['queue_wait_ms'] >= 1000
+    assert logged[0]['handler_ms'] >= 10
+    assert logged[0]['parse_ms'] >= 0
+    assert logged[0]['details_ms'] >= 0
+
+
+def test_handoff_to_successor(temp_config, tmp_path):
+    handled = []
+    first_message_started = threading.Event()
+    release_first_message = threading.Event()
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            if message['subject'] == '1':
+                first_message_started.set()
+                release_first_message.wait()
+            handled.append((self, message['subject']))
+
+    with socket.socket() as free_port_socket:
+        free_port_socket.bind(('127.0.0.1', 0))
+        port = free_port_socket.getsockname()[1]
+    handoff_socket = str(tmp_path / 'handoff.sock')
+
+    def create_handler():
+        with mock.patch('laim.laim.drop_privileges'):
+            return Handler(port=port, config_file=temp_config,
+                handoff_socket=handoff_socket)
+
+    def send(subject):
+        message = Message()
+        message['Subject'] = subject
+        with smtplib.SMTP('127.0.0.1', port) as smtp:
+            smtp.send_message(message, from_addr='foo@example.com', to_addrs=['bar'])
+
+    predecessor = create_handler()
+    predecessor_thread = threading.Thread(target=predecessor.run)
+    predecessor_thread.start()
+    send('1')
+    assert first_message_started.wait(5)
+    send('2')
+    send('3')
+
+    successor = create_handler()
+    successor_thread = threading.Thread(target=successor.run)
+    successor_thread.start()
+    # Don't let the predecessor's worker take a queued message before they've
+    # been handed over
+    assert predecessor.stop_event.wait(5)
+    release_first_message.set()
+    predecessor_thread.join(5)
+    assert not predecessor_thread.is_alive()
+
+    # The successor keeps serving on the same port
+    send('4')
+    successor.stop()
+    successor_thread.join(5)
+
+    assert sorted((h is predecessor, subject) for h, subject in handled) == [
+        (False, '2'),
+        (False, '3'),
+        (False, '4'),
+        (True, '1'),
+    ]
+
+
+def test_handoff_to_successor_that_dies(temp_config, tmp_path):
+    handled = []
+    logged = []
+    first_message_started = threading.Event()
+    release_first_message = threading.Event()
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            if message['subject'] == '1':
+                first_message_started.set()
+                release_first_message.wait()
+            handled.append(message['subject'])
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with socket.socket() as free_port_socket:
+        free_port_socket.bind(('127.0.0.1', 0))
+        port = free_port_socket.getsockname()[1]
+    handoff_socket = str(tmp_path / 'handoff.sock')
+
+    def send(subject):
+        message = Message()
+        message['Subject'] = subject
+        with smtplib.SMTP('127.0.0.1', port) as smtp:
+            smtp.send_message(message, from_addr='foo@example.com', to_addrs=['bar'])
+
+    with mock.patch('laim.laim.drop_privileges'):
+        predecessor = Handler(port=port, config_file=temp_config,
+            handoff_socket=handoff_socket)
+    predecessor_thread = threading.Thread(target=predecessor.run)
+    with before_log.connected_to(on_log):
+        predecessor_thread.start()
+        send('1')
+        assert first_message_started.wait(5)
+        send('2')
+        send('3')
+
+        # A successor that dies after it has taken the sockets and started
+        # reading the messages
+        with socket.socket(socket.AF_UNIX) as successor:
+            successor.connect(handoff_socket)
+            for sock in receive_sockets(successor):
+                sock.close()
+            with successor.makefile('rb') as handoff_fh:
+                handoff_fh.readline()
+
+        release_first_message.set()
+        predecessor_thread.join(5)
+        assert not predecessor_thread.is_alive()
+
+    assert handled == ['1', '2', '3']
+    handoff_log = [log_data for log_data in logged if log_data['action'] == 'handoff-error']
+    assert len(handoff_log) == 1
+    assert handoff_log[0]['requeued'] == 2
+
+
+def test_retries_failed_messages(temp_config):
+    handled = []
+    logged = []
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            handled.append(message['subject'])
+            if message['subject'] == 'flaky' and handled.count('flaky') < 3:
+                raise ValueError('Try again')
+            if message['subject'] == 'flaky':
+                self.stop()
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config, max_attempts=3, retry_delay=0.05)
+
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: flaky\n\nHello'))
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: fresh\n\nHello'))
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    # The fresh message isn't held up by the retries
+    assert handled == ['flaky', 'fresh', 'flaky', 'flaky']
+    assert [(log_data['action'], log_data.get('attempt')) for log_data in logged] == [
+        ('handle-message-error', 1),
+        ('handle-message', None),
+        ('handle-message-error', 2),
+        ('handle-message', 3),
+    ]
+    assert logged[0]['retry_in_ms'] <= 50
+
+
+def test_dead_letters_message_out_of_attempts(temp_config, tmp_path):
+    dead_letter_dir = tmp_path / 'dead-letter'
+    logged = []
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            if logged:
+                self.stop()
+            raise ValueError('Nope')
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config, user='root', max_attempts=2,
+                retry_delay=0.01, dead_letter_dir=str(dead_letter_dir))
+
+    payload = spill_to_file(b'Subject: Hi\n\nHello')
+    handler.queue.put(TaskArguments('foo', ['bar'], payload))
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    assert len(logged) == 2
+    assert 'dead_letter' not in logged[0]
+    assert logged[1]['attempt'] == 2
+    assert os.listdir(str(dead_letter_dir)) == [logged[1]['dead_letter']]
+    assert not os.path.exists(payload.path)
+
+
+def test_routes(temp_config):
+    logged = []
+
+    class Handler(Laim):
+        def __init__(self):
+            with mock.patch('laim.laim.drop_privileges'):
+                with mock.patch('laim.laim.LaimController'):
+                    super().__init__(config_file=temp_config, routes={
+                        'security@example.com': 'handle_security',
+                        '*': 'handle_other',
+                    })
+            self.handled = []
+
+        def handle_security(self, sender, recipients, message):
+            self.handled.append(('security', recipients))
+
+        def handle_other(self, sender, recipients, message):
+            self.handled.append(('other', recipients))
+
+    handler = Handler()
+    handler.queue.put(TaskArguments('foo', ['root', 'security@example.com', 'bar'], b''))
+    handler.stop()
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    assert handler.handled == [
+        ('other', ['root', 'bar']),
+        ('security', ['security@example.com']),
+    ]
+    assert logged[0]['action'] == 'handle-message'
+    assert logged[0]['routes'] == 'handle_other,handle_security'
+
+
+def test_retries_only_failed_routes(temp_config):
+    logged = []
+
+    class Handler(Laim):
+        def __init__(self):
+            with mock.patch('laim.laim.drop_privileges'):
+                with mock.patch('laim.laim.LaimController'):
+                    super().__init__(config_file=temp_config, max_attempts=2,
+                        retry_delay=0.05, routes={
+                            'security@example.com': 'handle_security',
+                            '*': 'handle_other',
+                        })
+            self.handled = []
+
+        def handle_security(self, sender, recipients, message):
+            self.handled.append(('security', recipients))
+            if len(self.handled) == 2:
+                raise ValueError('Try again')
+            self.stop()
+
+        def handle_other(self, sender, recipients, message):
+            self.handled.append(('other', recipients))
+
+    handler = Handler()
+    handler.queue.put(TaskArguments('foo', ['root', 'security@example.com'], b''))
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    assert handler.handled == [
+        ('other', ['root']),
+        ('security', ['security@example.com']),
+        ('security', ['security@example.com']),
+    ]
+    assert logged[0]['action'] == 'handle-message-error'
+    assert logged[0]['failed_recipients'] == 'security@example.com'
+    assert logged[1]['action'] == 'handle-message'
+    assert logged[1]['recipients'] == 'security@example.com'
+
+
+def test_circuit_breaker_parks_and_sheds_messages(temp_config, tmp_path):
+    logged = []
+    handled = []
+
+    class Handler(Laim):
+        def handle_message(self, sender, recipients, message):
+            handled.append(message['subject'])
+            raise ValueError('Downstream is down')
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config, user='root',
+                circuit_breaker=CircuitBreaker(min_calls=1, open_seconds=60),
+                shed_priority=5, dead_letter_dir=str(tmp_path))
+
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: 1\n\n'))
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: 2\n\n'))
+    handler.queue.put(TaskArguments('foo', ['bar'], b'Subject: 3\n\n', priority=5))
+    handler.stop()
+
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._start_worker()
+
+    assert handled == ['1']
+    assert [log_data['action'] for log_data in logged] == [
+        'circuit-breaker',
+        'handle-message-error',
+        'park-message',
+        'shed-message',
+    ]
+    assert logged[2]['retry_in_ms'] > 59000
+    assert sorted(os.listdir(str(tmp_path))) == sorted([
+        logged[1]['dead_letter'],
+        logged[3]['dead_letter'],
+    ])
+    assert [task_args.data for task_args in handler.retries.drain()] == [b'Subject: 2\n\n']
+
@@ -0,0 +1,92 @@
+from laim import before_log
+from laim.breaker import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+def record_calls(breaker, *failed):
+    for call_failed in failed:
+        breaker.record(breaker.allow(), call_failed, 10)
+
+
+def test_opens_on_error_rate_and_half_opens():
+    clock = FakeClock()
+    breaker = CircuitBreaker(window=60, min_calls=4, error_rate=0.5, open_seconds=30, clock=clock)
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        record_calls(breaker, False, True, False)
+        assert breaker.state == 'closed'
+        record_calls(breaker, True)
+        assert breaker.state == 'open'
+        assert breaker.allow() is None
+        assert breaker.retry_after() == 30
+
+        clock.now += 30
+        probe = breaker.allow()
+        assert probe is not None
+        assert breaker.state == 'half-open'
+        # Only a single probe at a time
+        assert breaker.allow() is None
+        breaker.record(probe, True, 10)
+        assert breaker.state == 'open'
+
+        clock.now += 30
+        breaker.record(breaker.allow(), False, 10)
+        assert breaker.state == 'closed'
+        assert breaker.allow() is not None
+
+    assert [(log_data['previous_state'], log_data['state']) for log_data in logged] == [
+        ('closed', 'open'),
+        ('open', 'half-open'),
+        ('half-open', 'open'),
+        ('open', 'half-open'),
+        ('half-open', 'closed'),
+    ]
+    assert logged[0]['action'] == 'circuit-breaker'
+    assert logged[0]['error_rate'] == 0.5
+
+
+def test_calls_from_before_half_open_are_not_probes():
+    clock = FakeClock()
+    breaker = CircuitBreaker(min_calls=1, error_rate=1, open_seconds=30, clock=clock)
+    slow_call = breaker.allow()
+    record_calls(breaker, True)
+    assert breaker.state == 'open'
+
+    clock.now += 30
+    probe = breaker.allow()
+    # Finishing the call that started before the breaker opened doesn't close it
+    breaker.record(slow_call, False, 10)
+    assert breaker.state == 'half-open'
+    assert breaker.allow() is None
+
+    breaker.record(probe, False, 10)
+    assert breaker.state == 'closed'
+
+
+def test_opens_on_slow_calls():
+    breaker = CircuitBreaker(min_calls=2, slow_call_ms=1000, slow_call_rate=1, clock=FakeClock())
+    breaker.record(breaker.allow(), False, 1500)
+    assert breaker.state == 'closed'
+    breaker.record(breaker.allow(), False, 2000)
+    assert breaker.state == 'open'
+
+
+def test_old_calls_leave_the_window():
+    clock = FakeClock()
+    breaker = CircuitBreaker(window=60, min_calls=2, error_rate=1, clock=clock)
+    record_calls(breaker, True)
+    clock.now += 61
+    record_calls(breaker, True)
+    assert breaker.state == 'closed'
+    record_calls(breaker, True)
+    assert breaker.state == 'open'
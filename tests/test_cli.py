@@ -1,42 +1,62 @@
-import email.parser
-import email.policy
+import itertools
 import os
 import pwd
+import socket
+import tempfile
 import textwrap
+import threading
+import time
 from unittest import mock
 
 import pytest
 
-from laim.__main__ import read_message, main, extract_recipients_from_to_header
+from laim.__main__ import (main, extract_recipients_from_to_header, get_sender_from_headers,
+    is_temporary_failure, read_body, read_headers, Headers, SMTPError)
+from laim.maildrop import read_maildrop_file
+from laim.spool import SpoolQueue
+from laim.util import TaskArguments
 
 def test_read_message():
-    stdin_mock = mock.Mock()
-    stdin_mock.buffer = [
+    lines = iter([
         b'From: foo\n',
         b'\n',
         b'Foo content\n',
         b'.\n',
         b'Should be ignored\n',
-    ]
-    with mock.patch('laim.__main__.sys.stdin', stdin_mock):
-        message = read_message(stop_on_dot=True)
+    ])
+    headers, first_body_line = read_headers(lines, stop_on_dot=True)
 
-    assert message.get_payload() == 'Foo content\n'
+    assert headers.get('From') == 'foo'
+    assert list(read_body(lines, first_body_line, stop_on_dot=True)) == [b'Foo content\n']
 
 
 def test_read_message_ignore_dot():
-    stdin_mock = mock.Mock()
-    stdin_mock.buffer = [
+    lines = iter([
         b'From: foo\n',
         b'\n',
         b'Foo content\n',
         b'.\n',
         b'Should be included\n',
+    ])
+    headers, first_body_line = read_headers(lines, stop_on_dot=False)
+
+    assert list(read_body(lines, first_body_line, stop_on_dot=False)) == [
+        b'Foo content\n',
+        b'.\n',
+        b'Should be included\n',
     ]
-    with mock.patch('laim.__main__.sys.stdin', stdin_mock):
-        message = read_message(stop_on_dot=False)
 
-    assert message.get_payload() == 'Foo content\n.\nShould be included\n'
+
+def test_read_message_without_blank_line_after_headers():
+    lines = iter([
+        b'Subject: foo\n',
+        b' folded\n',
+        b'Not a header\n',
+    ])
+    headers, first_body_line = read_headers(lines, stop_on_dot=True)
+
+    assert headers.get('Subject') == 'foo\n folded'
+    assert list(read_body(lines, first_body_line, stop_on_dot=True)) == [b'Not a header\n']
 
 
 def test_message_parsing():
@@ -197,9 +217,11 @@ def test_quoted_printable_long_subject():
 
 
 def assert_send_mail_called(send_mail_mock, sender, recipients, message_string):
-    send_mail_mock.assert_called_with(sender, recipients, mock.ANY)
-    sent_message = send_mail_mock.call_args[0][2]
-    assert sent_message.as_string(policy=email.policy.SMTP) == message_string
+    send_mail_mock.assert_called_with(sender, recipients, mock.ANY, mock.ANY)
+    headers, body = send_mail_mock.call_args[0][2:]
+    lines = itertools.chain(headers.lines(), [b'\n'], body)
+    sent_message = b''.join(line.rstrip(b'\r\n') + b'\r\n' for line in lines)
+    assert sent_message.decode('utf-8') == message_string
 
 
 @pytest.mark.parametrize('test_case', [
@@ -211,3 +233,130 @@ def test_extract_recipients_from_to_header(test_case):
     to_header, expected = test_case
     actual = extract_recipients_from_to_header(to_header)
     assert actual == expected
+
+
+def test_mailq_without_spool(caplog):
+    with mock.patch('laim.__main__.SPOOL_DIR', '/nonexistent'):
+        main(['-bp'])
+
+    assert 'Mail queue is empty' in caplog.text
+
+
+def test_mailq_lists_spooled_messages(capsys):
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool = SpoolQueue(spool_dir)
+        spool.put(TaskArguments('foo@example.com', ['bar@example.com'], b'Message'))
+        with mock.patch('laim.__main__.SPOOL_DIR', spool_dir):
+            main(['-bp'])
+
+    output = capsys.readouterr().out
+    assert 'foo@example.com' in output
+    assert 'bar@example.com' in output
+    assert '1 Request.' in output
+
+
+@pytest.mark.parametrize('test_case', [
+    ('root (Cron Daemon)', 'root'),
+    ('Foo Bar <foo@bar.com>', 'foo@bar.com'),
+    ('"Bar, Foo" <foo@bar.com>', 'foo@bar.com'),
+    ('foo@bar.com, baz@bar.com', 'foo@bar.com'),
+])
+def test_get_sender_from_headers(test_case):
+    from_header, expected = test_case
+    headers = Headers()
+    headers.append_line(b'From: ' + from_header.encode('utf-8') + b'\n')
+    assert get_sender_from_headers(headers) == expected
+
+
+def test_message_is_dropped_when_laim_is_down(tmp_path):
+    stdin_mock = mock.Mock()
+    stdin_mock.buffer = [
+        b'From: foo\n',
+        b'To: bar\n',
+        b'\n',
+        b'Message\n',
+    ]
+    with socket.socket() as closed_socket:
+        closed_socket.bind(('127.0.0.1', 0))
+        closed_port = closed_socket.getsockname()[1]
+
+    with mock.patch('laim.__main__.sys.stdin', stdin_mock):
+        with mock.patch.multiple('laim.__main__',
+                SMTP_PORT=closed_port,
+                SMTP_SOCKET=str(tmp_path / 'nonexistent.sock'),
+                MAILDROP_DIR=str(tmp_path)):
+            main([])
+
+    dropped = os.listdir(tmp_path)
+    assert len(dropped) == 1
+    task = read_maildrop_file(str(tmp_path / dropped[0]), in_memory=True)
+    assert task.sender == 'foo'
+    assert task.recipients == ['bar']
+    assert task.data == b'From: foo\r\nTo: bar\r\n\r\nMessage\r\n'
+
+
+@pytest.mark.parametrize('admission_delay,dropped', [
+    # Waiting for space in the queue for longer than the command timeout
+    (0.3, False),
+    # Still waiting when sendmail gives up and falls back to the maildrop
+    (1, True),
+])
+def test_waits_briefly_for_laim_to_admit_message(tmp_path, admission_delay, dropped):
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(str(tmp_path / 'smtp.sock'))
+    listener.listen(1)
+    listener.settimeout(5)
+    def serve_slow_queue():
+        conn, _ = listener.accept()
+        with conn, conn.makefile('rb') as reader:
+            conn.sendall(b'220 laim\r\n')
+            in_data = False
+            for line in reader:
+                if in_data:
+                    if line == b'.\r\n':
+                        in_data = False
+                        time.sleep(admission_delay)
+                        try:
+                            conn.sendall(b'250 OK\r\n')
+                        except OSError:
+                            return
+                elif line == b'DATA\r\n':
+                    in_data = True
+                    conn.sendall(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                elif line == b'QUIT\r\n':
+                    conn.sendall(b'221 Bye\r\n')
+                    return
+                else:
+                    conn.sendall(b'250 OK\r\n')
+    server = threading.Thread(target=serve_slow_queue)
+    server.start()
+    stdin_mock = mock.Mock()
+    stdin_mock.buffer = [b'To: bar\n', b'\n', b'Message\n']
+
+    try:
+        with mock.patch('laim.__main__.sys.stdin', stdin_mock):
+            with mock.patch.multiple('laim.__main__',
+                    SMTP_SOCKET=str(tmp_path / 'smtp.sock'),
+                    SMTP_TIMEOUT=0.1,
+                    DATA_REPLY_TIMEOUT=0.5,
+                    MAILDROP_DIR=str(tmp_path / 'maildrop')):
+                os.mkdir(str(tmp_path / 'maildrop'))
+                main(['-f', 'foo'])
+    finally:
+        server.join()
+        listener.close()
+
+    maildrop = os.listdir(str(tmp_path / 'maildrop'))
+    if not dropped:
+        assert maildrop == []
+        return
+    assert len(maildrop) == 1
+    task = read_maildrop_file(str(tmp_path / 'maildrop' / maildrop[0]), in_memory=True)
+    assert task.data == b'To: bar\r\nFrom: foo\r\n\r\nMessage\r\n'
+
+
+def test_rate_limited_message_is_not_dropped():
+    assert not is_temporary_failure(SMTPError(451, '4.7.1 Rate limit exceeded for sender'))
+    assert is_temporary_failure(SMTPError(451, '4.3.1 Queue full, try again later'))
+    assert is_temporary_failure(ConnectionRefusedError())
+    assert not is_temporary_failure(SMTPError(550, 'Rejected'))
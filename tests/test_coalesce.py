@@ -0,0 +1,74 @@
+import threading
+
+from laim.coalesce import Coalescer, get_fingerprint
+from laim.message import spill_to_file
+from laim.util import TaskArguments
+
+
+def make_task(subject, body, sender='cron@example.com'):
+    data = ('Subject: %s\n\n%s' % (subject, body)).encode('utf-8')
+    return TaskArguments(sender, ['root'], data)
+
+
+def test_fingerprint_normalizes_subject():
+    first = make_task('Cron <root@host> backup', 'failed\n')
+    second = make_task('cron  <ROOT@host>   backup ', 'failed\n')
+    assert get_fingerprint(first) == get_fingerprint(second)
+
+
+def test_fingerprint_differs_by_body_and_sender():
+    fingerprint = get_fingerprint(make_task('backup', 'failed\n'))
+    assert fingerprint != get_fingerprint(make_task('backup', 'succeeded\n'))
+    assert fingerprint != get_fingerprint(make_task('backup', 'failed\n', sender='foo'))
+
+
+def test_fingerprint_of_subject_in_unknown_charset():
+    task_args = make_task('=?x-unknown?Q?backup?=', 'failed\n')
+    assert get_fingerprint(task_args) == get_fingerprint(task_args)
+    assert get_fingerprint(task_args) != get_fingerprint(make_task('backup', 'failed\n'))
+
+
+def test_fingerprint_of_spilled_message(tmp_path):
+    task_args = make_task('backup', 'failed\n')
+    spilled = task_args._replace(data=spill_to_file(task_args.data, str(tmp_path)))
+    assert get_fingerprint(task_args) == get_fingerprint(spilled)
+
+
+def test_coalescer_requeues_last_duplicate_when_window_closes():
+    requeued = []
+    discarded = []
+    requeued_event = threading.Event()
+
+    def requeue(task_args):
+        requeued.append(task_args)
+        requeued_event.set()
+
+    coalescer = Coalescer(0.1, requeue, discarded.append)
+    tasks = [make_task('backup', 'failed\n') for _ in range(3)]
+
+    assert coalescer.accept(tasks[0])
+    assert not coalescer.accept(tasks[1])
+    assert not coalescer.accept(tasks[2])
+    assert coalescer.accept(make_task('other', 'failed\n'))
+
+    assert requeued_event.wait(1)
+    assert discarded == [tasks[1]]
+    assert requeued == [tasks[2]._replace(repeats=2)]
+
+    # The requeued task is handled, and the window is closed
+    assert coalescer.accept(requeued[0])
+    assert coalescer.accept(make_task('backup', 'failed\n'))
+
+
+def test_coalescer_flush():
+    requeued = []
+    coalescer = Coalescer(60, requeued.append, lambda task_args: None)
+    coalescer.accept(make_task('backup', 'failed\n'))
+    coalescer.accept(make_task('backup', 'failed\n'))
+
+    coalescer.flush()
+
+    assert [task_args.repeats for task_args in requeued] == [1]
+    # Nothing is held back once flushed, as it would never be requeued
+    assert coalescer.accept(make_task('backup', 'failed\n'))
+    assert coalescer.accept(make_task('backup', 'failed\n'))
@@ -0,0 +1,29 @@
+import os
+import tempfile
+
+import pytest
+
+from laim.config import ConfigReader
+
+
+@pytest.mark.parametrize('privileged_helper', (False, True))
+def test_config_reader_sees_replaced_file(privileged_helper):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'config.yml')
+        with open(path, 'w') as config_fh:
+            config_fh.write('foo: 1\n')
+        reader = ConfigReader(path, privileged_helper=privileged_helper)
+        try:
+            assert reader.read() == 'foo: 1\n'
+
+            # Editors typically replace the file instead of writing to it
+            with open(path + '.new', 'w') as config_fh:
+                config_fh.write('foo: 2\n')
+            os.rename(path + '.new', path)
+            assert reader.read() == 'foo: 2\n'
+
+            os.remove(path)
+            with pytest.raises(OSError):
+                reader.read()
+        finally:
+            reader.close()
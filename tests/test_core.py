@@ -1,11 +1,20 @@
 import asyncio
+import os
+import threading
 from queue import Queue
 from unittest import mock
 
 import pytest
+from aiosmtpd.smtp import Envelope
 
-from laim import Laim, unfold
-from laim.laim import LaimHandler
+from laim import Laim, before_log, unfold
+from laim.server import LaimHandler
+from laim.message import FilePayload
+from laim.ratelimit import RateLimit, RateLimiter
+from laim.retry import RetryScheduler
+from laim.spool import SpoolQueue
+from laim.taskqueue import TaskQueue
+from laim.util import TaskArguments
 
 
 def test_drops_privileges(temp_config):
@@ -39,9 +48,107 @@ def test_full_queue():
     def add_to_queue():
         return run(handler.handle_DATA(None, mock.Mock(), envelope))
 
-    add_to_queue() == '250 OK'
-    add_to_queue() == '250 OK'
-    add_to_queue() == '552 Exceeded storage allocation'
+    assert add_to_queue() == '250 OK'
+    assert add_to_queue() == '250 OK'
+    assert add_to_queue() == '451 4.3.1 Queue full, try again later'
+
+
+def test_full_queue_waits_for_space():
+    queue = Queue(1)
+    queue.put('existing task')
+    handler = LaimHandler(queue, admission_timeout=2)
+    envelope = mock.MagicMock()
+    envelope.rcpt_tos = ['foo']
+    envelope.content = b'Message'
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    # Free up space in the queue after the handler has started waiting
+    timer = threading.Timer(0.05, queue.get)
+    timer.start()
+    loop = asyncio.new_event_loop()
+    try:
+        with before_log.connected_to(on_log):
+            response = loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+    finally:
+        loop.close()
+        timer.join()
+
+    assert response == '250 OK'
+    assert logged[0]['action'] == 'queued-message'
+    assert logged[0]['admission_ms'] >= 40
+    assert queue.get_nowait().data == b'Message'
+
+
+def test_queue_byte_budget():
+    queue = TaskQueue()
+    handler = LaimHandler(queue, max_queue_bytes=10)
+    envelope = mock.MagicMock()
+    envelope.rcpt_tos = ['foo']
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+    loop = asyncio.new_event_loop()
+    def add_to_queue(content):
+        envelope.content = content
+        return loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+
+    try:
+        with before_log.connected_to(on_log):
+            assert add_to_queue(b'Message') == '250 OK'
+            assert add_to_queue(b'Note') == '451 4.3.1 Queue full, try again later'
+            assert add_to_queue(b'Hi') == '250 OK'
+            assert add_to_queue(b'Core dump!!') == '552 5.3.4 Message too large for the queue'
+            queue.get_nowait()
+            assert add_to_queue(b'Note') == '250 OK'
+    finally:
+        loop.close()
+
+    assert [(log_data['action'], log_data.get('queued_bytes')) for log_data in logged] == [
+        ('queued-message', 7),
+        ('queue-full', 7),
+        ('queued-message', 9),
+        ('message-too-large', None),
+        ('queued-message', 6),
+    ]
+    assert queue.queued_bytes == 6
+
+
+def test_queue_byte_budget_includes_retries():
+    queue = TaskQueue()
+    retries = RetryScheduler(max_attempts=2, base_delay=10)
+    handler = LaimHandler(queue, max_queue_bytes=10, retries=retries)
+    envelope = mock.MagicMock()
+    envelope.rcpt_tos = ['foo']
+    envelope.content = b'Note'
+    retries.schedule(TaskArguments('foo', ['bar'], b'Message'))
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+    finally:
+        loop.close()
+
+    assert response == '451 4.3.1 Queue full, try again later'
+    assert queue.empty()
+
+
+def test_queued_bytes_of_spilled_messages(tmp_path):
+    queue = TaskQueue()
+    handler = LaimHandler(queue, spill_threshold=5, spill_dir=str(tmp_path), max_queue_bytes=30)
+    envelope = mock.MagicMock()
+    envelope.rcpt_tos = ['foo']
+    envelope.content = b'Subject: large\n\nMessage'
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+    finally:
+        loop.close()
+
+    assert response == '250 OK'
+    assert queue.queued_bytes == len(envelope.content)
+    os.unlink(queue.get_nowait().data.path)
+    assert queue.queued_bytes == 0
 
 
 @pytest.mark.parametrize('testcase', [
@@ -54,3 +161,121 @@ def test_full_queue():
 def test_unfold(testcase):
     folded, expected = testcase
     assert unfold(folded) == expected
+
+
+def test_spooled_message_is_persisted_before_accepting(tmp_path):
+    spool = SpoolQueue(str(tmp_path))
+    handler = LaimHandler(spool)
+    envelope = mock.MagicMock()
+    envelope.rcpt_tos = ['foo']
+    envelope.mail_from = 'bar'
+    envelope.content = b'Message'
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+    finally:
+        loop.close()
+
+    assert response == '250 OK'
+    assert len(os.listdir(str(tmp_path / 'new'))) == 1
+
+
+def test_large_message_is_spilled_to_disk(tmp_path):
+    queue = Queue()
+    handler = LaimHandler(queue, spill_threshold=5, spill_dir=str(tmp_path))
+    envelope = mock.MagicMock()
+    envelope.rcpt_tos = ['foo']
+    envelope.content = b'Subject: large\n\nMessage'
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+    finally:
+        loop.close()
+
+    assert response == '250 OK'
+    task_args = queue.get_nowait()
+    assert isinstance(task_args.data, FilePayload)
+    assert os.path.dirname(task_args.data.path) == str(tmp_path)
+
+
+def test_rate_limited_recipient():
+    rate_limiter = RateLimiter({'sender': RateLimit(per_minute=1, burst=1)})
+    handler = LaimHandler(Queue(), rate_limiter=rate_limiter)
+    loop = asyncio.new_event_loop()
+    def add_recipient(envelope, address, rcpt_options=()):
+        return loop.run_until_complete(
+            handler.handle_RCPT(None, mock.Mock(), envelope, address, list(rcpt_options)))
+
+    try:
+        first = Envelope()
+        first.mail_from = 'foo'
+        assert add_recipient(first, 'root') == '250 OK'
+        assert add_recipient(first, 'admin', ['NOTIFY=NEVER']) == '250 OK'
+        assert first.rcpt_tos == ['root', 'admin']
+        assert first.rcpt_options == ['NOTIFY=NEVER']
+
+        second = Envelope()
+        second.mail_from = 'foo'
+        assert add_recipient(second, 'root').startswith('451 ')
+        assert second.rcpt_tos == []
+    finally:
+        loop.close()
+
+
+def test_reload_config(temp_config):
+    reloaded = []
+
+    class Handler(Laim):
+        def reload_config(self, config):
+            if 'invalid' in config:
+                raise ValueError('Invalid config')
+            reloaded.append(config)
+
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Handler(config_file=temp_config)
+
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        with open(temp_config, 'w') as config_fh:
+            config_fh.write('some-secret: new secret\n')
+        assert handler.reload()
+
+        with open(temp_config, 'w') as config_fh:
+            config_fh.write('some-secret: [unterminated\n')
+        assert not handler.reload()
+
+        with open(temp_config, 'w') as config_fh:
+            config_fh.write('invalid: true\n')
+        assert not handler.reload()
+
+    handler.config_reader.close()
+    assert reloaded == [{'some-secret': 'new secret'}]
+    assert handler.config == {'some-secret': 'new secret'}
+    assert [log_data['action'] for log_data in logged] == [
+        'reload-config',
+        'reload-config-error',
+        'reload-config-error',
+    ]
+    assert logged[2]['error_msg'] == 'Invalid config'
+
+
+def test_requeue_to_full_queue_does_not_block(temp_config, tmp_path):
+    with mock.patch('laim.laim.drop_privileges'):
+        with mock.patch('laim.laim.LaimController'):
+            handler = Laim(config_file=temp_config, user='root', max_queue_size=1,
+                coalesce_window=60, dead_letter_dir=str(tmp_path))
+    handler.queue.put_nowait(TaskArguments('foo', ['bar'], b'Message'))
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    with before_log.connected_to(on_log):
+        handler._requeue(TaskArguments('foo', ['bar'], b'Duplicate', repeats=2))
+
+    handler.config_reader.close()
+    assert logged[0]['action'] == 'requeue-queue-full'
+    assert os.listdir(str(tmp_path)) == [logged[0]['dead_letter']]
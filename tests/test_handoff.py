@@ -0,0 +1,24 @@
+import socket
+import threading
+
+from laim.handoff import receive_sockets, send_sockets
+
+
+def test_send_sockets():
+    sender, receiver = socket.socketpair()
+    listeners = [socket.socket(), socket.socket(socket.AF_UNIX)]
+    received = []
+    try:
+        listeners[0].bind(('127.0.0.1', 0))
+        # The sender waits for the receiver to acknowledge
+        thread = threading.Thread(target=lambda: received.extend(receive_sockets(receiver)))
+        thread.start()
+        send_sockets(sender, listeners)
+        thread.join()
+
+        assert len(received) == 2
+        assert received[0].getsockname() == listeners[0].getsockname()
+        assert received[1].family == socket.AF_UNIX
+    finally:
+        for sock in listeners + received + [sender, receiver]:
+            sock.close()
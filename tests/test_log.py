@@ -1,9 +1,13 @@
 import email.message
+import struct
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 
 import pytest
 
-from laim.log import format_message_structure, format_context
+from laim.log import (BufferedLogWriter, JournaldSink, format_message_structure,
+    format_context)
 
 
 @pytest.mark.parametrize('context,expected', [
@@ -59,3 +63,65 @@ def test_format_message_structure_nested():
 
     expected = 'multipart/mixed(text/plain, multipart/alternative(image/jpg, image/png))'
     assert format_message_structure(msg) == expected
+
+
+class ListSink:
+    def __init__(self, block_event=None):
+        self.written = []
+        self.block_event = block_event
+
+    def write_batch(self, batch):
+        if self.block_event is not None:
+            self.block_event.wait()
+        self.written.extend(batch)
+
+
+def test_buffered_log_writer():
+    sink = ListSink()
+    writer = BufferedLogWriter(sink)
+    try:
+        writer.write({'action': 'first'})
+        writer.write({'action': 'second'})
+        writer.flush()
+    finally:
+        writer.close()
+
+    assert [context['action'] for context in sink.written] == ['first', 'second']
+
+
+def test_buffered_log_writer_drops_when_full():
+    unblock = threading.Event()
+    sink = ListSink(unblock)
+    writer = BufferedLogWriter(sink, max_buffer_size=2)
+    try:
+        writer.write({'action': 'in-flight'})
+        # Wait for the writer thread to pick up the first line and block on the sink
+        while not writer._writing:
+            time.sleep(0.001)
+        for i in range(4):
+            writer.write({'action': 'queued', 'i': i})
+        unblock.set()
+        writer.flush()
+    finally:
+        writer.close()
+
+    assert writer.dropped == 2
+    assert [context['action'] for context in sink.written] == [
+        'in-flight', 'queued', 'queued', 'log-dropped']
+    assert sink.written[-1]['dropped'] == 2
+
+
+def test_journald_entry_format():
+    sink = JournaldSink(socket_path='/nonexistent')
+    entry = sink.format_entry({
+        'action': 'handle-message-error',
+        'error': 'ValueError',
+        'error_msg': 'multi\nline',
+    })
+
+    message = b'action=handle-message-error error=ValueError error_msg="multi\nline"'
+    assert entry.startswith(b'MESSAGE\n' + struct.pack('<Q', len(message)) + message + b'\n')
+    assert b'PRIORITY=3\n' in entry
+    assert b'SYSLOG_IDENTIFIER=laim\n' in entry
+    assert b'LAIM_ACTION=handle-message-error\n' in entry
+    assert b'LAIM_ERROR_MSG\n' + struct.pack('<Q', 10) + b'multi\nline\n' in entry
@@ -0,0 +1,108 @@
+import os
+import queue
+import tempfile
+import time
+from unittest import mock
+
+import pytest
+
+from laim.__main__ import Headers, drop_mail
+from laim.maildrop import MaildropWatcher
+from laim.message import FilePayload
+
+
+@pytest.fixture
+def maildrop_dir():
+    with tempfile.TemporaryDirectory() as directory:
+        yield directory
+
+
+def drop_test_mail(directory):
+    headers = Headers()
+    headers.append_line(b'Subject: Hi\n')
+    with mock.patch('laim.__main__.MAILDROP_DIR', directory):
+        drop_mail('foo', ['bar'], headers, iter([b'Hello\n']))
+
+
+def test_ingests_dropped_mail(maildrop_dir):
+    task_queue = queue.Queue()
+    watcher = MaildropWatcher(maildrop_dir, task_queue, spooled=False)
+    watcher.start()
+    try:
+        drop_test_mail(maildrop_dir)
+        task = task_queue.get(timeout=10)
+    finally:
+        watcher.stop()
+
+    assert task.sender == 'foo'
+    assert task.recipients == ['bar']
+    assert isinstance(task.data, FilePayload)
+    assert os.path.basename(task.data.path).startswith('.queued-')
+    with task.data.open() as payload_fh:
+        assert payload_fh.read() == b'Subject: Hi\r\n\r\nHello\r\n'
+
+
+def test_ingests_dropped_mail_into_spool(maildrop_dir):
+    task_queue = queue.Queue()
+    watcher = MaildropWatcher(maildrop_dir, task_queue, spooled=True)
+    watcher.start()
+    try:
+        drop_test_mail(maildrop_dir)
+        task = task_queue.get(timeout=10)
+        # Removed from the maildrop once it's been put on the queue
+        deadline = time.monotonic() + 10
+        while os.listdir(maildrop_dir) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        watcher.stop()
+
+    assert task.data == b'Subject: Hi\r\n\r\nHello\r\n'
+    assert os.listdir(maildrop_dir) == []
+
+
+def test_requeues_messages_queued_by_previous_run(maildrop_dir):
+    drop_test_mail(maildrop_dir)
+    dropped = os.listdir(maildrop_dir)[0]
+    os.rename(os.path.join(maildrop_dir, dropped), os.path.join(maildrop_dir, '.queued-' + dropped))
+    with open(os.path.join(maildrop_dir, 'invalid'), 'w') as invalid_fh:
+        invalid_fh.write('not a message')
+
+    task_queue = queue.Queue()
+    watcher = MaildropWatcher(maildrop_dir, task_queue, spooled=False)
+    watcher.start()
+    try:
+        task = task_queue.get(timeout=10)
+        deadline = time.monotonic() + 10
+        while 'invalid' in os.listdir(maildrop_dir) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        watcher.stop()
+
+    assert task.data.path == os.path.join(maildrop_dir, '.queued-' + dropped)
+    assert task_queue.empty()
+    assert sorted(os.listdir(maildrop_dir)) == ['.invalid-invalid', '.queued-' + dropped]
+
+
+@pytest.mark.parametrize('spooled', [False, True])
+def test_refuses_files_that_are_not_regular(maildrop_dir, spooled):
+    with tempfile.NamedTemporaryFile() as target_fh:
+        drop_test_mail(maildrop_dir)
+        dropped = os.listdir(maildrop_dir)[0]
+        # Only laim could read the target, and nothing ever writes to the FIFO
+        os.rename(os.path.join(maildrop_dir, dropped), target_fh.name)
+        os.symlink(target_fh.name, os.path.join(maildrop_dir, 'symlink'))
+        os.mkfifo(os.path.join(maildrop_dir, 'fifo'))
+
+        task_queue = queue.Queue()
+        watcher = MaildropWatcher(maildrop_dir, task_queue, spooled=spooled)
+        watcher.start()
+        try:
+            deadline = time.monotonic() + 10
+            while len([f for f in os.listdir(maildrop_dir) if f.startswith('.invalid-')]) < 2 \
+                    and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+
+    assert task_queue.empty()
+    assert sorted(os.listdir(maildrop_dir)) == ['.invalid-fifo', '.invalid-symlink']
@@ -0,0 +1,104 @@
+import email.message
+import email.policy
+
+from laim.message import FilePayload, LazyMessage, spill_to_file
+
+
+MULTIPART_MESSAGE = (
+    b'From: foo@example.com\r\n'
+    b'Subject: Backup report\r\n'
+    b'Content-Type: multipart/mixed; boundary="XXX"\r\n'
+    b'\r\n'
+    b'--XXX\r\n'
+    b'Content-Type: text/plain\r\n'
+    b'\r\n'
+    b'See attached\r\n'
+    b'--XXX\r\n'
+    b'Content-Type: application/octet-stream\r\n'
+    b'\r\n'
+    b'\xff\xfe\r\n'
+    b'--XXX--\r\n'
+)
+
+
+def test_header_access_does_not_parse_body():
+    message = LazyMessage(MULTIPART_MESSAGE)
+
+    assert message['subject'] == 'Backup report'
+    assert message.get('from') == 'foo@example.com'
+    assert 'Subject' in message
+    assert message.get_content_type() == 'multipart/mixed'
+    assert not message.is_parsed
+
+
+def test_body_access_parses_message():
+    message = LazyMessage(MULTIPART_MESSAGE)
+
+    assert message.is_multipart()
+    assert message.is_parsed
+    assert [part.get_content_type() for part in message.get_payload()] == [
+        'text/plain', 'application/octet-stream']
+
+
+def test_replaced_header_survives_parsing():
+    message = LazyMessage(b'Subject: =?utf-8?q?foo?=\n\nbody\n')
+    message.replace_header('subject', 'foo')
+
+    assert message.get_payload() == 'body\n'
+    assert message['subject'] == 'foo'
+
+
+def test_non_utf8_body():
+    message = LazyMessage(b'Subject: latin-1\n\nbl\xe5b\xe6r\n')
+    assert message.get_payload(decode=True) == b'bl\xe5b\xe6r\n'
+
+
+def test_utf8_body_without_charset():
+    message = LazyMessage(b'Subject: Hei\n\nHei p\xc3\xa5 deg\n')
+    assert message.get_payload() == 'Hei p\u00e5 deg\n'
+
+
+def test_utf8_body_without_charset_in_file(tmp_path):
+    payload = spill_to_file(b'Subject: Hei\n\nHei p\xc3\xa5 deg\n', str(tmp_path))
+    message = LazyMessage(payload)
+    assert message.get_payload() == 'Hei p\u00e5 deg\n'
+
+
+def test_is_a_message():
+    message = LazyMessage(MULTIPART_MESSAGE)
+    assert isinstance(message, email.message.Message)
+    assert not message.is_parsed
+
+    message = LazyMessage(MULTIPART_MESSAGE, email.policy.default)
+    assert isinstance(message, email.message.EmailMessage)
+
+
+def test_message_without_headers():
+    message = LazyMessage(b'\nbody\n')
+    assert len(message) == 0
+    assert message.get_payload() == 'body\n'
+
+
+def test_policy():
+    message = LazyMessage(MULTIPART_MESSAGE, email.policy.default)
+    assert message.get_body(('plain',)).get_content() == 'See attached'
+
+
+def test_file_payload(tmp_path):
+    path = str(tmp_path / 'message')
+    with open(path, 'wb') as message_fh:
+        message_fh.write(b'envelope\n' + MULTIPART_MESSAGE)
+    payload = FilePayload(path, len(b'envelope\n'), len(MULTIPART_MESSAGE))
+
+    message = LazyMessage(payload)
+    assert message['subject'] == 'Backup report'
+    assert not message.is_parsed
+
+    assert message.get_payload(0).get_payload() == 'See attached'
+
+
+def test_spill_to_file(tmp_path):
+    payload = spill_to_file(MULTIPART_MESSAGE, str(tmp_path))
+    assert payload.size == len(MULTIPART_MESSAGE)
+    with payload.open() as payload_fh:
+        assert payload_fh.read() == MULTIPART_MESSAGE
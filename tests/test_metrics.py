@@ -0,0 +1,88 @@
+import http.client
+import socket
+from queue import Queue
+
+from laim import CircuitBreaker, log
+from laim.metrics import Histogram, Metrics, start_metrics_server
+
+
+def test_histogram():
+    histogram = Histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert histogram.render() == [
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.550000',
+        'test_seconds_count 3',
+    ]
+
+
+def test_metrics_from_log_events():
+    queue = Queue()
+    queue.put('task')
+    metrics = Metrics(queue)
+
+    log({'action': 'queued-message'})
+    log({'action': 'queued-message'})
+    log({'action': 'queue-full'})
+    log({'action': 'handle-message', 'parse_ms': 2, 'queue_wait_ms': None}, start_time=0)
+
+    rendered = metrics.render()
+    assert 'laim_events_total{action="queued-message"} 2\n' in rendered
+    assert 'laim_events_total{action="queue-full"} 1\n' in rendered
+    assert 'laim_parse_duration_seconds_bucket{le="0.005"} 1\n' in rendered
+    assert 'laim_handle_duration_seconds_count 1\n' in rendered
+    assert 'laim_queue_size 1\n' in rendered
+
+
+def test_metrics_server():
+    metrics = Metrics(Queue())
+    server = start_metrics_server(metrics, ('127.0.0.1', 0))
+    try:
+        connection = http.client.HTTPConnection(*server.server_address)
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        assert response.status == 200
+        assert b'laim_queue_size 0' in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_server_on_unix_socket(tmp_path):
+    metrics = Metrics(Queue())
+    path = str(tmp_path / 'metrics.sock')
+    server = start_metrics_server(metrics, path)
+    try:
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(path)
+        client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        client.close()
+        assert response.startswith(b'HTTP/1.0 200')
+        assert b'laim_queue_size 0' in response
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_circuit_breaker_state():
+    breaker = CircuitBreaker(min_calls=1)
+    metrics = Metrics(Queue(), breaker)
+    breaker.record(breaker.allow(), True, 10)
+
+    rendered = metrics.render()
+    assert 'laim_circuit_breaker_state{state="open"} 1\n' in rendered
+    assert 'laim_circuit_breaker_state{state="closed"} 0\n' in rendered
+    assert 'laim_events_total{action="circuit-breaker"} 1\n' in rendered
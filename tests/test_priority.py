@@ -0,0 +1,98 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+
+from laim import PriorityRule, before_log
+from laim.server import LaimHandler
+from laim.priority import PrioritySpoolQueue, PriorityTaskQueue, Prioritizer
+from laim.util import TaskArguments
+
+
+RULES = [
+    PriorityRule(1, sender='^root@', subject=r'security'),
+    PriorityRule(5, recipient='^reports@'),
+    PriorityRule(2, headers={'X-Cron-Env': 'critical'}),
+]
+
+
+@pytest.mark.parametrize('sender,recipients,message,expected', [
+    ('root@localhost', ['admin'], b'Subject: *** SECURITY information ***\n\nsudo', 1),
+    ('root@localhost', ['admin'], b'Subject: Daily report\n\n', 3),
+    ('root@localhost', ['admin', 'reports@localhost'], b'Subject: Upgrades\n\n', 5),
+    ('cron@localhost', ['admin'], b'X-Cron-Env: <critical>\n\n', 2),
+    ('foo', ['admin'], b'X-Priority: 1 (Highest)\n\n', 1),
+    ('foo', ['admin'], b'Importance: low\n\n', 5),
+    ('foo', ['admin'], b'Priority: urgent\n\n', 1),
+    ('foo', ['admin'], b'X-Priority: whatever\n\n', 3),
+    ('root@localhost', ['admin'], b'Subject: =?utf-8?q?Security?=\n\n', 1),
+])
+def test_classify(sender, recipients, message, expected):
+    assert Prioritizer(RULES).classify(sender, recipients, message) == expected
+
+
+def test_invalid_rule():
+    with pytest.raises(ValueError):
+        Prioritizer([PriorityRule(0, sender='root')])
+
+
+def task(name, priority, enqueued_at):
+    return TaskArguments('foo', ['bar'], name, enqueued_at=enqueued_at, priority=priority)
+
+
+def test_queue_order_with_aging():
+    task_queue = PriorityTaskQueue(aging=60)
+    now = time.time()
+    task_queue.put(task('old low', 5, now - 300))
+    task_queue.put(None)
+    task_queue.put(task('low', 5, now))
+    task_queue.put(task('normal', 3, now))
+    task_queue.put(task('second normal', None, now))
+    task_queue.put(task('high', 1, now))
+
+    handled = []
+    while True:
+        task_args = task_queue.get_nowait()
+        if task_args is None:
+            break
+        handled.append(task_args.data)
+
+    assert handled == ['old low', 'high', 'normal', 'second normal', 'low']
+
+
+def test_spooled_priority_survives_restart(tmp_path):
+    now = time.time()
+    spool = PrioritySpoolQueue(str(tmp_path))
+    spool.put(TaskArguments('foo', ['bar'], b'low', enqueued_at=now, priority=5))
+    spool.put(TaskArguments('foo', ['bar'], b'high', enqueued_at=now, priority=1))
+
+    replayed = PrioritySpoolQueue(str(tmp_path))
+    first = replayed.get_nowait()
+    with first.data.open() as payload_fh:
+        assert payload_fh.read() == b'high'
+    assert first.priority == 1
+    assert replayed.get_nowait().priority == 5
+
+
+def test_priority_is_logged_when_queued():
+    task_queue = PriorityTaskQueue()
+    handler = LaimHandler(task_queue, prioritizer=Prioritizer(RULES))
+    envelope = mock.MagicMock()
+    envelope.mail_from = 'root@localhost'
+    envelope.rcpt_tos = ['admin']
+    envelope.content = b'Subject: Security alert\n\nsudo'
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    loop = asyncio.new_event_loop()
+    try:
+        with before_log.connected_to(on_log):
+            response = loop.run_until_complete(handler.handle_DATA(None, mock.Mock(), envelope))
+    finally:
+        loop.close()
+
+    assert response == '250 OK'
+    assert logged[0]['priority'] == 1
+    assert task_queue.get_nowait().priority == 1
@@ -0,0 +1,37 @@
+import threading
+import time
+
+from laim import before_log
+from laim.profiler import SamplingProfiler
+
+
+def test_profiler_logs_stacks_per_thread():
+    stop = threading.Event()
+
+    def busy_function():
+        while not stop.is_set():
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=busy_function, name='busy')
+    thread.start()
+
+    logged = []
+    def on_log(sender, log_data):
+        logged.append(log_data)
+
+    profiler = SamplingProfiler(duration=0.1, interval=0.001)
+    with before_log.connected_to(on_log):
+        assert profiler.start()
+        assert not profiler.start()
+        profiler.join()
+    stop.set()
+    thread.join()
+
+    assert logged[0]['action'] == 'profile-started'
+    assert logged[-1]['action'] == 'profile-done'
+    busy_stacks = [log_data for log_data in logged
+        if log_data['action'] == 'profile-stack' and log_data['thread'] == 'busy']
+    assert busy_stacks
+    assert 'busy_function' in busy_stacks[0]['stack']
+    assert 0 < busy_stacks[0]['share'] <= 1
+    assert not any(log_data.get('thread') == 'Laim profiler' for log_data in logged)
@@ -0,0 +1,53 @@
+import pytest
+
+from laim.ratelimit import RateLimit, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_then_refill():
+    clock = FakeClock()
+    limiter = RateLimiter({'sender': RateLimit(per_minute=60, burst=2)}, clock=clock)
+
+    assert limiter.acquire([('sender', 'foo')]) is None
+    assert limiter.acquire([('sender', 'foo')]) is None
+    assert limiter.acquire([('sender', 'foo')]) == ('sender', 'foo')
+
+    # Other senders are unaffected
+    assert limiter.acquire([('sender', 'bar')]) is None
+
+    clock.now += 1
+    assert limiter.acquire([('sender', 'foo')]) is None
+    assert limiter.acquire([('sender', 'foo')]) == ('sender', 'foo')
+
+
+def test_tokens_are_only_taken_if_all_keys_have_capacity():
+    clock = FakeClock()
+    limiter = RateLimiter({
+        'sender': RateLimit(per_minute=1, burst=1),
+        'recipient': RateLimit(per_minute=1, burst=2),
+    }, clock=clock)
+
+    assert limiter.acquire([('recipient', 'root'), ('sender', 'foo')]) is None
+    assert limiter.acquire([('recipient', 'root'), ('sender', 'foo')]) == ('sender', 'foo')
+
+    # The recipient still has one token left since the last attempt was rejected
+    assert limiter.acquire([('recipient', 'root'), ('sender', 'bar')]) is None
+    assert limiter.acquire([('recipient', 'root'), ('sender', 'baz')]) == ('recipient', 'root')
+
+
+def test_keys_without_limits_are_ignored():
+    limiter = RateLimiter({'sender': RateLimit(per_minute=1, burst=1)})
+    for _ in range(5):
+        assert limiter.acquire([('client', 'localhost')]) is None
+
+
+def test_invalid_limit():
+    with pytest.raises(ValueError):
+        RateLimiter({'sender': RateLimit(per_minute=0, burst=1)})
@@ -0,0 +1,79 @@
+import json
+import time
+
+from laim.maildrop import read_maildrop_file
+from laim.message import spill_to_file
+from laim.retry import RetryScheduler, get_backoff, write_dead_letter
+from laim.util import TaskArguments
+
+
+def test_schedules_retry_until_out_of_attempts():
+    retries = RetryScheduler(max_attempts=3, base_delay=0)
+    task_args = TaskArguments('foo', ['bar'], b'Message')
+
+    assert retries.schedule(task_args) == 0
+    retried, _ = retries.pop_due()
+    assert retried.attempts == 1
+
+    assert retries.schedule(retried) == 0
+    retried, _ = retries.pop_due()
+    assert retried.attempts == 2
+
+    assert retries.schedule(retried) is None
+    assert retries.pop_due() == (None, None)
+
+
+def test_retry_is_not_due_before_backoff():
+    retries = RetryScheduler(max_attempts=2, base_delay=10)
+    retries.schedule(TaskArguments('foo', ['bar'], b'Message'))
+
+    task_args, wait = retries.pop_due()
+    assert task_args is None
+    assert 4 < wait <= 10
+
+
+def test_limits_messages_waiting_to_be_retried():
+    retries = RetryScheduler(max_attempts=2, base_delay=10, max_retrying=1)
+
+    assert retries.schedule(TaskArguments('foo', ['bar'], b'1')) is not None
+    assert retries.schedule(TaskArguments('foo', ['bar'], b'2')) is None
+    assert [task_args.data for task_args in retries.drain()] == [b'1']
+    assert len(retries) == 0
+
+
+def test_keeps_track_of_bytes_waiting_to_be_retried():
+    retries = RetryScheduler(max_attempts=2, base_delay=0)
+    retries.schedule(TaskArguments('foo', ['bar'], b'Message'))
+    retries.park(TaskArguments('foo', ['bar'], b'Note'), 10)
+    assert retries.retrying_bytes == 11
+
+    retried, _ = retries.pop_due()
+    assert retried.data == b'Message'
+    assert retries.retrying_bytes == 4
+
+    retries.drain()
+    assert retries.retrying_bytes == 0
+
+
+def test_backoff():
+    for _ in range(100):
+        assert 1 <= get_backoff(1, 2, 60) <= 2
+        assert 4 <= get_backoff(3, 2, 60) <= 8
+        assert 30 <= get_backoff(10, 2, 60) <= 60
+
+
+def test_dead_letter_can_be_read_from_maildrop(tmp_path):
+    payload = spill_to_file(b'Subject: Hi\r\n\r\nHello\r\n', str(tmp_path))
+    task_args = TaskArguments('foo', ['bar'], payload, enqueued_at=time.time(), attempts=3)
+
+    filename = write_dead_letter(str(tmp_path), task_args, 'ValueError', 'Nope')
+
+    dead_letter = read_maildrop_file(str(tmp_path / filename), in_memory=True)
+    assert dead_letter.sender == 'foo'
+    assert dead_letter.recipients == ['bar']
+    assert dead_letter.enqueued_at == task_args.enqueued_at
+    assert dead_letter.data == b'Subject: Hi\r\n\r\nHello\r\n'
+    with open(str(tmp_path / filename), 'rb') as dead_letter_fh:
+        header = json.loads(dead_letter_fh.readline())
+    assert header['attempts'] == 3
+    assert header['error_msg'] == 'Nope'
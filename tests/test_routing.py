@@ -0,0 +1,125 @@
+import pytest
+
+from laim.routing import RouteError, Router
+
+
+ROUTES = {
+    'root@example.com': 'exact',
+    'root': 'local_part',
+    'alerts-*@example.com': 'domain_prefix',
+    'alerts-db-*@example.com': 'longer_domain_prefix',
+    'alerts-*': 'prefix',
+    '@example.com': 'domain',
+    '*': 'default',
+}
+
+
+@pytest.mark.parametrize('recipient,expected', [
+    ('root@example.com', 'exact'),
+    ('ROOT@Example.com', 'exact'),
+    ('root@example.org', 'local_part'),
+    ('root', 'local_part'),
+    ('alerts-web@example.com', 'domain_prefix'),
+    ('alerts-db-1@example.com', 'longer_domain_prefix'),
+    ('alerts-web@example.org', 'prefix'),
+    ('alerts-web', 'prefix'),
+    ('alerts-', 'prefix'),
+    ('postmaster@example.com', 'domain'),
+    ('postmaster@example.org', 'default'),
+    ('postmaster', 'default'),
+])
+def test_lookup(recipient, expected):
+    assert Router(ROUTES, None).lookup(recipient) == expected
+
+
+def test_lookup_without_default():
+    assert Router({'@example.com': 'domain'}, None).lookup('root') is None
+
+
+@pytest.mark.parametrize('pattern', ['*root', 'al*erts', 'root@*.example.com', 'a**'])
+def test_invalid_pattern(pattern):
+    with pytest.raises(ValueError):
+        Router({pattern: 'target'}, None)
+
+
+class FakeSink:
+    name = 'sink'
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, sender, recipients, message):
+        self.sent.append(recipients)
+        return {'sink_status': 200}
+
+
+class Handler:
+    def __init__(self):
+        self.handled = []
+        self.sink = FakeSink()
+
+    def handle_security(self, sender, recipients, message):
+        self.handled.append(recipients)
+
+    def fail(self, sender, recipients, message):
+        raise ValueError('failed for %s' % ','.join(recipients))
+
+    fail_again = fail
+
+
+def test_dispatch_splits_recipients():
+    handler = Handler()
+    router = Router({
+        'security@example.com': 'handle_security',
+        'root': 'handle_security',
+        '@example.com': 'sink',
+    }, handler)
+
+    log_data = router.dispatch('foo', [
+        'security@example.com',
+        'dev@example.com',
+        'root',
+        'other@example.org',
+        'ops@example.com',
+    ], 'message')
+
+    assert handler.handled == [['security@example.com', 'root']]
+    assert handler.sink.sent == [['dev@example.com', 'ops@example.com']]
+    assert log_data == {
+        'routes': 'handle_security,sink',
+        'unrouted': 'other@example.org',
+        'sink_status': 200,
+    }
+
+
+def test_dispatch_to_object():
+    sink = FakeSink()
+    router = Router({'*': sink}, None)
+
+    log_data = router.dispatch('foo', ['bar'], 'message')
+
+    assert sink.sent == [['bar']]
+    assert log_data['routes'] == 'sink'
+
+
+def test_dispatch_tries_all_routes():
+    handler = Handler()
+    router = Router({'root': 'fail', '@example.com': 'sink'}, handler)
+
+    with pytest.raises(ValueError) as exc_info:
+        router.dispatch('foo', ['root', 'dev@example.com'], 'message')
+    assert handler.sink.sent == [['dev@example.com']]
+    assert exc_info.value.failed_recipients == ['root']
+
+    router = Router({'root': 'fail', '@example.com': 'fail_again', '*': 'sink'}, handler)
+    with pytest.raises(RouteError) as exc_info:
+        router.dispatch('foo', ['root', 'dev@example.com', 'other'], 'message')
+    assert str(exc_info.value) == \
+        '2 of 3 routes failed: fail: failed for root, fail_again: failed for dev@example.com'
+    assert exc_info.value.failed_recipients == ['root', 'dev@example.com']
+
+
+def test_unknown_target():
+    router = Router({'root': 'handle_root'}, Handler())
+    with pytest.raises(ValueError):
+        router.resolve()
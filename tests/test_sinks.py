@@ -0,0 +1,148 @@
+import http.client
+import http.server
+import json
+import socketserver
+import threading
+from email.message import Message
+
+import pytest
+
+from laim import QueuedMessage
+from laim.sinks import WebhookError, WebhookSink
+
+
+class WebhookServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), WebhookRequestHandler)
+        self.requests = []
+        self.connections = 0
+        self.status = 200
+        self.drop_idle_connections = False
+        self.respond = True
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+
+
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        self.closed.set()
+
+
+class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.requests.append((self.path, json.loads(body)))
+        if not self.server.respond:
+            # Disconnect after the request was received, like a crashing server
+            self.close_connection = True
+            return
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+        # Close without telling the client, like servers timing out idle
+        # connections do
+        self.close_connection = self.server.drop_idle_connections
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def webhook_server():
+    server = WebhookServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def create_message(subject, body):
+    message = Message()
+    message['Subject'] = subject
+    message.set_payload(body)
+    return message
+
+
+def create_sink(server, **kwargs):
+    return WebhookSink(
+        'http://127.0.0.1:%d/hook?token=foo' % server.server_address[1],
+        payload={'text': '{hostname}: {subject}', 'details': ['{recipients}', '{body}']},
+        name='test',
+        **kwargs
+    )
+
+
+def test_webhook_sink_reuses_connection(webhook_server):
+    sink = create_sink(webhook_server)
+    log_data = sink.send('foo', ['bar', 'baz'], create_message('Hello', 'Message'))
+    sink.send('foo', ['bar'], create_message('Again', 'Message'))
+    sink.close()
+
+    assert log_data['sink'] == 'test'
+    assert log_data['sink_status'] == 200
+    assert log_data['sink_ms'] > 0
+    assert webhook_server.connections == 1
+    path, payload = webhook_server.requests[0]
+    assert path == '/hook?token=foo'
+    assert payload == {
+        'text': '%s: Hello' % sink.hostname,
+        'details': ['bar, baz', 'Message'],
+    }
+
+
+def test_webhook_sink_reconnects_when_idle_connection_is_closed(webhook_server):
+    webhook_server.drop_idle_connections = True
+    sink = create_sink(webhook_server)
+    sink.send('foo', ['bar'], create_message('Hello', 'Message'))
+    assert webhook_server.closed.wait(5)
+    sink.send('foo', ['bar'], create_message('Again', 'Message'))
+    sink.close()
+
+    assert len(webhook_server.requests) == 2
+    assert webhook_server.connections == 2
+
+
+def test_webhook_sink_does_not_resend_request_the_server_received(webhook_server):
+    sink = create_sink(webhook_server)
+    sink.send('foo', ['bar'], create_message('Hello', 'Message'))
+    webhook_server.respond = False
+    with pytest.raises(http.client.RemoteDisconnected):
+        sink.send('foo', ['bar'], create_message('Again', 'Message'))
+    sink.close()
+
+    assert len(webhook_server.requests) == 2
+    assert webhook_server.connections == 1
+
+
+def test_webhook_sink_error_status(webhook_server):
+    webhook_server.status = 500
+    sink = create_sink(webhook_server)
+    with pytest.raises(WebhookError):
+        sink.send('foo', ['bar'], create_message('Hello', 'Message'))
+    sink.close()
+
+
+def test_webhook_sink_batch(webhook_server):
+    sink = create_sink(webhook_server, concurrency=3)
+    batch = [QueuedMessage('foo', ['bar'], create_message(str(i), 'Message')) for i in range(10)]
+    log_data = sink.send_batch(batch)
+    sink.close()
+
+    assert log_data['sink_requests'] == 10
+    assert sorted(payload['text'].split(': ')[1] for _, payload in webhook_server.requests) == \
+        sorted(str(i) for i in range(10))
+    assert webhook_server.connections <= 3
@@ -0,0 +1,84 @@
+import os
+import queue
+import socket
+import tempfile
+import threading
+from unittest import mock
+
+from laim.__main__ import main
+from laim.server import LaimController, LaimHandler
+from laim.sockets import bind_unix_socket, get_systemd_sockets
+
+
+def test_get_systemd_sockets():
+    listening_socket = socket.socket()
+    listening_socket.bind(('127.0.0.1', 0))
+    listening_socket.listen()
+    environ = {
+        'LISTEN_PID': str(os.getpid()),
+        'LISTEN_FDS': '1',
+        'LISTEN_FDNAMES': 'laim.socket',
+    }
+
+    with mock.patch('laim.sockets.SD_LISTEN_FDS_START', listening_socket.fileno()):
+        sockets = get_systemd_sockets(environ)
+
+    assert environ == {}
+    assert len(sockets) == 1
+    assert sockets[0].getsockname() == listening_socket.getsockname()
+    listening_socket.detach()
+    sockets[0].close()
+
+
+def test_get_systemd_sockets_for_other_process():
+    environ = {
+        'LISTEN_PID': str(os.getpid() + 1),
+        'LISTEN_FDS': '1',
+    }
+
+    assert get_systemd_sockets(environ) == []
+    assert environ == {}
+
+
+def test_sendmail_over_unix_socket():
+    task_queue = queue.Queue()
+    privilege_event = threading.Event()
+    privilege_event.set()
+    stdin_mock = mock.Mock()
+    stdin_mock.buffer = [
+        b'From: "Foo" <foo@example.com>\n',
+        b'To: bar@example.com\n',
+        b'Bcc: secret@example.com\n',
+        b'\n',
+        b'.leading dot\n',
+        b'last line',
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'smtp.sock')
+        # A stale socket from a previous run should be replaced
+        bind_unix_socket(path).close()
+        controller = LaimController(
+            privilege_event,
+            LaimHandler(task_queue),
+            port=0,
+            sockets=[bind_unix_socket(path)],
+            bind_port=False,
+        )
+        controller.start()
+        try:
+            with mock.patch('laim.__main__.SMTP_SOCKET', path):
+                with mock.patch('laim.__main__.sys.stdin', stdin_mock):
+                    main([])
+        finally:
+            controller.stop()
+
+    task = task_queue.get_nowait()
+    assert task.sender == 'foo@example.com'
+    assert task.recipients == ['bar@example.com', 'secret@example.com']
+    assert task.data == (
+        b'From: "Foo" <foo@example.com>\r\n'
+        b'To: bar@example.com\r\n'
+        b'\r\n'
+        b'.leading dot\r\n'
+        b'last line\r\n'
+    )
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import queue
+import tempfile
+
+import pytest
+
+from laim.spool import SpoolQueue, list_spool
+from laim.util import TaskArguments
+
+
+@pytest.fixture
+def spool_dir():
+    with tempfile.TemporaryDirectory() as directory:
+        yield directory
+
+
+def test_put_and_replay(spool_dir):
+    spool = SpoolQueue(spool_dir)
+    spool.put(TaskArguments('foo', ['bar', 'baz'], b'first'))
+    spool.put(TaskArguments('foo', ['bar'], b'second'))
+
+    first = spool.get()
+    assert read_payload(first.data) == b'first'
+    spool.ack(first)
+
+    # The second message was never acked, and should be replayed
+    replayed_spool = SpoolQueue(spool_dir)
+    assert replayed_spool.replayed == 1
+    replayed = replayed_spool.get_nowait()
+    assert replayed.sender == 'foo'
+    assert replayed.recipients == ['bar']
+    assert read_payload(replayed.data) == b'second'
+
+
+def test_stop_sentinel_is_not_persisted(spool_dir):
+    spool = SpoolQueue(spool_dir)
+    spool.put(None)
+    assert spool.get() is None
+    assert list_spool(spool_dir) == []
+
+
+def test_put_async(spool_dir):
+    spool = SpoolQueue(spool_dir, maxsize=1)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(spool.put_async(TaskArguments('foo', ['bar'], b'data'), loop))
+        with pytest.raises(queue.Full):
+            loop.run_until_complete(spool.put_async(TaskArguments('foo', ['bar'], b'data'), loop))
+    finally:
+        loop.close()
+
+    task_args = spool.get_nowait()
+    assert task_args.spool_id in os.listdir(os.path.join(spool_dir, 'new'))
+    assert os.listdir(os.path.join(spool_dir, 'tmp')) == []
+
+
+def test_items_being_persisted_are_not_handed_out(spool_dir):
+    spool = SpoolQueue(spool_dir, maxsize=1)
+    spool._reserve() # pylint: disable=protected-access
+    assert spool.qsize() == 0
+    with pytest.raises(queue.Empty):
+        spool.get(timeout=0.01)
+    with pytest.raises(queue.Full):
+        spool._reserve(block=False) # pylint: disable=protected-access
+
+
+def test_put_async_cancelled_while_committing(spool_dir):
+    spool = SpoolQueue(spool_dir, maxsize=1)
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(spool.put_async(TaskArguments('foo', ['bar'], b'data'), loop))
+        loop.call_soon(task.cancel)
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+        # The item was written before the cancellation, thus is published once committed
+        task_args = loop.run_until_complete(loop.run_in_executor(None, spool.get, True, 5))
+    finally:
+        loop.close()
+
+    assert task_args.spool_id in os.listdir(os.path.join(spool_dir, 'new'))
+    assert spool.qsize() == 0
+
+
+def test_list_spool(spool_dir):
+    spool = SpoolQueue(spool_dir)
+    spool.put(TaskArguments('foo', ['bar', 'baz'], b'Subject: test\n\nbody'))
+
+    entries = list_spool(spool_dir)
+    assert len(entries) == 1
+    assert entries[0].sender == 'foo'
+    assert entries[0].recipients == ['bar', 'baz']
+    assert entries[0].size == len(b'Subject: test\n\nbody')
+
+
+def read_payload(payload):
+    with payload.open() as payload_fh:
+        return payload_fh.read()
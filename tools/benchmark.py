@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''
+Load test the full path from SMTP to the handler.
+
+Starts a laim handler on a local port, and sends messages to it from several
+concurrent SMTP clients. Reports how many messages per second were accepted,
+how many were rejected because the queue was full, and the latency from the
+start of each SMTP transaction until the handler is done with the message.
+
+Runs as the current user, like ./devhandler.py, from the root of a checkout:
+
+    $ ./venv/bin/python tools/benchmark.py --help
+'''
+
+import argparse
+import os
+import pwd
+import smtplib
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from unittest import mock
+
+# Use the laim of the checkout the script is in, also when it's not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from laim import Laim, before_log # pylint: disable=wrong-import-position
+
+
+def main():
+    args = get_args()
+
+    with tempfile.NamedTemporaryFile() as config_fh:
+        with mock.patch('os.setgroups'):
+            # Prevent a call to setgroups() that requires superuser privileges
+            handler = BenchmarkHandler(
+                handler_delay=args.handler_delay_ms/1000,
+                port=args.port,
+                user=pwd.getpwuid(os.getuid()).pw_name,
+                max_queue_size=args.queue_size,
+                num_workers=args.workers,
+                admission_timeout=args.admission_timeout,
+                config_file=config_fh.name,
+                log_target='stdout',
+                smtp_kwargs={
+                    'data_size_limit': 0,
+                },
+            )
+
+    rejected_events = []
+    def count_rejected(sender, log_data): # pylint: disable=unused-argument
+        if log_data['action'] == 'queue-full':
+            rejected_events.append(log_data)
+    before_log.connect(count_rejected)
+
+    handler_thread = threading.Thread(target=handler.run)
+    handler_thread.start()
+
+    messages = build_messages(args.messages, args.size, args.shape)
+    results = send_messages(messages, args.port, args.concurrency)
+    handler.wait_for(results.accepted_ids, timeout=args.drain_timeout)
+    handler.stop()
+    handler_thread.join()
+
+    print_report(args, results, handler, len(rejected_events))
+
+
+class BenchmarkHandler(Laim):
+
+    def __init__(self, handler_delay, **kwargs):
+        super().__init__(**kwargs)
+        self.handler_delay = handler_delay
+        self.completed = {}
+        self.completed_lock = threading.Condition()
+
+
+    def handle_message(self, sender, recipients, message):
+        if self.handler_delay:
+            time.sleep(self.handler_delay)
+        with self.completed_lock:
+            self.completed[message['X-Benchmark-Id']] = time.monotonic()
+            self.completed_lock.notify_all()
+
+
+    def wait_for(self, message_ids, timeout):
+        deadline = time.monotonic() + timeout
+        with self.completed_lock:
+            while not all(message_id in self.completed for message_id in message_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.completed_lock.wait(remaining)
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}
+        self.accepted_ids = []
+        # Reply code -> number of messages rejected with it, and the text of
+        # the first reply with the code
+        self.errors = {}
+        self.first_errors = {}
+        self.duration = None
+
+
+    def add_error(self, code, text):
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+            self.first_errors.setdefault(code, text)
+
+
+def build_messages(count, size, shape):
+    body = ('x' * 75 + '\n') * (size // 76 + 1)
+    body = body[:size]
+    messages = []
+    for message_id in range(count):
+        if shape == 'plain':
+            message = MIMEText(body)
+        elif shape == 'multipart':
+            message = MIMEMultipart('alternative')
+            message.attach(MIMEText(body))
+            message.attach(MIMEText('<pre>%s</pre>' % body, 'html'))
+        else:
+            message = MIMEMultipart()
+            message.attach(MIMEText('See attached'))
+            message.attach(MIMEApplication(os.urandom(size), Name='dump.bin'))
+        message['Subject'] = 'Benchmark message %d' % message_id
+        message['From'] = 'benchmark@localhost'
+        message['To'] = 'root@localhost'
+        message['X-Benchmark-Id'] = str(message_id)
+        # smtplib sends bytes as they are, the lines must already end in CRLF
+        messages.append((str(message_id), message.as_bytes(policy=SMTP)))
+    return messages
+
+
+def send_messages(messages, port, concurrency):
+    results = Results()
+    remaining = list(reversed(messages))
+    remaining_lock = threading.Lock()
+
+    def send():
+        with smtplib.SMTP('127.0.0.1', port=port) as smtp:
+            while True:
+                with remaining_lock:
+                    if not remaining:
+                        return
+                    message_id, data = remaining.pop()
+
+                started = time.monotonic()
+                try:
+                    smtp.sendmail('benchmark@localhost', ['root@localhost'], data)
+                except smtplib.SMTPResponseException as ex:
+                    results.add_error(ex.smtp_code, ex.smtp_error)
+                    smtp.rset()
+                    continue
+                except smtplib.SMTPRecipientsRefused as ex:
+                    results.add_error(*ex.recipients['root@localhost'])
+                    smtp.rset()
+                    continue
+
+                with results.lock:
+                    results.started[message_id] = started
+                    results.accepted_ids.append(message_id)
+
+    start_time = time.monotonic()
+    clients = [threading.Thread(target=send) for _ in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    results.duration = time.monotonic() - start_time
+    return results
+
+
+def print_report(args, results, handler, rejected_events):
+    latencies = sorted(
+        (handler.completed[message_id] - results.started[message_id])*1000
+        for message_id in results.accepted_ids
+        if message_id in handler.completed
+    )
+    accepted = len(results.accepted_ids)
+    print()
+    print('messages=%d concurrency=%d size=%d shape=%s workers=%d' % (
+        args.messages, args.concurrency, args.size, args.shape, args.workers))
+    print('accepted: %d (%.1f msg/s)' % (accepted, accepted/results.duration))
+    queue_full = results.errors.get(451, 0)
+    print('queue-full: %d (%.1f%%), logged: %d' % (
+        queue_full, 100*queue_full/args.messages, rejected_events))
+    print('errors: %d' % sum(results.errors.values()))
+    for code, count in sorted(results.errors.items()):
+        text = results.first_errors[code]
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        print('  %d: %d, first: %s' % (code, count, text))
+    print('handled: %d' % len(latencies))
+    if latencies:
+        print('latency ms: p50=%.1f p90=%.1f p99=%.1f max=%.1f mean=%.1f' % (
+            percentile(latencies, 50),
+            percentile(latencies, 90),
+            percentile(latencies, 99),
+            latencies[-1],
+            statistics.mean(latencies),
+        ))
+
+
+def percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--messages', type=int, default=1000,
+        help='Number of messages to send. Default: %(default)s')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+        help='Number of concurrent SMTP clients. Default: %(default)s')
+    parser.add_argument('-s', '--size', type=int, default=1024,
+        help='Size of the message body in bytes. Default: %(default)s')
+    parser.add_argument('--shape', choices=('plain', 'multipart', 'attachment'),
+        default='plain', help='MIME structure of the messages. Default: %(default)s')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='Number of handler workers. Default: %(default)s')
+    parser.add_argument('-q', '--queue-size', type=int, default=50,
+        help='Max queue size. Default: %(default)s')
+    parser.add_argument('--admission-timeout', type=float, default=10,
+        help='Seconds to wait for space in a full queue. Default: %(default)s')
+    parser.add_argument('-d', '--handler-delay-ms', type=float, default=0,
+        help='Time the handler spends on each message. Default: %(default)s')
+    parser.add_argument('-p', '--port', type=int, default=2526,
+        help='Port to run laim on. Default: %(default)s')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+        help='Max seconds to wait for the handler to finish after sending. '
+        'Default: %(default)s')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+'''
+Measure how long a sendmail invocation takes, from starting the process until
+it exits after submitting the message.
+
+Starts an SMTP server that accepts and discards everything, and runs sendmail
+against it repeatedly. The startup time of the bare interpreter is reported
+too, since that's the lower bound for any invocation.
+'''
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from aiosmtpd.controller import Controller
+
+
+SENDMAIL_SCRIPT = '''
+import sys
+import laim.__main__ as sendmail
+sendmail.SMTP_PORT = %d
+sendmail.SMTP_SOCKET = '/nonexistent'
+sendmail.main(sys.argv[1:])
+'''
+
+
+def main():
+    args = get_args()
+
+    controller = Controller(DiscardingHandler(), hostname='127.0.0.1', port=args.port)
+    controller.start()
+    try:
+        message = build_message(args.size)
+        interpreter = time_runs([sys.executable, '-c', 'pass'], b'', args.runs)
+        sendmail = time_runs(
+            [sys.executable, '-c', SENDMAIL_SCRIPT % args.port, 'root@localhost'],
+            message,
+            args.runs,
+        )
+    finally:
+        controller.stop()
+
+    print('runs=%d size=%d' % (args.runs, args.size))
+    print_timings('interpreter', interpreter)
+    print_timings('sendmail', sendmail)
+    print('sendmail overhead: %.1f ms' % (
+        statistics.median(sendmail) - statistics.median(interpreter)))
+
+
+class DiscardingHandler:
+    async def handle_DATA(self, server, session, envelope):
+        return '250 OK'
+
+
+def build_message(size):
+    body = ('x' * 75 + '\n') * (size // 76 + 1)
+    return (
+        'From: root (Cron Daemon)\n'
+        'To: root\n'
+        'Subject: Cron <root@localhost> run-parts /etc/cron.hourly\n'
+        '\n'
+        '%s' % body[:size]
+    ).encode('utf-8')
+
+
+def time_runs(command, stdin, runs):
+    timings = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, input=stdin, check=True)
+        timings.append((time.perf_counter() - start_time)*1000)
+    return timings
+
+
+def print_timings(name, timings):
+    print('%s ms: p50=%.1f min=%.1f max=%.1f mean=%.1f' % (
+        name,
+        statistics.median(timings),
+        min(timings),
+        max(timings),
+        statistics.mean(timings),
+    ))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--runs', type=int, default=50,
+        help='Number of times to run sendmail. Default: %(default)s')
+    parser.add_argument('-s', '--size', type=int, default=1024,
+        help='Size of the message body in bytes. Default: %(default)s')
+    parser.add_argument('-p', '--port', type=int, default=2527,
+        help='Port to run the SMTP server on. Default: %(default)s')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()